@@ -1,21 +1,28 @@
 from flask import Flask, jsonify, request, send_from_directory
 from flask_login import login_user, logout_user, LoginManager
-from flask_socketio import SocketIO, emit
+from flask_socketio import SocketIO, emit, join_room
 
 import logging
 logging.basicConfig(level=logging.DEBUG)
 
 from flask_cors import CORS
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
 from api.models import Base, Content
 from api.openaichat import openai_single_prompt_chat, build_doc_explanation_msg, openai_chat
 from dotenv import load_dotenv
 import os
+import threading
+from functools import partial
 
-from api.database import get_content_list, store_latest_version, get_latest_version, store_content_list, get_chats, create_highlight, get_highlights, sync_content, get_chat_by_id, create_chat, update_chat, store_user, get_user, update_content
+from api.database import engine, Session, get_library_version, get_content_list, get_content_page, get_content_by_id, get_change_cursor, get_changes, search_content, store_latest_version, get_latest_version, store_content_list, get_chats, create_highlight, get_highlights, sync_content, get_chat_by_id, get_chat_messages, create_chat, update_chat, append_chat_messages, store_user, get_user, update_content, get_note_document, save_note_edit, RevisionConflict
 from api.zotero_sync import sync_zotero_down, download_zotero_attachment
 from api.converters import quill2Dict
+from api.delta import DeltaError, to_html
+from api.note_store import note_filename, note_store
+from api.migrations import upgrade
+from api.cache import ResponseCache, cached_response
+from api.sync_jobs import SyncRunner
+from api.attachments import prefetch_collection_attachments, send_attachment
+from api import events, zotero_http
 
 
 login_manager = LoginManager()
@@ -24,8 +31,6 @@ login_manager = LoginManager()
 def load_user(user_id):
     return get_user({'id':user_id})
 
-DATABASE_URL = 'sqlite:///locus.db'
-
 load_dotenv()
 
 ZOTERO_API_KEY = os.getenv("ZOTERO_API_KEY")
@@ -33,15 +38,48 @@ ZOTERO_USER_ID = os.getenv("ZOTERO_USER_ID")
 ZOTERO_COLLECTION_NAME = os.getenv("ZOTERO_COLLECTION", "locus") 
 CONTENT_FILE_PATH = os.getenv("CONTENT_FILE_PATH")
 OPEN_AI_API_KEY = os.getenv("OPEN_AI_API_KEY")
+# number of past messages sent to the LLM with each new one
+CHAT_HISTORY_LIMIT = int(os.getenv("CHAT_HISTORY_LIMIT", 100))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", 256))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+# how long content change events are collected before they are pushed to clients, in seconds
+CHANGE_PUSH_INTERVAL = float(os.getenv("CHANGE_PUSH_INTERVAL", 0.25))
+# seconds between background incremental syncs; 0 turns them off
+SYNC_INTERVAL = float(os.getenv("SYNC_INTERVAL", 0))
+# clients subscribed to this library's changes; one server serves one library
+LIBRARY_ROOM = f"library:{ZOTERO_USER_ID or 'local'}"
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('FLASK_APP_SECRET_KEY')
-CORS(app)
+CORS(app, expose_headers=['X-Change-Cursor'])
 socketio = SocketIO(app, cors_allowed_origins="*")
-engine = create_engine(DATABASE_URL)
-Base.metadata.create_all(engine)
-Session = sessionmaker(bind=engine)
+upgrade(engine)
 login_manager.init_app(app)
+response_cache = ResponseCache(RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_MAX_BYTES)
+change_batcher = events.ChangeBatcher(
+    lambda batch: socketio.emit('content_changes', batch, to=LIBRARY_ROOM),
+    interval=CHANGE_PUSH_INTERVAL,
+    start_task=socketio.start_background_task,
+    sleep=socketio.sleep,
+)
+events.subscribe(change_batcher.add)
+sync_runner = SyncRunner(
+    lambda progress: sync_zotero_down(ZOTERO_API_KEY, ZOTERO_USER_ID, ZOTERO_COLLECTION_NAME, progress=progress),
+    publish=lambda job: socketio.emit('sync_progress', job, to=LIBRARY_ROOM),
+    start_task=socketio.start_background_task,
+    sleep=socketio.sleep,
+)
+if SYNC_INTERVAL > 0 and ZOTERO_API_KEY:
+    sync_runner.start_periodic(SYNC_INTERVAL)
+# a single attachment prefetch at a time
+attachment_prefetch = threading.Lock()
+
+
+@socketio.on('subscribe')
+def on_subscribe(message=None):
+    # the client then receives 'content_changes' batches and fetches the rows from /changes
+    join_room(LIBRARY_ROOM)
+    emit('subscribed', {'room': LIBRARY_ROOM})
 
 
 @socketio.on('user_message')
@@ -54,15 +92,12 @@ def on_user_message(message):
     doc = message.get('doc')
     
     if chat_id:
-        # Chat exists, load the history from the db and send with the new message
-        chat_info = get_chat_by_id(chat_id, return_dict=True)
-        chat_highlights = chat_info['content_metadata']['chat']['highlights']
-        chat_messages = chat_info['content_metadata']['chat']['messages']
+        # Chat exists, load the recent history from the db and send it with the new message
+        chat_messages = [{'role': m['role'], 'content': m['content']} for m in get_chat_messages(chat_id, limit=CHAT_HISTORY_LIMIT)]
     else:
         # Create a new chat
-        chat_highlights = []
         chat_messages = []
-        chat_info = create_chat({'title': 'Chat Session'}, chat_messages, chat_highlights, return_dict=True)
+        chat_info = create_chat({'title': 'Chat Session'}, [], [], return_dict=True)
         chat_id = chat_info['id']
     
     if highlight and len(highlight)>0:
@@ -71,10 +106,12 @@ def on_user_message(message):
         msg_text += expl_text
     
     # Add the new message to the chat history
-    chat_messages.append({
+    user_message = {
         'role': 'user',
         'content': msg_text
-    })
+    }
+    chat_messages.append(user_message)
+    append_chat_messages(chat_id, [user_message])
     
     # Send the message to the OpenAI API and get LLM response
     reply = ""
@@ -88,13 +125,11 @@ def on_user_message(message):
         if content:
             reply += content
 
-    chat_messages.append({
+    # Store only the new reply; the history is already in the db
+    append_chat_messages(chat_id, [{
         'role': 'assistant',
         'content': reply
-    })
-    
-    # Update the chat entry in the database with new messages
-    update_chat(chat_id, chat_messages, chat_highlights)
+    }])
 
 # @socketio.on('user_message')
 # def on_user_message(message):
@@ -136,7 +171,16 @@ def hello_world():
 
 @app.route('/sync', methods=['POST'])
 def sync_zotero():
-   return jsonify({"version":sync_zotero_down(ZOTERO_API_KEY, ZOTERO_USER_ID, ZOTERO_COLLECTION_NAME)})
+   # runs in the background; progress is pushed as 'sync_progress' and the synced items as 'content_changes'
+   job = sync_runner.start()
+   return jsonify(job.to_dict()), 202
+
+@app.route('/sync/<job_id>', methods=['GET'])
+def get_sync_job(job_id):
+   job = sync_runner.get(job_id)
+   if job is None:
+      return jsonify({"error": "Unknown sync job"}), 404
+   return jsonify(job.to_dict())
 
 # @app.route('/chat', methods=['POST'])
 # def chat():
@@ -161,6 +205,7 @@ def sync_zotero():
 #         pass
 
 @app.route('/chats', methods=['GET'])
+@cached_response(response_cache, get_library_version)
 def get_chats_endpoint():
     # Get all chats from the database
     chats = get_chats(asdict=True)
@@ -168,6 +213,14 @@ def get_chats_endpoint():
     # Return a JSON response with the highlights
     return jsonify(chats)
 
+@app.route('/chats/<int:chat_id>/messages', methods=['GET'])
+def get_chat_messages_endpoint(chat_id):
+    # e.g. /chats/3/messages?limit=50 for the latest page, then &before=<seq of the oldest message> for older ones
+    limit = request.args.get('limit', type=int)
+    messages = get_chat_messages(chat_id, limit=limit, before_seq=request.args.get('before', type=int))
+    # seq starts at 1 in every chat, so anything above it means older messages remain
+    return jsonify({"messages": messages, "has_more": bool(messages) and messages[0]['seq'] > 1})
+
 @app.route('/create_highlight', methods=['POST'])
 def create_highlight_endpoint():
     # Extract highlight data from the request JSON
@@ -182,6 +235,7 @@ def create_highlight_endpoint():
     return jsonify(new_highlight)
 
 @app.route('/highlights', methods=['GET'])
+@cached_response(response_cache, get_library_version)
 def get_highlights_endpoint():
     # Get all highlights from the database
     highlights = get_highlights(asdict=True)
@@ -193,10 +247,53 @@ def get_highlights_endpoint():
 def save():
     data = request.get_json()
     print(data)
-    # stored_contents, error = store_content_list([quill2Dict(data, storage_path = CONTENT_FILE_PATH, storage_fmt="html")], return_dict=True)
-    error = sync_content([quill2Dict(data, storage_path = CONTENT_FILE_PATH, storage_fmt="html")], [], sync_key="id")
-    stored_contents = get_content_list(asdict=True)
-    return jsonify({"message": "Saved", "error": error, "saved_content": stored_contents})
+    if 'ops' in data:
+        return save_edit(data)
+    note = quill2Dict(data)
+    if note_store is not None and note['id'] is not None:
+        note['filename'] = note_filename(note['id'])
+    stored_contents, error = store_content_list([note], return_dict=True, key="id")
+    if error:
+        return jsonify({"message": "Not saved", "error": error}), 500
+    saved = stored_contents[0]
+    if note_store is not None:
+        # written in the background; /attachment waits for a pending write of the file it serves
+        filename = note_store.save(saved['id'], data['content'] if 'content' in data else partial(render_note, saved['id']))
+        if saved['filename'] != filename:
+            # a new note, or one stored under its title before
+            update_content([{"id": saved['id'], "filename": filename}])
+            saved = get_content_by_id(saved['id'])
+    # only the saved item; clients pick up other changes from /changes
+    return jsonify({"message": "Saved", "error": None, "saved_content": saved})
+
+def save_edit(data):
+    # e.g. {"id": 7, "base_revision": 12, "ops": [{"retain": 120}, {"insert": "a"}]}: the edit since base_revision
+    try:
+        saved = save_note_edit(data['id'], data['base_revision'], data['ops'], title=data.get('title'),
+                               filename=note_filename(data['id']) if note_store is not None else None)
+    except RevisionConflict as e:
+        # the client fetches /content/<id>/document and rebases its pending edits on it
+        return jsonify({"message": "Not saved", "error": str(e), "revision": e.revision}), 409
+    except DeltaError as e:
+        return jsonify({"message": "Not saved", "error": str(e)}), 400
+    if saved is None:
+        return jsonify({"message": "Not saved", "error": "No such note"}), 404
+    if note_store is not None:
+        # rendered when the file is written, once for a burst of edits
+        note_store.save(saved['id'], partial(render_note, saved['id']))
+    return jsonify({"message": "Saved", "error": None, "revision": saved['revision']})
+
+def render_note(content_id):
+    document = get_note_document(content_id)
+    return to_html(document['delta']['ops']) if document else ''
+
+@app.route('/content/<int:content_id>/document', methods=['GET'])
+def get_note(content_id):
+    # the current delta and revision of a note, the base for incremental saves
+    document = get_note_document(content_id)
+    if document is None:
+        return jsonify({"message": "No such note"}), 404
+    return jsonify(document)
 
 @app.route('/dl_zotero', methods=['POST'])
 def dl_zotero():
@@ -205,19 +302,86 @@ def dl_zotero():
         return jsonify({"message": "Not a zotero entry"}), 400
     content_id = data['id']
     zotero_key = data['zotero_key']
-    attachment = download_zotero_attachment(ZOTERO_API_KEY, ZOTERO_USER_ID, zotero_key, CONTENT_FILE_PATH)
-    if attachment:
+    downloaded = download_zotero_attachment(ZOTERO_API_KEY, ZOTERO_USER_ID, zotero_key, CONTENT_FILE_PATH)
+    if downloaded:
         print("updating the filename")
-        # update the content entry
-        update_obj = {"id":content_id, "filename": attachment['data']['filename'] }
+        # update the content entry to point at the stored file
+        attachment, filename = downloaded
+        update_obj = {"id":content_id, "filename": filename }
         # print(update_obj)
         update_content([update_obj,])
-        return "successfully downloaded file", 200
+        item = get_content_by_id(content_id)
+        return jsonify({"message": "successfully downloaded file", "item": item}), 200
+    return jsonify({"message": "No attachment found"}), 404
+
+@app.route('/attachments/prefetch', methods=['POST'])
+def prefetch_attachments():
+    # downloads run in the background; every stored file shows up as a 'content_changes' update of its entry
+    if not attachment_prefetch.acquire(blocking=False):
+        return jsonify({"message": "Attachment prefetch already running"}), 409
+
+    def run():
+        try:
+            prefetch_collection_attachments(ZOTERO_API_KEY, ZOTERO_USER_ID, ZOTERO_COLLECTION_NAME, CONTENT_FILE_PATH)
+        except Exception:
+            logging.exception("Attachment prefetch failed")
+        finally:
+            attachment_prefetch.release()
+    socketio.start_background_task(run)
+    return jsonify({"message": "Prefetching attachments"}), 202
+
+CONTENT_PAGE_PARAMS = ('limit', 'cursor', 'content_type', 'tag', 'author', 'group', 'fields')
+MAX_PAGE_SIZE = 500
 
 @app.route('/content', methods=['GET'])
 def get_all_content():
-    content_data = get_content_list(asdict=True)
-    return jsonify(content_data)
+    # the change feed position before the listing; /changes from it returns everything written since
+    cursor = get_change_cursor()
+    response = list_content()
+    response.headers['X-Change-Cursor'] = cursor
+    return response
+
+@cached_response(response_cache, get_library_version)
+def list_content():
+    if not any(param in request.args for param in CONTENT_PAGE_PARAMS):
+        # unpaginated listing for older clients
+        content_data = get_content_list(asdict=True)
+        return jsonify(content_data)
+
+    # e.g. /content?limit=100&content_type=zotero_entry&fields=id,title,authors&cursor=<next_cursor>
+    limit = request.args.get('limit', 50, type=int)
+    fields = request.args.get('fields')
+    try:
+        items, next_cursor = get_content_page(
+            limit=min(max(limit, 1), MAX_PAGE_SIZE),
+            cursor=request.args.get('cursor'),
+            content_type=request.args.get('content_type'),
+            tag=request.args.get('tag'),
+            author_id=request.args.get('author', type=int),
+            group_id=request.args.get('group', type=int),
+            fields=fields.split(',') if fields else None,
+        )
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
+    return jsonify({"items": items, "next_cursor": next_cursor})
+
+@app.route('/search', methods=['GET'])
+def search_endpoint():
+    # e.g. /search?q=transformer+attention&limit=20&offset=20&content_type=note
+    query = request.args.get('q', '')
+    limit = min(max(request.args.get('limit', 20, type=int), 1), MAX_PAGE_SIZE)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    results, next_offset = search_content(query, limit, offset, request.args.get('content_type'))
+    return jsonify({"results": results, "next_offset": next_offset})
+
+@app.route('/changes', methods=['GET'])
+def changes():
+    # e.g. /changes?since=<cursor from the last call>; without since, the whole library
+    limit = min(max(request.args.get('limit', MAX_PAGE_SIZE, type=int), 1), MAX_PAGE_SIZE)
+    try:
+        return jsonify(get_changes(request.args.get('since'), limit))
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
 
 @app.route('/content/<content_id>', methods=['GET'])
 def get_single_content(content_id):
@@ -231,7 +395,16 @@ def update_content_by_id(content_id):
 
 @app.route('/attachment/<filename>', methods=['GET'])
 def get_attachment(filename):
-    return send_from_directory(CONTENT_FILE_PATH, filename)
+    # supports Range requests; content-addressed files are cached by clients for good
+    if note_store is not None:
+        note_store.flush([filename])
+    return send_attachment(CONTENT_FILE_PATH, filename)
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return jsonify({"response_cache": response_cache.stats(), "library_version": get_library_version(),
+                    "zotero": zotero_http.stats()})
 
 
 @app.route('/register', methods=['POST'])
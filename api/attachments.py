@@ -0,0 +1,337 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+from flask import Response, abort, request, send_file
+from werkzeug.security import safe_join
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import re
+import shutil
+import threading
+
+from api.database import get_entries_without_file, update_content
+from api.zotero_http import ZoteroClient, get_client
+
+"""
+attachments.py
+
+This module downloads the files of Zotero attachments (the PDFs of library entries) into CONTENT_FILE_PATH. A file is
+streamed to disk in chunks, so its size does not matter for memory, into a partial file under `.partial/`. When it is
+complete it is checked against the MD5 Zotero reports and renamed atomically to the SHA-256 of its content, e.g.
+`3a7bd3e2360a3d29eea436fcfb7e44c735d117c42d1c1835420b6b9942dd4f1b.pdf`; that name is what `Content.filename` holds.
+Readers therefore only ever see complete files, and the same PDF attached to several entries is stored once.
+
+An interrupted download leaves its partial file behind, and the next attempt resumes it with a Range request.
+
+`AttachmentStore.prefetch` downloads many attachments with a bounded pool of workers; `prefetch_collection_attachments`
+uses it to fetch every missing PDF of a collection, listing the collection's attachments with one paged request
+instead of one request per entry.
+
+`send_attachment` serves the stored files. It answers Range requests with 206 Partial Content, so PDF viewers can
+load the pages they show instead of the whole file, and sets a strong ETag from the content hash. A content-addressed
+file never changes under its name, so it is marked cacheable for a year and immutable; files stored under other names
+(from before content addressing) are revalidated with their ETag on every use. A whole-file request from a client
+that accepts gzip gets the `.gz` variant next to the file, if one was stored.
+
+Configuration:
+- ATTACHMENT_WORKERS: the number of files downloaded at once by a prefetch (default 4)
+- ATTACHMENT_PRECOMPRESS: also store a gzip variant of every downloaded file that compresses well (default off)
+"""
+
+logger = logging.getLogger(__name__)
+
+CONTENT_FILE_PATH = os.getenv("CONTENT_FILE_PATH")
+ATTACHMENT_WORKERS = int(os.getenv("ATTACHMENT_WORKERS", 4))
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+PARTIAL_DIR = '.partial'
+PDF_CONTENT_TYPE = 'application/pdf'
+ATTACHMENT_PRECOMPRESS = os.getenv("ATTACHMENT_PRECOMPRESS", "").lower() in ("1", "true", "yes")
+# a gzip variant is only kept if it is at least this much smaller; most PDFs are compressed internally already
+PRECOMPRESS_MIN_SAVING = 0.1
+# encodings of stored variants, in order of preference, with their file suffixes
+PRECOMPRESSED_ENCODINGS = (('gzip', '.gz'),)
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+CONTENT_ADDRESSED_NAME = re.compile(r'[0-9a-f]{64}(\.[A-Za-z0-9]+)?')
+
+# one download per attachment at a time, across stores and threads, so two writers never share a partial file
+_key_locks: Dict[str, threading.Lock] = {}
+_key_locks_lock = threading.Lock()
+
+
+class AttachmentError(Exception):
+    pass
+
+
+@contextmanager
+def _attachment_lock(attachment_key: str) -> Iterator[None]:
+    with _key_locks_lock:
+        lock = _key_locks.setdefault(attachment_key, threading.Lock())
+    with lock:
+        yield
+
+
+def is_downloadable_pdf(attachment: dict) -> bool:
+    """
+    Check whether an item is a PDF attachment whose file is stored by Zotero. Linked files only exist on the computer
+    that added them.
+
+    :param attachment: A Zotero item
+    """
+    data = attachment['data']
+    return (data.get('itemType') == 'attachment' and data.get('contentType') == PDF_CONTENT_TYPE
+            and data.get('linkMode') != 'linked_file')
+
+
+def blob_name(digest: str, attachment: dict) -> str:
+    """
+    Get the stored name of a file: its content hash with the extension of the original file.
+
+    :param digest: The SHA-256 hex digest of the file
+    :param attachment: The attachment item the file belongs to
+    :return: The file name
+    """
+    data = attachment['data']
+    extension = os.path.splitext(data.get('filename') or '')[1].lower()
+    if not extension:
+        extension = mimetypes.guess_extension(data.get('contentType') or '') or ''
+    return digest + extension
+
+
+class AttachmentStore:
+    """
+    Download Zotero attachment files into a content-addressed directory.
+    """
+
+    def __init__(self, client: ZoteroClient, storage_dir: str = CONTENT_FILE_PATH, workers: int = ATTACHMENT_WORKERS,
+                 chunk_size: int = DOWNLOAD_CHUNK_SIZE, precompress: bool = ATTACHMENT_PRECOMPRESS):
+        """
+        :param client: The Zotero client of the library
+        :param storage_dir: The directory the files are stored in
+        :param workers: The number of files downloaded at once by `prefetch`
+        :param chunk_size: The number of bytes read and written at a time
+        :param precompress: Whether to store a gzip variant of the downloaded files; see `store_precompressed`
+        """
+        self.client = client
+        self.storage_dir = storage_dir
+        self.workers = max(1, workers)
+        self.chunk_size = chunk_size
+        self.precompress = precompress
+
+    def partial_path(self, attachment_key: str) -> str:
+        return os.path.join(self.storage_dir, PARTIAL_DIR, f"{attachment_key}.part")
+
+    def download(self, attachment: dict) -> str:
+        """
+        Download the file of an attachment, resuming an interrupted download of it.
+
+        :param attachment: The attachment item
+        :return: The name of the stored file in the storage directory
+        :raises AttachmentError: If the downloaded file does not match the MD5 Zotero reports for it
+        """
+        key = attachment['key']
+        partial = self.partial_path(key)
+        os.makedirs(os.path.dirname(partial), exist_ok=True)
+        with _attachment_lock(key):
+            sha256, md5 = hashlib.sha256(), hashlib.md5()
+            offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+            with self.client.download(key, offset) as response:
+                if offset and response.status_code != 206:
+                    # the server sent the whole file
+                    offset = 0
+                with open(partial, 'r+b' if offset else 'wb') as f:
+                    if offset:
+                        # the hashes cover the whole file, so feed them what the interrupted download wrote
+                        for block in iter(lambda: f.read(self.chunk_size), b''):
+                            sha256.update(block)
+                            md5.update(block)
+                    else:
+                        logger.debug("Downloading %s", key)
+                    for block in response.iter_content(self.chunk_size):
+                        f.write(block)
+                        sha256.update(block)
+                        md5.update(block)
+                    f.flush()
+                    os.fsync(f.fileno())
+
+            expected = attachment['data'].get('md5')
+            if expected and md5.hexdigest() != expected:
+                os.remove(partial)
+                raise AttachmentError(f"Download of {key} does not match its MD5 {expected}")
+
+            name = blob_name(sha256.hexdigest(), attachment)
+            path = os.path.join(self.storage_dir, name)
+            if os.path.exists(path):
+                # already stored for another attachment
+                os.remove(partial)
+            else:
+                os.replace(partial, path)
+                if self.precompress:
+                    store_precompressed(path)
+            return name
+
+    def download_item(self, item_key: str) -> Optional[Tuple[dict, str]]:
+        """
+        Download the PDF attachment of a library entry, if it has one.
+
+        :param item_key: The key of the entry
+        :return: The attachment item and the name of the stored file, or None if the entry has no PDF attachment
+        """
+        for attachment in self.client.children(item_key):
+            if is_downloadable_pdf(attachment):
+                return attachment, self.download(attachment)
+        return None
+
+    def prefetch(self, attachments: Iterable[dict]) -> Iterator[Tuple[dict, Optional[str]]]:
+        """
+        Download the files of many attachments with a bounded pool of workers.
+
+        :param attachments: The attachment items
+        :return: An iterator over each attachment and the name of its stored file, in completion order; the name is
+                 None if the download failed
+        """
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = {pool.submit(self.download, attachment): attachment for attachment in attachments}
+            for future in as_completed(futures):
+                attachment = futures[future]
+                try:
+                    name = future.result()
+                except Exception:
+                    logger.exception("Downloading attachment %s failed", attachment['key'])
+                    name = None
+                yield attachment, name
+
+
+def pdf_attachments_by_parent(attachments: Iterable[dict]) -> Dict[str, dict]:
+    """
+    Pick the first PDF attachment of every entry.
+
+    :param attachments: Attachment items
+    :return: The attachments by the key of their parent entry
+    """
+    by_parent = {}
+    for attachment in attachments:
+        parent = attachment['data'].get('parentItem')
+        if parent and is_downloadable_pdf(attachment):
+            by_parent.setdefault(parent, attachment)
+    return by_parent
+
+
+def prefetch_collection_attachments(api_key: str, user_id: str, collection_name: str,
+                                    storage_dir: str = CONTENT_FILE_PATH,
+                                    workers: int = ATTACHMENT_WORKERS) -> Dict[str, int]:
+    """
+    Download the PDF of every entry in a collection that has none stored yet, and point the entry's filename at it.
+
+    :param api_key: Zotero API key
+    :param user_id: Zotero user ID
+    :param collection_name: Name of the Zotero collection
+    :param storage_dir: The directory the files are stored in
+    :param workers: The number of files downloaded at once
+    :return: The number of entries whose file was downloaded, that failed, and that have no PDF attachment
+    """
+    missing = get_entries_without_file()
+    counts = {'downloaded': 0, 'failed': 0, 'no_attachment': 0}
+    if not missing:
+        return counts
+    client = get_client(user_id, api_key)
+    collection_key = client.collection_key(collection_name)
+    attachments, _ = client.collection_items(collection_key, item_type='attachment')
+    wanted = {parent: attachment for parent, attachment in pdf_attachments_by_parent(attachments).items()
+              if parent in missing}
+    counts['no_attachment'] = len(missing) - len(wanted)
+
+    parents = {attachment['key']: parent for parent, attachment in wanted.items()}
+    store = AttachmentStore(client, storage_dir, workers)
+    for attachment, name in store.prefetch(wanted.values()):
+        if name is None:
+            counts['failed'] += 1
+            continue
+        update_content([{'id': missing[parents[attachment['key']]], 'filename': name}])
+        counts['downloaded'] += 1
+    logger.info("Prefetched attachments of %s: %s", collection_name, counts)
+    return counts
+
+
+def store_precompressed(path: str, min_saving: float = PRECOMPRESS_MIN_SAVING) -> Optional[str]:
+    """
+    Store a gzip variant of a file next to it, if it is sufficiently smaller.
+
+    :param path: The path of the file
+    :param min_saving: The fraction of the size the variant must save
+    :return: The path of the variant, or None if it was not worth keeping
+    """
+    variant = path + '.gz'
+    partial = variant + '.part'
+    with open(path, 'rb') as source, gzip.open(partial, 'wb') as target:
+        shutil.copyfileobj(source, target, DOWNLOAD_CHUNK_SIZE)
+    if os.path.getsize(partial) > (1 - min_saving) * os.path.getsize(path):
+        os.remove(partial)
+        return None
+    os.replace(partial, variant)
+    return variant
+
+
+def is_content_addressed(filename: str) -> bool:
+    return CONTENT_ADDRESSED_NAME.fullmatch(filename) is not None
+
+
+@lru_cache(maxsize=1024)
+def _file_digest(path: str, mtime_ns: int, size: int) -> str:
+    # keyed on the modification time and size, so a replaced file is hashed again
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def file_etag(path: str, filename: str) -> str:
+    """
+    Get the strong ETag of a stored file: the SHA-256 of its content, which content-addressed names already are.
+
+    :param path: The path of the file
+    :param filename: Its name in the storage directory
+    """
+    if is_content_addressed(filename):
+        return filename.split('.', 1)[0]
+    stat = os.stat(path)
+    return _file_digest(path, stat.st_mtime_ns, stat.st_size)
+
+
+def send_attachment(directory: str, filename: str) -> Response:
+    """
+    Serve a stored attachment file for the current request, with Range, ETag and cache headers.
+
+    :param directory: The storage directory
+    :param filename: The name of the file in it
+    :return: The response; 200, 206 for a Range request, 304 if the client's copy is current, or 416
+    """
+    path = safe_join(directory, filename)
+    if path is None or not os.path.isfile(path):
+        abort(404)
+    etag = file_etag(path, filename)
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    immutable = is_content_addressed(filename)
+
+    served, encoding, has_variants = path, None, False
+    for name, suffix in PRECOMPRESSED_ENCODINGS:
+        if os.path.isfile(path + suffix):
+            has_variants = True
+            # ranges address the decoded file, so a Range request always gets the file itself
+            if encoding is None and 'Range' not in request.headers and name in request.accept_encodings:
+                served, encoding = path + suffix, name
+
+    response = send_file(served, mimetype=mimetype, conditional=True,
+                         etag=f"{etag}-{encoding}" if encoding else etag,
+                         max_age=IMMUTABLE_MAX_AGE if immutable else None)
+    if immutable:
+        response.cache_control.immutable = True
+    if encoding:
+        response.content_encoding = encoding
+    if has_variants:
+        response.vary.add('Accept-Encoding')
+    return response
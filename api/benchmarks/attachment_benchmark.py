@@ -0,0 +1,148 @@
+import argparse
+import hashlib
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional, Tuple
+
+from flask import Flask, send_from_directory
+
+if __name__ == "__main__":
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from api.attachments import send_attachment, store_precompressed
+
+"""
+attachment_benchmark.py
+
+Benchmark the serving of attachment files to PDF viewers. A synthetic PDF (half incompressible image data, half page
+text) is served twice: by plain `send_from_directory`, as `/attachment` did before, and by `send_attachment` under its
+content-addressed name with a gzip variant. A client with an HTTP cache opens the file several times, in two ways:
+
+- whole: the viewer downloads the complete file on every open
+- ranged: the viewer reads the head and the tail of the file, then a few pages, with Range requests
+
+For each server and viewer the script reports the requests sent and the bytes received for the first open and for
+the repeated opens, and the latency: the time spent in the app plus a simulated network round trip per request.
+
+Usage:
+    python -m api.benchmarks.attachment_benchmark [--size-mb 20] [--opens 5] [--rtt-ms 20] [--output results.json]
+"""
+
+RANGE_SIZE = 256 * 1024
+PAGES_VIEWED = 8
+
+
+def make_pdf(size: int) -> bytes:
+    rng = random.Random(0)
+    half = size // 2
+    text = b"BT /F1 11 Tf 72 720 Td (" + b" ".join(rng.choice([b"the", b"model", b"learning", b"graph", b"robot"])
+                                               for _ in range(60)) + b") Tj ET\n"
+    return b"%PDF-1.5\n" + rng.randbytes(half) + (text * (half // len(text) + 1))[:half]
+
+
+class CachingClient:
+    """
+    A client with an HTTP cache: fresh responses are reused without a request, stale ones are revalidated with their
+    ETag.
+    """
+
+    def __init__(self, client, accept_encoding: str = "gzip"):
+        self.client = client
+        self.accept_encoding = accept_encoding
+        # (url, range) -> (etag, body, fresh until)
+        self.cache: Dict[Tuple[str, Optional[str]], Tuple[Optional[str], bytes, float]] = {}
+        self.requests = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def get(self, url: str, byte_range: Optional[str] = None) -> bytes:
+        cached = self.cache.get((url, byte_range))
+        if cached and cached[2] > time.time():
+            return cached[1]
+        headers = {"Accept-Encoding": self.accept_encoding}
+        if byte_range:
+            headers["Range"] = byte_range
+        if cached and cached[0]:
+            headers["If-None-Match"] = cached[0]
+        start = time.perf_counter()
+        response = self.client.get(url, headers=headers)
+        body = response.get_data()
+        self.seconds += time.perf_counter() - start
+        self.requests += 1
+        self.bytes += len(body)
+        if response.status_code == 304:
+            return cached[1]
+        max_age = response.cache_control.max_age if not response.cache_control.no_cache else None
+        self.cache[(url, byte_range)] = (response.headers.get("ETag"), body, time.time() + (max_age or 0))
+        return body
+
+
+def open_document(client: CachingClient, url: str, size: int, viewer: str) -> None:
+    if viewer == "whole":
+        client.get(url)
+        return
+    client.get(url, f"bytes=0-{RANGE_SIZE - 1}")
+    client.get(url, f"bytes={size - RANGE_SIZE}-{size - 1}")
+    for page in range(PAGES_VIEWED):
+        start = (size // PAGES_VIEWED) * page
+        client.get(url, f"bytes={start}-{start + RANGE_SIZE - 1}")
+
+
+def measure(app: Flask, url: str, size: int, viewer: str, opens: int, rtt: float) -> Dict:
+    client = CachingClient(app.test_client())
+    results = {}
+    for label, count in (("first_open", 1), ("repeat_opens", opens - 1)):
+        requests, received, seconds = client.requests, client.bytes, client.seconds
+        for _ in range(count):
+            open_document(client, url, size, viewer)
+        sent = client.requests - requests
+        results[label] = {
+            "requests": sent,
+            "bytes": client.bytes - received,
+            "latency_ms": ((client.seconds - seconds) + sent * rtt) * 1000,
+        }
+    return results
+
+
+def run(size_mb: int, opens: int, rtt_ms: float) -> Dict:
+    data = make_pdf(size_mb * 1024 * 1024)
+    results = {"file_bytes": len(data), "opens": opens, "rtt_ms": rtt_ms, "servers": {}}
+    with tempfile.TemporaryDirectory() as directory:
+        legacy_name = "paper.pdf"
+        hashed_name = hashlib.sha256(data).hexdigest() + ".pdf"
+        for name in (legacy_name, hashed_name):
+            with open(os.path.join(directory, name), "wb") as f:
+                f.write(data)
+        store_precompressed(os.path.join(directory, hashed_name))
+
+        app = Flask(__name__)
+        app.add_url_rule("/before/<filename>", "before", lambda filename: send_from_directory(directory, filename))
+        app.add_url_rule("/after/<filename>", "after", lambda filename: send_attachment(directory, filename))
+
+        for server, url in (("send_from_directory", f"/before/{legacy_name}"), ("send_attachment", f"/after/{hashed_name}")):
+            results["servers"][server] = {viewer: measure(app, url, len(data), viewer, opens, rtt_ms / 1000)
+                                          for viewer in ("whole", "ranged")}
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size-mb", type=int, default=20)
+    parser.add_argument("--opens", type=int, default=5)
+    parser.add_argument("--rtt-ms", type=float, default=20)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results = run(args.size_mb, args.opens, args.rtt_ms)
+    print(f"{results['file_bytes'] / 1e6:.1f} MB file, {results['opens']} opens, {results['rtt_ms']:.0f} ms round trip")
+    for server, viewers in results["servers"].items():
+        for viewer, phases in viewers.items():
+            for phase, numbers in phases.items():
+                print(f"  {server:20} {viewer:7} {phase:13} {numbers['requests']:3} requests "
+                      f"{numbers['bytes'] / 1e6:8.2f} MB {numbers['latency_ms']:9.1f} ms")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
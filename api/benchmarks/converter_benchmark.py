@@ -0,0 +1,156 @@
+import argparse
+import copy
+import gc
+import json
+import os
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, Iterable, List, Optional
+
+if __name__ == "__main__":
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from api.benchmarks.sync_benchmark import LibraryGenerator
+from api.converters import ConversionReport, convert_zotero_items
+from api.tests.zotero_stub import ZoteroStub
+from api.zotero_sync import SKIPPED_ITEM_TYPES
+
+"""
+converter_benchmark.py
+
+Benchmark the conversion of Zotero items to content dicts: `zotero2Dict` as it was before `convert_zotero_items`
+(called once per item, changing the item in place), the same with a deep copy of every item to leave the input
+intact, and `convert_zotero_items`. The items come from the synthetic library of the sync benchmark and are parsed
+from JSON for every run, so that each string is a separate object as in an API response.
+
+For each converter the script reports the conversion time and the items converted per second, and the memory the
+records retain once the pages they were converted from are freed, as they are during a sync.
+
+Usage:
+    python -m api.benchmarks.converter_benchmark [--items 100000] [--page-size 100] [--repeat 3] [--output results.json]
+"""
+
+
+def legacy_zotero2Dict(item: dict) -> dict:
+    # zotero2Dict before convert_zotero_items, without the commented-out code
+    if 'title' not in item['data'] or item['data']['title'] == '' or item['data']['title'] is None:
+        print(f'Empty title: {item}')
+    if item['data']['itemType'] == 'attachment':
+        content_type = 'zotero_attachment'
+        summary = "attachment for " + item['data']['title']
+        authors = []
+    else:
+        content_type = 'zotero_entry'
+        summary = item['data']['abstractNote'] if 'abstractNote' in item['data'] else None
+        if 'creators' in item['data']:
+            for a in item['data']['creators']:
+                if 'name' in a:
+                    fullname = a['name']
+                    firstname, lastname = fullname.split(' ', 1)
+                    a['firstName'] = firstname
+                    a['lastName'] = lastname
+            authors = [{"first_name": a["firstName"], "last_name": a["lastName"]} for a in item['data']['creators']] if 'creators' in item['data'] else []
+        else:
+            authors = []
+        item['data']['filename'] = None
+    item['data']['links'] = item['links']
+    return {
+        "content_type": content_type,
+        "zotero_key": item['key'],
+        "zotero_version": item['version'],
+        "title": item['data']['title'] if 'title' in item['data'] else None,
+        "content_metadata": item['data'],
+        "filename": item['data']['filename'] if 'filename' in item['data'] else None,
+        "summary": summary,
+        "tags": ','.join([t['tag'] for t in item['data']['tags']]),
+        "deleted": False,
+        "authors": authors
+    }
+
+
+def per_item(items: Iterable[dict]) -> List[dict]:
+    return [legacy_zotero2Dict(item) for item in items]
+
+
+def per_item_copied(items: Iterable[dict]) -> List[dict]:
+    # what keeping the items intact cost with the old function
+    return [legacy_zotero2Dict(copy.deepcopy(item)) for item in items]
+
+
+def batch(items: Iterable[dict]) -> List[dict]:
+    return list(convert_zotero_items(items, ConversionReport()))
+
+
+CONVERTERS: Dict[str, Callable[[Iterable[dict]], List[dict]]] = {
+    "zotero2Dict (before)": per_item,
+    "zotero2Dict + deepcopy": per_item_copied,
+    "convert_zotero_items": batch,
+}
+
+
+def make_pages(count: int, page_size: int) -> List[str]:
+    """
+    Generate a library of `count` entries and return the items that are synced, as JSON pages.
+    """
+    stub = ZoteroStub()
+    LibraryGenerator(stub).populate(count)
+    items = [item for item in stub.items if item["data"]["itemType"] not in SKIPPED_ITEM_TYPES]
+    return [json.dumps(items[start:start + page_size]) for start in range(0, len(items), page_size)]
+
+
+def time_conversion(convert: Callable[[Iterable[dict]], List[dict]], pages: List[str]) -> Dict:
+    # page by page, as the sync converts them; parsing the JSON is not timed
+    seconds = 0.0
+    converted = 0
+    gc.collect()
+    for page in pages:
+        items = json.loads(page)
+        start = time.perf_counter()
+        records = convert(items)
+        seconds += time.perf_counter() - start
+        converted += len(records)
+    return {"seconds": seconds, "items": converted, "items_per_second": converted / seconds}
+
+
+def retained_memory(convert: Callable[[Iterable[dict]], List[dict]], pages: List[str]) -> Dict:
+    gc.collect()
+    tracemalloc.start()
+    records = []
+    for page in pages:
+        records.extend(convert(json.loads(page)))
+    gc.collect()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"retained_mb": retained / 1e6, "peak_mb": peak / 1e6}
+
+
+def run(count: int, page_size: int, repeat: int) -> Dict:
+    pages = make_pages(count, page_size)
+    results = {"entries": count, "page_size": page_size, "converters": {}}
+    for name, convert in CONVERTERS.items():
+        timings = [time_conversion(convert, pages) for _ in range(repeat)]
+        best = min(timings, key=lambda timing: timing["seconds"])
+        results["converters"][name] = {**best, **retained_memory(convert, pages)}
+    return results
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--items", type=int, default=100000, help="entries in the generated library")
+    parser.add_argument("--page-size", type=int, default=100, help="items per page, as read from the API")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per converter; the fastest is reported")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    results = run(args.items, args.page_size, args.repeat)
+    for name, r in results["converters"].items():
+        print(f"{name:22} {r['items']:7d} items {r['seconds']:7.3f}s {r['items_per_second']:10.0f} items/s "
+              f"{r['retained_mb']:8.1f} MB retained {r['peak_mb']:8.1f} MB peak")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,122 @@
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from typing import Dict, List, Tuple
+
+if __name__ == "__main__":
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from api import search
+from api.database import create_db_engine
+from api.migrations import upgrade
+from api.models import ChatMessage, Content
+
+"""
+search_benchmark.py
+
+Benchmark the full-text search index on a synthetic corpus. The corpus mixes Zotero entries (title, abstract, tags),
+Quill notes and chat transcripts, drawn from a fixed vocabulary with a Zipf-like word distribution so that common
+and rare terms both occur. The script reports the time to build the index and the latency of a set of queries.
+
+Usage:
+    python -m api.benchmarks.search_benchmark [--rows 100000] [--repeat 20] [--output results.json]
+"""
+
+VOCABULARY_SIZE = 5000
+QUERIES = ["learning", "neural network", "graph", "bayesian optimisation", "robot manipulation", "transfo", "zzzz"]
+SEED_WORDS = ["learning", "neural", "network", "graph", "bayesian", "optimisation", "robot", "manipulation",
+              "transformer", "attention", "reinforcement", "vision", "language", "policy", "kernel"]
+
+
+def make_vocabulary() -> List[str]:
+    rng = random.Random(0)
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    words = ["".join(rng.choice(letters) for _ in range(rng.randint(4, 10))) for _ in range(VOCABULARY_SIZE)]
+    # the most frequent ranks behave like stopwords; the query terms sit just below them
+    return words[:100] + SEED_WORDS + words[100:]
+
+
+def make_rows(count: int) -> Tuple[List[Dict], List[Dict]]:
+    rng = random.Random(1)
+    vocabulary = make_vocabulary()
+    weights = [1.0 / (rank + 1) for rank in range(len(vocabulary))]
+
+    def sentence(length: int) -> str:
+        return " ".join(rng.choices(vocabulary, weights, k=length))
+
+    rows, messages = [], []
+    for i in range(count):
+        kind = rng.random()
+        if kind < 0.8:
+            rows.append({"title": sentence(8).capitalize(), "content_type": "zotero_entry", "zotero_key": f"K{i:08d}",
+                         "summary": sentence(120), "tags": ",".join(rng.sample(vocabulary[:200], 3)),
+                         "content_metadata": {"key": f"K{i:08d}"}, "deleted": False})
+        elif kind < 0.9:
+            rows.append({"title": sentence(4).capitalize(), "content_type": "note", "zotero_key": None, "summary": None,
+                         "tags": None, "content_metadata": {"ops": [{"insert": sentence(300) + "\n"}]}, "deleted": False})
+        else:
+            messages += [{"chat_id": i + 1, "seq": n + 1, "role": "user" if n % 2 == 0 else "assistant",
+                          "content": sentence(40)} for n in range(10)]
+            rows.append({"title": "Chat Session", "content_type": "chat", "zotero_key": None, "summary": None,
+                         "tags": None, "content_metadata": {"chat": {"highlights": []}}, "deleted": False})
+        rows[-1]["id"] = i + 1
+    return rows, messages
+
+
+def run(rows: int, repeat: int) -> Dict:
+    results = {"rows": rows, "queries": {}}
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_db_engine(f"sqlite:///{os.path.join(directory, 'locus.db')}")
+        upgrade(engine)
+
+        corpus, messages = make_rows(rows)
+        start = time.perf_counter()
+        with engine.begin() as conn:
+            for i in range(0, len(corpus), 5000):
+                conn.execute(Content.__table__.insert(), corpus[i:i + 5000])
+            # chat messages are indexed by triggers as they are inserted
+            for i in range(0, len(messages), 5000):
+                conn.execute(ChatMessage.__table__.insert(), messages[i:i + 5000])
+        results["insert_seconds"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        with engine.begin() as conn:
+            search.reindex(conn)
+        results["index_seconds"] = time.perf_counter() - start
+        results["database_bytes"] = os.path.getsize(os.path.join(directory, 'locus.db'))
+
+        with engine.connect() as conn:
+            for query in QUERIES:
+                timings = []
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    page, _ = search.search(conn, query, limit=20)
+                    timings.append((time.perf_counter() - start) * 1000)
+                timings.sort()
+                results["queries"][query] = {
+                    "hits_on_page": len(page),
+                    "p50_ms": statistics.median(timings),
+                    "p95_ms": timings[int(0.95 * (len(timings) - 1))],
+                }
+        engine.dispose()
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    results = run(args.rows, args.repeat)
+    print(f"{results['rows']} rows: inserted in {results['insert_seconds']:.1f}s, indexed in {results['index_seconds']:.1f}s")
+    for query, timing in results["queries"].items():
+        print(f"  {query!r:28} p50 {timing['p50_ms']:7.2f} ms   p95 {timing['p95_ms']:7.2f} ms   ({timing['hits_on_page']} hits)")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
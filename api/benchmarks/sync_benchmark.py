@@ -0,0 +1,254 @@
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional
+
+if __name__ == "__main__":
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from api.tests.zotero_stub import API_KEY, USER_ID, ZoteroStub
+
+"""
+sync_benchmark.py
+
+Benchmark `sync_zotero_down` on synthetic libraries. For each size a Zotero-shaped library is generated: journal
+articles, books and conference papers with one to eight creators (some of them institutions), tags drawn with a
+Zipf-like distribution, abstracts, PDF attachments and child notes. It is served by the local Zotero stub, with a
+configurable latency per request and page size. Two syncs are measured against a fresh database file:
+
+- cold: the first sync of the whole collection
+- incremental: the next sync, after 1% of the entries were edited, 0.5% added and 0.2% deleted
+
+Every sync runs in a process of its own, so its peak RSS is not inflated by the library generation or an earlier
+run. For each sync the script reports the wall time, the number of SQL statements, the peak RSS, the items read per
+second and the requests sent to the API. The results can be written as JSON and compared against a stored baseline;
+the script exits with status 1 if a metric regressed by more than the tolerance.
+
+Usage:
+    python -m api.benchmarks.sync_benchmark [--sizes 1000 10000 100000] [--latency-ms 0] [--page-size 100]
+                                            [--output results.json] [--baseline baseline.json] [--tolerance 0.2]
+"""
+
+COLLECTION = "locus"
+# share of the entries edited, added and deleted before the incremental sync
+EDITED, ADDED, DELETED = 0.01, 0.005, 0.002
+# metrics compared against a baseline, and whether higher values are better
+COMPARED_METRICS = {"wall_seconds": False, "queries": False, "peak_rss_mb": False, "items_per_second": True}
+ITEM_TYPES = (("journalArticle", 0.6), ("conferencePaper", 0.25), ("book", 0.1), ("report", 0.05))
+INSTITUTIONS = ["Google Research", "Max Planck Institute", "World Health Organization", "OpenAI Team",
+                "European Space Agency"]
+
+
+class LibraryGenerator:
+    """
+    Fill a Zotero stub with a reproducible synthetic library.
+    """
+
+    def __init__(self, stub: ZoteroStub, seed: int = 0):
+        self.stub = stub
+        self.rng = random.Random(seed)
+        letters = "abcdefghijklmnopqrstuvwxyz"
+        self.words = ["".join(self.rng.choice(letters) for _ in range(self.rng.randint(3, 11))) for _ in range(4000)]
+        self.weights = [1.0 / (rank + 1) for rank in range(len(self.words))]
+        self.tags = [" ".join(self.rng.sample(self.words[:500], self.rng.randint(1, 2))) for _ in range(300)]
+        self.first_names = [w.capitalize() for w in self.words[1000:1300]]
+        self.last_names = [w.capitalize() for w in self.words[1300:2300]]
+        self.collection = stub.add_collection(COLLECTION)
+        self.entries: List[str] = []
+
+    def text(self, length: int) -> str:
+        return " ".join(self.rng.choices(self.words, self.weights, k=length))
+
+    def creators(self) -> List[Dict[str, str]]:
+        creators = []
+        for _ in range(self.rng.choice([1, 1, 2, 2, 3, 3, 4, 5, 6, 8])):
+            if self.rng.random() < 0.03:
+                creators.append({"creatorType": "author", "name": self.rng.choice(INSTITUTIONS)})
+            else:
+                creators.append({"creatorType": self.rng.choice(["author"] * 9 + ["editor"]),
+                                 "firstName": self.rng.choice(self.first_names),
+                                 "lastName": self.rng.choice(self.last_names)})
+        return creators
+
+    def add_entry(self) -> dict:
+        item_type = self.rng.choices([t for t, _ in ITEM_TYPES], [w for _, w in ITEM_TYPES])[0]
+        tags = [{"tag": tag} for tag in dict.fromkeys(self.rng.choices(self.tags, k=self.rng.randint(0, 6)))]
+        entry = self.stub.add_item(self.collection, self.text(self.rng.randint(5, 14)).capitalize(), item_type,
+                                   creators=self.creators(), tags=tags,
+                                   abstractNote=self.text(self.rng.randint(50, 250)) if self.rng.random() < 0.85 else "",
+                                   date=str(self.rng.randint(1990, 2024)), DOI=f"10.{self.rng.randint(1000, 9999)}/{len(self.entries)}",
+                                   url="", extra="")
+        self.entries.append(entry["key"])
+        if self.rng.random() < 0.7:
+            self.stub.add_item(self.collection, "Full Text PDF", "attachment", parentItem=entry["key"],
+                               contentType="application/pdf", linkMode="imported_file", filename="paper.pdf",
+                               md5="0" * 32)
+        if self.rng.random() < 0.1:
+            self.stub.add_item(self.collection, "", "note", parentItem=entry["key"], note=f"<p>{self.text(40)}</p>")
+        return entry
+
+    def populate(self, count: int) -> None:
+        for _ in range(count):
+            self.add_entry()
+
+    def change(self) -> Dict[str, int]:
+        """
+        Edit, add and delete a share of the entries, as between two syncs.
+        """
+        count = len(self.entries)
+        edited = self.rng.sample(self.entries, max(1, int(count * EDITED)))
+        for key in edited:
+            self.stub.update_item(key, title=self.text(8).capitalize(), abstractNote=self.text(120))
+        added = max(1, int(count * ADDED))
+        for _ in range(added):
+            self.add_entry()
+        deleted = self.rng.sample([key for key in self.entries if key not in edited], max(1, int(count * DELETED)))
+        for key in deleted:
+            self.stub.delete_item(key)
+            self.entries.remove(key)
+        return {"edited": len(edited), "added": added, "deleted": len(deleted)}
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def run_worker(page_size: int) -> Dict:
+    """
+    Run one sync in this process and return its measurements. The environment points the database at the benchmark's
+    file and the client at the stub, so the api modules are imported only here.
+    """
+    from sqlalchemy import event
+    from api import database, zotero_http
+    from api.migrations import upgrade
+    from api.zotero_sync import sync_zotero_down
+
+    upgrade(database.engine)
+    zotero_http.PAGE_SIZE = page_size
+    queries = []
+    event.listen(database.engine, "before_cursor_execute", lambda *args: queries.append(1))
+    progress = {"items": 0, "upserted": 0, "pages": 0}
+    rss_before = peak_rss_mb()
+
+    start = time.perf_counter()
+    version = sync_zotero_down(API_KEY, USER_ID, COLLECTION, progress=progress.update)
+    wall = time.perf_counter() - start
+    return {
+        "version": version,
+        "wall_seconds": wall,
+        "queries": len(queries),
+        "items": progress["items"],
+        "upserted": progress["upserted"],
+        "pages": progress["pages"],
+        "items_per_second": progress["items"] / wall if wall else 0.0,
+        "peak_rss_mb": peak_rss_mb(),
+        "rss_before_sync_mb": rss_before,
+    }
+
+
+def measure_sync(stub: ZoteroStub, database_url: str, page_size: int, rate_limit: float) -> Dict:
+    env = {**os.environ, "LOCUS_DATABASE_URL": database_url, "ZOTERO_API_URL": stub.url,
+           "ZOTERO_RATE_LIMIT": str(rate_limit)}
+    env.pop("TESTING", None)
+    requests_before = len(stub.requests)
+    completed = subprocess.run([sys.executable, "-m", "api.benchmarks.sync_benchmark", "--worker",
+                                "--page-size", str(page_size)], env=env, capture_output=True, text=True,
+                               cwd=os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+    if completed.returncode != 0:
+        raise RuntimeError(f"Sync worker failed:\n{completed.stderr}")
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+    result["requests"] = len(stub.requests) - requests_before
+    return result
+
+
+def run(sizes: List[int], latency_ms: float, page_size: int, rate_limit: float) -> Dict:
+    results = {"config": {"latency_ms": latency_ms, "page_size": page_size, "rate_limit": rate_limit,
+                          "python": sys.version.split()[0]}, "sizes": {}}
+    for size in sizes:
+        stub = ZoteroStub().start()
+        try:
+            generator = LibraryGenerator(stub)
+            generator.populate(size)
+            # latency applies to the syncs, not to the generation
+            stub.latency = latency_ms / 1000
+            with tempfile.TemporaryDirectory() as directory:
+                database_url = f"sqlite:///{os.path.join(directory, 'locus.db')}"
+                cold = measure_sync(stub, database_url, page_size, rate_limit)
+                changes = generator.change()
+                incremental = measure_sync(stub, database_url, page_size, rate_limit)
+                incremental["changes"] = changes
+                results["sizes"][str(size)] = {"library_items": len(stub.items), "cold": cold,
+                                               "incremental": incremental}
+        finally:
+            stub.stop()
+    return results
+
+
+def compare(results: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """
+    Find the metrics that are worse than the baseline by more than `tolerance` (a fraction of the baseline value).
+
+    :return: A description of every regression
+    """
+    regressions = []
+    for size, runs in results["sizes"].items():
+        for phase, metrics in runs.items():
+            expected = baseline.get("sizes", {}).get(size, {}).get(phase)
+            if not isinstance(metrics, dict) or not expected:
+                continue
+            for metric, higher_is_better in COMPARED_METRICS.items():
+                old, new = expected.get(metric), metrics.get(metric)
+                if not old or new is None:
+                    continue
+                change = (new - old) / old
+                if (-change if higher_is_better else change) > tolerance:
+                    regressions.append(f"{size} {phase} {metric}: {old:.2f} -> {new:.2f} ({change:+.0%})")
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--latency-ms", type=float, default=0, help="latency the stub adds to every request")
+    parser.add_argument("--page-size", type=int, default=100, help="items per page the client requests")
+    parser.add_argument("--rate-limit", type=float, default=0,
+                        help="requests per second of the client's governor (0: unlimited)")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="compare against the results in this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed regression, as a fraction")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker:
+        print(json.dumps(run_worker(args.page_size)))
+        return 0
+
+    results = run(args.sizes, args.latency_ms, args.page_size, args.rate_limit)
+    for size, runs in results["sizes"].items():
+        for phase in ("cold", "incremental"):
+            r = runs[phase]
+            print(f"{int(size):7d} items {phase:11} {r['wall_seconds']:8.2f}s {r['queries']:7d} queries "
+                  f"{r['peak_rss_mb']:7.1f} MB peak RSS {r['items_per_second']:9.0f} items/s {r['requests']:5d} requests")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+        print(f"No regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,151 @@
+from collections import OrderedDict
+from functools import wraps
+from typing import Callable, Dict, NamedTuple, Optional
+from flask import Response, make_response, request
+import hashlib
+import threading
+
+"""
+cache.py
+
+This module contains the response cache for the read endpoints (`/content`, `/highlights`, `/chats`). Those endpoints
+serialize whole tables, while the data only changes on a sync, a save or a chat message. Each cached body is stored
+together with the library version (see `database.get_library_version`) it was computed at, so a write anywhere in the
+library invalidates every entry at once without the cache having to know what changed.
+
+Entries are kept in LRU order and bounded both by count and by total body size. Every response carries a strong ETag
+derived from its body, and requests with a matching `If-None-Match` get an empty 304.
+"""
+
+
+class CachedResponse(NamedTuple):
+    version: int
+    body: bytes
+    mimetype: str
+    etag: str
+
+
+class ResponseCache:
+    """
+    A thread-safe LRU cache of response bodies, each tagged with the library version it was computed at.
+    """
+
+    def __init__(self, max_entries: int = 256, max_bytes: int = 64 * 1024 * 1024):
+        """
+        :param max_entries: The maximum number of cached responses
+        :param max_bytes: The maximum total size of the cached bodies
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, CachedResponse]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.not_modified = 0
+
+    def get(self, key: str, version: int) -> Optional[CachedResponse]:
+        """
+        Look up a response computed at the given library version.
+
+        :param key: The cache key, e.g. the request path with its query string
+        :param version: The current library version
+        :return: The cached response, or None if there is none for this version
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.version != version:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: str, version: int, body: bytes, mimetype: str) -> CachedResponse:
+        """
+        Store a response, evicting the least recently used ones to stay within the bounds.
+
+        :param key: The cache key
+        :param version: The library version the body was computed at
+        :param body: The response body
+        :param mimetype: The response mimetype
+        :return: The cached response
+        """
+        entry = CachedResponse(version, body, mimetype, hashlib.sha256(body).hexdigest()[:32])
+        with self._lock:
+            self._discard(key)
+            if len(body) > self.max_bytes:
+                # too large to keep; still hand back the entry so the caller can tag the response
+                return entry
+            self._entries[key] = entry
+            self._bytes += len(body)
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                self._discard(next(iter(self._entries)))
+                self.evictions += 1
+        return entry
+
+    def record_not_modified(self) -> None:
+        with self._lock:
+            self.not_modified += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Get the counters for monitoring.
+
+        :return: The hits, misses, evictions and 304 responses so far, and the current number and size of entries
+        """
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'not_modified': self.not_modified,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+            }
+
+    def _discard(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= len(entry.body)
+
+
+def cached_response(cache: ResponseCache, get_version: Callable[[], int]) -> Callable:
+    """
+    Decorate a Flask GET view so its successful responses are cached per URL and library version, and answered with
+    a 304 when the client already has them.
+
+    :param cache: The cache to store the responses in
+    :param get_version: Returns the current library version
+    :return: The decorator
+    """
+    def decorator(view: Callable) -> Callable:
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            # read the version before computing the body: a write that lands in between then only makes the entry
+            # look older than its data, and the next request recomputes it
+            version = get_version()
+            key = request.full_path
+            entry = cache.get(key, version)
+            if entry is None:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                entry = cache.put(key, version, response.get_data(), response.mimetype)
+
+            response = Response(entry.body, mimetype=entry.mimetype)
+            response.set_etag(entry.etag)
+            # let clients keep the body but revalidate it on every use
+            response.cache_control.no_cache = True
+            response = response.make_conditional(request)
+            if response.status_code == 304:
+                cache.record_not_modified()
+            return response
+        return wrapper
+    return decorator
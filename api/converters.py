@@ -1,5 +1,9 @@
 from api.models import Content, Author
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+import html
+import json
 import os
+import sys
 
 
 def quill2Content(item: dict, storage_path: str = None, storage_fmt: str = "html") -> Content:
@@ -32,29 +36,16 @@ def quill2Content(item: dict, storage_path: str = None, storage_fmt: str = "html
     content.authors = [{"first_name": a["first_name"], "last_name": a["last_name"]} for a in item['authors']]
     return content
 
-def quill2Dict(item: dict, storage_path: str = None, storage_fmt: str = "html") -> dict:
+def quill2Dict(item: dict) -> dict:
     """
-    Convert a delta text document to a dictionary.
+    Convert a delta text document to a dictionary. The note's file is stored separately, see `api.note_store`.
     """
-    if storage_path is not None:
-        filename = item["title"].replace(" ", "_") + f".{storage_fmt}"
-        with open(os.path.join(storage_path, filename), "w") as f:
-            if storage_fmt == "html":
-                f.write(item["content"])
-            elif storage_fmt == "delta":
-                f.write(item["delta"])
-            else:
-                raise ValueError("storage_fmt must be 'html' or 'delta'")
-    else:
-        filename = None
     return {
         "id": item['id'] if 'id' in item else None,
         "content_type": item['type'],
-        "zotero_key": None,
-        "zotero_version": None,
+        # no zotero_key/zotero_version: a note keeps the ones its upload to Zotero stored
         "title": item['title'],
         "content_metadata": item['delta'],
-        "filename": filename,
         "summary": None,
         "tags": ','.join([t['tag'] for t in item['tags']]) if 'tags' in item else None,
         "deleted": False,
@@ -83,51 +74,171 @@ def zotero2Content(item: dict) -> Content:
     content.authors = [{"first_name": a["firstName"], "last_name": a["lastName"]} for a in item['data']['creators']]
     return content
 
+class ConversionProblem(NamedTuple):
+    key: Optional[str]
+    problem: str
+
+
+class ConversionReport:
+    """
+    The problems `convert_zotero_items` found in the items it converted, e.g. missing titles or unnamed creators.
+    """
+
+    def __init__(self):
+        self.converted = 0
+        self.skipped = 0
+        self.problems: List[ConversionProblem] = []
+
+    def add(self, key: Optional[str], problem: str) -> None:
+        self.problems.append(ConversionProblem(key, problem))
+
+    def counts(self) -> Dict[str, int]:
+        """
+        :return: The number of items with each kind of problem
+        """
+        counts = {}
+        for problem in self.problems:
+            counts[problem.problem] = counts.get(problem.problem, 0) + 1
+        return counts
+
+    def __bool__(self) -> bool:
+        return bool(self.problems)
+
+    def __repr__(self) -> str:
+        return f"ConversionReport(converted={self.converted}, skipped={self.skipped}, problems={self.counts()})"
+
+
+def _split_name(creator: dict) -> Tuple[str, str]:
+    """
+    Get the first and last name of a creator. A single-field name ('name'), e.g. an organization, is all last name,
+    as Zotero stores it.
+    """
+    if 'name' in creator:
+        return '', creator['name'] or ''
+    return creator.get('firstName') or '', creator.get('lastName') or ''
+
+
+def _author(creator: dict) -> dict:
+    first_name, last_name = _split_name(creator)
+    return {"first_name": sys.intern(first_name), "last_name": sys.intern(last_name)}
+
+
+_UNNAMED = {"first_name": '', "last_name": ''}
+
+
+def convert_zotero_items(items: Iterable[dict], report: Optional[ConversionReport] = None) -> Iterator[dict]:
+    """
+    Convert Zotero items to content dictionaries, as `zotero2Dict` does, without changing the items.
+
+    The content_metadata of a record is a shallow copy of the item's data, with the item's links added (and filename
+    set to None for entries); the nested values are shared with the item, not copied. Only attachments have a filename
+    column value: an entry's file is stored locally (see `attachments.py`), and a sync must not erase its name. Item
+    types and creator names repeat across a library, so those strings are interned. Problems are recorded in `report` instead of being printed;
+    an item without key or data is skipped.
+
+    :param items: Zotero items, as returned by the API
+    :param report: Collects the problems found, and the number of items converted and skipped
+    :return: An iterator over the content dictionaries, in the order of the items
+    """
+    intern = sys.intern
+    for item in items:
+        data = item.get('data')
+        key = item.get('key')
+        if not isinstance(data, dict) or key is None:
+            if report is not None:
+                report.skipped += 1
+                report.add(key, 'malformed item')
+            continue
+        title = data.get('title')
+        if not title and report is not None:
+            report.add(key, 'empty title')
+        metadata = {**data, 'links': item.get('links', {})}
+        item_type = data.get('itemType')
+        if item_type is not None:
+            metadata['itemType'] = intern(item_type)
+
+        if item_type == 'attachment':
+            content_type = 'zotero_attachment'
+            summary = "attachment for " + (title or '')
+            authors = []
+        else:
+            content_type = 'zotero_entry'
+            summary = data.get('abstractNote')
+            metadata['filename'] = None
+            creators = data.get('creators') or ()
+            try:
+                # the common case: every creator has a first and a last name
+                authors = [{"first_name": intern(creator['firstName']), "last_name": intern(creator['lastName'])}
+                           for creator in creators]
+            except (KeyError, TypeError):
+                authors = [_author(creator) for creator in creators]
+            if report is not None and _UNNAMED in authors:
+                report.add(key, 'unnamed creator')
+
+        if report is not None:
+            report.converted += 1
+        record = {
+            "content_type": content_type,
+            "zotero_key": key,
+            "zotero_version": item.get('version'),
+            "title": title,
+            "content_metadata": metadata,
+            "summary": summary,
+            "tags": ','.join([t['tag'] for t in data.get('tags') or ()]),
+            "deleted": False,
+            "authors": authors,
+        }
+        if content_type == 'zotero_attachment':
+            record["filename"] = data.get('filename')
+        yield record
+
 def zotero2Dict(item: dict) -> dict:
     """
-    Convert a Zotero item to a dictionary.
-    
+    Convert a Zotero item to a dictionary. The item is not changed; see `convert_zotero_items` to convert many.
+
     :param item: Zotero item
     :return: Dictionary
+    :raises ValueError: If the item has no key or data
     """
-    # print(f'{item["data"]["title"]}: {item["data"]["itemType"]}')
-    # print(item["data"])
-    if 'title' not in item['data'] or item['data']['title'] == '' or item['data']['title'] is None:
-        print(f'Empty title: {item}')
-    if item['data']['itemType'] == 'attachment':
-        content_type = 'zotero_attachment' 
-        summary = "attachment for " + item['data']['title']
-        authors = []
+    for content in convert_zotero_items([item]):
+        return content
+    raise ValueError(f"Not a Zotero item: {item!r:.200}")
 
-    else:
-        content_type = 'zotero_entry'
-        summary = item['data']['abstractNote'] if 'abstractNote' in item['data'] else None
-        if 'creators' in item['data']:
-            for a in item['data']['creators']:
-                if 'name' in a:
-                    fullname = a['name']
-                    firstname, lastname = fullname.split(' ', 1)
-                    a['firstName'] = firstname
-                    a['lastName'] = lastname
-            authors = [{"first_name": a["firstName"], "last_name": a["lastName"]} for a in item['data']['creators']] if 'creators' in item['data'] else []
-        else:
-            authors = []
-        item['data']['filename'] = None
+def delta2Html(delta) -> str:
+    """
+    Render the text of a Quill delta as HTML paragraphs, one per line. Formatting and embeds are dropped.
 
-    # add the links info to the metadata
-    # print("ddddd")
-    item['data']['links'] = item['links']
-    return {
-        "content_type": content_type,
-        "zotero_key": item['key'],
-        "zotero_version": item['version'],
-        "title": item['data']['title'] if 'title' in item['data'] else None,
-        "content_metadata": item['data'],
-        "filename": item['data']['filename'] if 'filename' in item['data'] else None,
-        "summary": summary,
-        # "time_created": item['data']['dateAdded'],
-        # "time_modified": item['data']['dateModified'],
-        "tags": ','.join([t['tag'] for t in item['data']['tags']]),
-        "deleted": False,
-        "authors": authors
-    }
+    :param delta: Quill delta, as a dictionary or a JSON string
+    :return: HTML
+    """
+    if isinstance(delta, str):
+        delta = json.loads(delta)
+    text = ''.join(op['insert'] for op in (delta or {}).get('ops', []) if isinstance(op.get('insert'), str))
+    return ''.join(f"<p>{html.escape(line)}</p>" for line in text.rstrip('\n').split('\n'))
+
+def content2Zotero(content: dict, collection_key: Optional[str] = None, note_html: Optional[str] = None) -> dict:
+    """
+    Convert a content dictionary to Zotero item data for an upload. A note becomes a Zotero note; an entry carries the
+    fields that can be edited locally. Content that is already in Zotero carries its key and version, so the write
+    updates that item and fails if it changed in Zotero since. New content carries the key it was assigned for the
+    upload, if any, and is added to the collection.
+
+    :param content: Content dictionary, as returned by `Content.to_dict`
+    :param collection_key: The key of the collection new items are added to
+    :param note_html: The HTML of a note; by default it is rendered from the note's delta
+    :return: Zotero item data
+    """
+    tags = [{'tag': tag.strip()} for tag in (content.get('tags') or '').split(',') if tag.strip()]
+    if content['content_type'] == 'note':
+        if note_html is None:
+            note_html = f"<h1>{html.escape(content['title'] or '')}</h1>" + delta2Html(content.get('content_metadata'))
+        data = {'itemType': 'note', 'note': note_html, 'tags': tags}
+    else:
+        data = {'title': content['title'], 'abstractNote': content.get('summary') or '', 'tags': tags}
+    if content.get('zotero_key'):
+        data['key'] = content['zotero_key']
+    if content.get('zotero_version') is not None:
+        data['version'] = content['zotero_version']
+    elif collection_key:
+        data['collections'] = [collection_key]
+    return data
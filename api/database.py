@@ -1,10 +1,19 @@
-from typing import List, Dict, Tuple, Union, Optional
-from api.models import ZoteroVersion, Content, Author, Group, GroupType, User
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
+from typing import Iterable, List, Dict, Tuple, Union, Optional
+from api import delta, events, search
+from api.models import LibraryState, SyncState, Content, Author, Group, GroupType, User, ChatMessage, NoteRevision, content_authors, GroupContent
+from sqlalchemy.orm import sessionmaker, load_only, selectinload
+from sqlalchemy.orm.attributes import get_history
+from sqlalchemy import create_engine, event, select, update, delete, Select, and_, or_, case, func, literal
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.pool import StaticPool
+from sqlalchemy.exc import IntegrityError
 from datetime import datetime
 from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session as OrmSession
 
+import base64
+import binascii
+import logging
 import os
 
 """
@@ -20,22 +29,104 @@ functions for handling the following operations:
 3. Soft deleting and restoring content items.
 4. Syncing content with Zotero.
 
-The module also contains a helper function to create an SQLAlchemy engine and session factory.
+The module also contains the factory for the shared SQLAlchemy engine (SQLite tuned for concurrent access) and the
+session factory.
 """
 
 
+# Connection-level settings for SQLite. WAL lets readers run alongside the single writer, and busy_timeout makes a
+# writer wait for the lock instead of failing with "database is locked". Override or extend them with
+# LOCUS_SQLITE_PRAGMAS, e.g. "synchronous=FULL;cache_size=-16000".
+DEFAULT_SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': '5000',         # milliseconds
+    'mmap_size': '268435456',       # 256 MiB
+    'cache_size': '-65536',         # negative values are KiB, i.e. 64 MiB
+}
+
+def sqlite_pragmas() -> Dict[str, str]:
+    """
+    Get the pragmas applied to every new SQLite connection: the defaults, updated from LOCUS_SQLITE_PRAGMAS.
+    """
+    pragmas = dict(DEFAULT_SQLITE_PRAGMAS)
+    for setting in os.environ.get("LOCUS_SQLITE_PRAGMAS", "").split(';'):
+        if '=' in setting:
+            name, value = setting.split('=', 1)
+            pragmas[name.strip()] = value.strip()
+    return pragmas
+
 # Initialize the database engine and create a session factory
-def create_db_engine():
-    if os.environ.get("TESTING"):
-        return create_engine("sqlite:///:memory:")
-    else:
-        return create_engine("sqlite:///locus.db")
+def create_db_engine(url: Optional[str] = None) -> Engine:
+    """
+    Create the SQLAlchemy engine for the locus database. The app, the sync code and the migrations all share the
+    engine created here.
+
+    Args:
+        url (Optional[str]): The database URL. Defaults to LOCUS_DATABASE_URL, or `locus.db` in the working
+                             directory (an in-memory database when TESTING is set).
+
+    Returns:
+        Engine: The engine, with the pragmas from `sqlite_pragmas` applied to every new connection. The pool size
+                of file databases comes from LOCUS_DB_POOL_SIZE and LOCUS_DB_MAX_OVERFLOW.
+    """
+    if url is None:
+        if os.environ.get("TESTING"):
+            url = "sqlite:///:memory:"
+        else:
+            url = os.environ.get("LOCUS_DATABASE_URL", "sqlite:///locus.db")
+
+    options = {}
+    database_url = make_url(url)
+    is_file_db = database_url.get_backend_name() == 'sqlite' and database_url.database not in (None, '', ':memory:')
+    if is_file_db:
+        options['pool_size'] = int(os.environ.get("LOCUS_DB_POOL_SIZE", 10))
+        options['max_overflow'] = int(os.environ.get("LOCUS_DB_MAX_OVERFLOW", 20))
+        # connections are handed between the request threads and socket handlers
+        options['connect_args'] = {'check_same_thread': False}
+    elif database_url.get_backend_name() == 'sqlite':
+        # an in-memory database lives in its connection, so every thread (e.g. background sync jobs) must share it
+        options['poolclass'] = StaticPool
+        options['connect_args'] = {'check_same_thread': False}
+    new_engine = create_engine(url, **options)
+
+    if database_url.get_backend_name() == 'sqlite':
+        pragmas = sqlite_pragmas()
+
+        @event.listens_for(new_engine, 'connect')
+        def apply_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for name, value in pragmas.items():
+                cursor.execute(f"PRAGMA {name} = {value}")
+            cursor.close()
+
+    return new_engine
 
 engine = create_db_engine()
 Session = sessionmaker(bind=engine)
 
+logger = logging.getLogger(__name__)
+
+# SQLite refuses statements with more than 999 bound parameters on older builds, so IN (...) lookups are chunked.
+SQLITE_MAX_PARAMS = 500
+CONTENT_COLUMNS = frozenset(column.key for column in Content.__table__.columns)
+AUTHOR_CACHE_KEY = 'author_cache'
+CHAT_APPEND_ATTEMPTS = 3
+CHAT_PREVIEW_LENGTH = 100
+LIBRARY_VERSION_KEY = 'library_version'
+# content uploaded to Zotero, and the columns whose local changes queue it for upload
+ZOTERO_UPLOAD_TYPES = ('note', 'zotero_entry')
+ZOTERO_UPLOAD_FIELDS = ('title', 'summary', 'tags', 'content_metadata')
+# a note's incremental edits are folded into its snapshot once this many have accumulated
+NOTE_SNAPSHOT_INTERVAL = int(os.environ.get("NOTE_SNAPSHOT_INTERVAL", 50))
+
+
+# Zotero version functions. We store the version number to check what has changed since we last synced. It lives in
+# the single sync_state row, so reading it is a primary key lookup and storing it overwrites the previous one.
+def _set_latest_version(session: Session, version: int) -> None:
+    session.execute(update(SyncState).where(SyncState.id == 1).values(
+        library_version=version, synced_at=datetime.utcnow()))
 
-# Zotero version functions. We store the version number to check what has changed since we last synced.
 def store_latest_version(version: int) -> None:
     """
     Store the latest Zotero version number in the database.
@@ -44,22 +135,100 @@ def store_latest_version(version: int) -> None:
         version (int): The latest Zotero version number.
     """
     with Session() as session:
-        new_version = ZoteroVersion(version=version, timestamp=datetime.utcnow())
-        session.add(new_version)
+        _set_latest_version(session, version)
         session.commit()
 
-def get_latest_version() -> ZoteroVersion:
+def get_latest_version() -> Optional[int]:
     """
     Retrieve the latest Zotero version number stored in the database.
 
     Returns:
-        ZoteroVersion: The latest stored Zotero version number.
+        Optional[int]: The latest stored Zotero version number, or None before the first sync.
     """
     with Session() as session:
-        session = Session()
-        latest_version = session.query(ZoteroVersion).order_by(ZoteroVersion.timestamp.desc()).first()
-    return latest_version
+        state = session.get(SyncState, 1)
+        return state.library_version if state is not None else None
+
+
+# Library change counter. Every transaction that writes through a session bumps it once, so caches keyed on it can
+# tell whether anything changed since they were filled.
+def get_library_version() -> int:
+    """
+    Retrieve the library's change counter.
+
+    Returns:
+        int: The counter; it increases with every committed write.
+    """
+    with Session() as session:
+        return session.scalar(select(LibraryState.version).where(LibraryState.id == 1)) or 0
+
+def _bump_library_version(session: OrmSession) -> int:
+    """
+    Increment the change counter inside the session's transaction, once per transaction.
+    """
+    if LIBRARY_VERSION_KEY not in session.info:
+        session.info[LIBRARY_VERSION_KEY] = session.connection().execute(
+            LibraryState.__table__.update().where(LibraryState.id == 1)
+            .values(version=LibraryState.version + 1).returning(LibraryState.version)
+        ).scalar()
+    return session.info[LIBRARY_VERSION_KEY]
+
+@event.listens_for(OrmSession, 'before_flush')
+def _stamp_changed_content(session: OrmSession, flush_context, instances) -> None:
+    # content rows carry the version of their last write, which orders the change feed
+    changed = [obj for obj in session.new if isinstance(obj, Content)]
+    changed += [obj for obj in session.dirty if isinstance(obj, Content) and session.is_modified(obj)]
+    if changed:
+        change_seq = _bump_library_version(session)
+        for content in changed:
+            content.change_seq = change_seq
+            _mark_zotero_dirty(content)
+            _replace_note_revisions(session, content)
+
+def _mark_zotero_dirty(content: Content) -> None:
+    """
+    Queue a local change for upload to Zotero. A write that sets a new zotero_version comes from Zotero (a sync or an
+    upload's result), so the row is in step with it.
+    """
+    if content.content_type not in ZOTERO_UPLOAD_TYPES:
+        return
+    # get_history rather than inspect().attrs, which memoizes a reference cycle on every instance state
+    if content.zotero_version is not None and get_history(content, 'zotero_version').has_changes():
+        content.zotero_dirty = False
+    elif content.zotero_key is None or any(get_history(content, field).has_changes() for field in ZOTERO_UPLOAD_FIELDS):
+        content.zotero_dirty = True
+
+def _replace_note_revisions(session: OrmSession, content: Content) -> None:
+    """
+    Start a new revision for a note whose whole document was saved, dropping the incremental edits it replaces.
+    """
+    if content.content_type != 'note' or content.id is None:
+        return
+    if not get_history(content, 'content_metadata').has_changes() or get_history(content, 'revision').has_changes():
+        return
+    conn = session.connection()
+    latest = conn.scalar(select(func.max(NoteRevision.revision)).where(NoteRevision.content_id == content.id))
+    content.revision = max(latest or 0, content.revision or 0) + 1
+    conn.execute(NoteRevision.__table__.delete().where(NoteRevision.content_id == content.id))
+
+@event.listens_for(OrmSession, 'after_flush')
+def _flush_bumps_library_version(session: OrmSession, flush_context) -> None:
+    if session.new or session.dirty or session.deleted:
+        _bump_library_version(session)
+
+@event.listens_for(OrmSession, 'do_orm_execute')
+def _bulk_write_bumps_library_version(orm_execute_state) -> None:
+    # query.update() / query.delete() bypass the flush
+    if orm_execute_state.is_update or orm_execute_state.is_delete:
+        change_seq = _bump_library_version(orm_execute_state.session)
+        mapper = orm_execute_state.bind_mapper
+        if orm_execute_state.is_update and mapper is not None and mapper.class_ is Content:
+            orm_execute_state.statement = orm_execute_state.statement.values(change_seq=change_seq)
 
+@event.listens_for(OrmSession, 'after_commit')
+@event.listens_for(OrmSession, 'after_rollback')
+def _end_library_version(session: OrmSession) -> None:
+    session.info.pop(LIBRARY_VERSION_KEY, None)
 
 def store_user(user_data: Dict[str,str]) -> None:
     """
@@ -73,8 +242,10 @@ def store_user(user_data: Dict[str,str]) -> None:
         existing_user = session.query(User).filter_by(username=username).first()
         if existing_user:
             return existing_user, "User already exists."
-        new_author =  Author(first_name=first_name, last_name=last_name)
-        new_user = User(username=username, author=new_author)
+        author = construct_author(session, {'first_name': first_name, 'last_name': last_name})
+        if author.user_id is not None:
+            return author.user, "An account for this author already exists."
+        new_user = User(username=username, author=author)
         new_user.set_password(password)
         session.add(new_user)
         session.commit()
@@ -111,6 +282,91 @@ def store_author(author_data: Dict[str, str]) -> None:
         session.add(new_author)
         session.commit()
 
+# Statements behind the hot read paths. They are built here so that `migrations.check_query_plans` can verify
+# the exact queries the listing functions run.
+def active_content_query() -> Select:
+    """
+    Build the query for all content that has not been soft deleted.
+    """
+    return select(Content).where(Content.deleted == False)
+
+def content_type_query(content_type: str) -> Select:
+    """
+    Build the query for all content of a given type, e.g. 'highlight' or 'chat'.
+    """
+    return select(Content).where(Content.content_type == content_type)
+
+def content_page_query(limit: int, cursor: Optional[Tuple[datetime, int]] = None, content_type: Optional[str] = None,
+                       tag: Optional[str] = None, author_id: Optional[int] = None, group_id: Optional[int] = None) -> Select:
+    """
+    Build the keyset-paginated query for active content, newest first, ordered by (time_modified, id).
+
+    Args:
+        limit (int): The maximum number of rows to return.
+        cursor (Optional[Tuple[datetime, int]]): The (time_modified, id) of the last row of the previous page.
+        content_type (Optional[str]): Only return content of this type.
+        tag (Optional[str]): Only return content carrying this tag.
+        author_id (Optional[int]): Only return content by this author.
+        group_id (Optional[int]): Only return content in this group.
+    """
+    query = active_content_query()
+    if content_type is not None:
+        query = query.where(Content.content_type == content_type)
+    if tag is not None:
+        # tags are stored comma separated, with or without a space after the comma
+        normalized_tags = literal(',') + func.replace(Content.tags, ', ', ',') + literal(',')
+        query = query.where(normalized_tags.contains(f',{tag},', autoescape=True))
+    if author_id is not None:
+        query = query.where(Content.authors.any(Author.id == author_id))
+    if group_id is not None:
+        query = query.where(Content.groups.any(Group.id == group_id))
+    if cursor is not None:
+        time_modified, content_id = cursor
+        query = query.where(or_(
+            Content.time_modified < time_modified,
+            and_(Content.time_modified == time_modified, Content.id < content_id),
+        ))
+    return query.order_by(Content.time_modified.desc(), Content.id.desc()).limit(limit)
+
+def hot_queries() -> Dict[str, Select]:
+    """
+    Return the queries that run on every page load or sync batch, keyed by a descriptive name.
+
+    Returns:
+        Dict[str, Select]: The statements, with representative parameter values bound.
+    """
+    return {
+        'active_content': active_content_query(),
+        'highlights': content_type_query('highlight'),
+        'chats': content_type_query('chat'),
+        'chat_tail': select(ChatMessage).where(ChatMessage.chat_id == 1).order_by(ChatMessage.seq.desc()).limit(20),
+        'content_by_zotero_key': select(Content).where(Content.zotero_key.in_(['ABCD1234', 'EFGH5678'])),
+        'authors_by_last_name': select(Author).where(Author.last_name.in_(['Doe', 'Roe'])),
+        'authors_of_content': select(Author).join(content_authors).where(content_authors.c.content_id == 1),
+        'content_of_author': select(Content).join(content_authors).where(content_authors.c.author_id == 1),
+        'groups_of_content': select(Group).join(GroupContent).where(GroupContent.c.content_id == 1),
+        'content_page': content_page_query(limit=50, cursor=(datetime(2023, 1, 1), 100)),
+        'content_page_by_type': content_page_query(limit=50, content_type='zotero_entry'),
+        'changes': changes_query(500, (0, 0)),
+        'latest_change': latest_change_query(),
+        'zotero_upload_queue': dirty_content_query(50, 100),
+    }
+
+def with_relations(query: Select, fields: Optional[List[str]] = None) -> Select:
+    """
+    Eager-load the relationships that `Content.to_dict` serializes, with one extra query per relationship for the
+    whole result instead of two lazy loads per row.
+
+    Args:
+        query (Select): A query selecting Content.
+        fields (Optional[List[str]]): The fields that will be serialized; all if None.
+    """
+    if fields is None or 'authors' in fields:
+        query = query.options(selectinload(Content.authors))
+    if fields is None or 'groups' in fields:
+        query = query.options(selectinload(Content.groups))
+    return query
+
 # Content database functions.
 def get_content_list(asdict: Optional[bool] = False) -> List[Dict[str, str]]:
     """
@@ -120,12 +376,210 @@ def get_content_list(asdict: Optional[bool] = False) -> List[Dict[str, str]]:
         List[Dict[str, str]]: A list of dictionaries containing content data.
     """
     with Session() as session:
-        content_list = session.query(Content).filter(Content.deleted == False).all()
+        query = with_relations(active_content_query()) if asdict else active_content_query()
+        content_list = session.scalars(query).all()
         if asdict:
-            return [c.to_dict() for c in content_list]
+            return _with_note_edits(session, [c.to_dict() for c in content_list])
         else:
             return content_list
 
+def get_content_by_id(content_id: int) -> Optional[Dict[str, any]]:
+    """
+    Retrieve a single content item with its authors and groups.
+
+    Args:
+        content_id (int): The id of the content item.
+
+    Returns:
+        Optional[Dict[str, any]]: The content item as a dictionary, or None if it does not exist.
+    """
+    with Session() as session:
+        content = session.scalars(with_relations(select(Content).where(Content.id == content_id))).first()
+        if content is None:
+            return None
+        return _with_note_edits(session, [content.to_dict()])[0]
+
+def get_entries_without_file() -> Dict[str, int]:
+    """
+    Retrieve the Zotero entries whose attachment has not been downloaded yet.
+
+    Returns:
+        Dict[str, int]: The content id of each entry, by zotero_key.
+    """
+    with Session() as session:
+        rows = session.execute(select(Content.zotero_key, Content.id).where(
+            Content.deleted == False, Content.content_type == 'zotero_entry',
+            Content.filename == None, Content.zotero_key != None))
+        return dict(rows.all())
+
+def encode_cursor(content: Content) -> str:
+    """
+    Encode the keyset position of a content item as an opaque page cursor.
+    """
+    position = f"{content.time_modified.isoformat()}|{content.id}"
+    return base64.urlsafe_b64encode(position.encode()).decode()
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    """
+    Decode a page cursor produced by `encode_cursor`.
+
+    Raises:
+        ValueError: If the cursor is malformed.
+    """
+    try:
+        time_modified, content_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(time_modified), int(content_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+def get_content_page(limit: int = 50, cursor: Optional[str] = None, content_type: Optional[str] = None,
+                     tag: Optional[str] = None, author_id: Optional[int] = None, group_id: Optional[int] = None,
+                     fields: Optional[List[str]] = None) -> Tuple[List[Dict[str, any]], Optional[str]]:
+    """
+    Retrieve one page of active content, newest first.
+
+    Args:
+        limit (int): The page size.
+        cursor (Optional[str]): The `next_cursor` returned with the previous page, or None for the first page.
+        content_type (Optional[str]): Only return content of this type.
+        tag (Optional[str]): Only return content carrying this tag.
+        author_id (Optional[int]): Only return content by this author.
+        group_id (Optional[int]): Only return content in this group.
+        fields (Optional[List[str]]): The keys to include in each item (see `Content.DICT_FIELDS`); all if None.
+                                      Columns that are not requested are not loaded.
+
+    Returns:
+        Tuple[List[Dict[str, any]], Optional[str]]: The page of content dictionaries, and the cursor of the next page
+                                                    or None if this is the last page.
+
+    Raises:
+        ValueError: If the cursor is malformed or an unknown field is requested.
+    """
+    if fields is not None:
+        unknown = set(fields) - set(Content.DICT_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+    position = decode_cursor(cursor) if cursor else None
+    # fetch one extra row to learn whether there is a next page
+    query = with_relations(content_page_query(limit + 1, position, content_type, tag, author_id, group_id), fields)
+    if fields is not None:
+        columns = [getattr(Content, f) for f in fields if f in CONTENT_COLUMNS]
+        query = query.options(load_only(Content.id, Content.time_modified, *columns))
+
+    with Session() as session:
+        content_list = session.scalars(query).all()
+        next_cursor = encode_cursor(content_list[limit - 1]) if len(content_list) > limit else None
+        return _with_note_edits(session, [c.to_dict(fields) for c in content_list[:limit]]), next_cursor
+
+def search_content(query: str, limit: int = 20, offset: int = 0, content_type: Optional[str] = None) -> Tuple[List[Dict[str, any]], Optional[int]]:
+    """
+    Full-text search over titles, abstracts, tags, note text and chat messages.
+
+    Args:
+        query (str): The text entered by the user.
+        limit (int): The page size.
+        offset (int): The number of results to skip.
+        content_type (Optional[str]): Only return content of this type.
+
+    Returns:
+        Tuple[List[Dict[str, any]], Optional[int]]: The page of ranked results with highlighted matches (see
+                                                    `search.search`), and the offset of the next page or None.
+    """
+    with Session() as session:
+        return search.search(session.connection(), query, limit, offset, content_type)
+
+def encode_change_cursor(change_seq: int, content_id: int) -> str:
+    """
+    Encode a position in the change feed as an opaque cursor.
+    """
+    return base64.urlsafe_b64encode(f"{change_seq}|{content_id}".encode()).decode()
+
+def decode_change_cursor(cursor: str) -> Tuple[int, int]:
+    """
+    Decode a change feed cursor produced by `encode_change_cursor`.
+
+    Raises:
+        ValueError: If the cursor is malformed.
+    """
+    try:
+        change_seq, content_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return int(change_seq), int(content_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+def changes_query(limit: int, since: Optional[Tuple[int, int]] = None) -> Select:
+    """
+    Build the query for the content rows written after a change feed position, in write order.
+    """
+    query = select(Content)
+    if since is not None:
+        change_seq, content_id = since
+        query = query.where(or_(Content.change_seq > change_seq,
+                                and_(Content.change_seq == change_seq, Content.id > content_id)))
+    return query.order_by(Content.change_seq, Content.id).limit(limit)
+
+def latest_change_query() -> Select:
+    """
+    Build the query for the change feed position of the latest write.
+    """
+    return select(Content.change_seq, Content.id).order_by(Content.change_seq.desc(), Content.id.desc()).limit(1)
+
+def dirty_content_query(limit: int, after_id: int = 0) -> Select:
+    """
+    Build the query for the next content rows queued for upload to Zotero, in id order.
+    """
+    return (select(Content).where(Content.zotero_dirty == True, Content.id > after_id)
+            .order_by(Content.id).limit(limit))
+
+def get_change_cursor() -> str:
+    """
+    Retrieve the change feed position of the latest write. A client that reads it before a full listing can follow
+    the feed from there; writes that land in between are in both, and applying them again is harmless.
+
+    Returns:
+        str: The cursor to pass to `get_changes`.
+    """
+    with Session() as session:
+        latest = session.execute(latest_change_query()).first()
+    return encode_change_cursor(*latest) if latest else encode_change_cursor(0, 0)
+
+def get_changes(since: Optional[str] = None, limit: int = 500) -> Dict[str, any]:
+    """
+    Retrieve the content created, updated or soft deleted since a change feed cursor.
+
+    Every write stamps the rows it touches with the library version (`Content.change_seq`), and writes are serialized
+    by SQLite, so the feed is ordered by commit. Soft-deleted rows come back as tombstones; hard deletes are not
+    reported.
+
+    Args:
+        since (Optional[str]): The cursor returned by the previous call; None to start from the beginning.
+        limit (int): The maximum number of rows (items and tombstones together) to return.
+
+    Returns:
+        Dict[str, any]: 'items', the new and updated content as dictionaries; 'deleted', the tombstones with id,
+                        zotero_key and time_modified; 'cursor', the position to pass as `since` next time; and
+                        'has_more', whether the limit cut the feed short.
+
+    Raises:
+        ValueError: If the cursor is malformed.
+    """
+    position = decode_change_cursor(since) if since else None
+    with Session() as session:
+        rows = session.scalars(with_relations(changes_query(limit + 1, position))).all()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if rows:
+            since = encode_change_cursor(rows[-1].change_seq, rows[-1].id)
+        elif since is None:
+            since = encode_change_cursor(0, 0)
+        return {
+            'items': _with_note_edits(session, [row.to_dict() for row in rows if not row.deleted]),
+            'deleted': [{'id': row.id, 'zotero_key': row.zotero_key, 'time_modified': row.time_modified}
+                        for row in rows if row.deleted],
+            'cursor': since,
+            'has_more': has_more,
+        }
+
 def update_content(content_list: List[Dict[str, str]]) -> None:
     """
     Update the specified content in the database.
@@ -133,15 +587,24 @@ def update_content(content_list: List[Dict[str, str]]) -> None:
     Args:
         content_list (List[Dict[str, str]]): A list of dictionaries containing content data.
     """
-    print(f"Updating content list: {content_list}")
+    updated_rows = 0
     with Session() as session:
         for content in content_list:
-            print(f"Updating content: {content}")
-            rows_matched = session.query(Content).filter(Content.id == content['id']).count()
-            print(f"Rows matched: {rows_matched}")
-            rows_updated = session.query(Content).filter(Content.id == content['id']).update(content, synchronize_session='fetch')
-            print(f"Rows updated: {rows_updated}")
+            values = {key: value for key, value in content.items() if key != 'id'}
+            if 'zotero_version' not in values and set(values) & set(ZOTERO_UPLOAD_FIELDS):
+                values['zotero_dirty'] = Content.content_type.in_(ZOTERO_UPLOAD_TYPES) | Content.zotero_dirty
+            updated = session.execute(
+                update(Content).where(Content.id == content['id']).values(values)
+                .returning(Content.id, Content.content_type, Content.change_seq)
+            ).all()
+            updated_rows += len(updated)
+            for content_id, content_type, change_seq in updated:
+                fields = [key for key in values if key != 'zotero_dirty'] + ['time_modified']
+                events.record(session, content_id, content_type, 'updated', fields, change_seq)
+        # bulk updates bypass the flush hook that maintains the search index
+        search.reindex(session.connection(), [content['id'] for content in content_list])
         session.commit()
+    logger.debug("Updated %d of %d content items", updated_rows, len(content_list))
 
 def create_highlight(content, highlight_text, return_dict=False):
     with Session() as session:
@@ -175,7 +638,8 @@ def get_highlights(asdict: Optional[bool] = False) -> List[Dict[str, str]]:
         List[Dict[str, str]]: A list of dictionaries containing highlight data.
     """
     with Session() as session:
-        highlights = session.query(Content).filter(Content.content_type == 'highlight').all()
+        query = content_type_query('highlight')
+        highlights = session.scalars(with_relations(query) if asdict else query).all()
         if asdict:
             return [h.to_dict() for h in highlights]
         else:
@@ -183,27 +647,35 @@ def get_highlights(asdict: Optional[bool] = False) -> List[Dict[str, str]]:
 
 def get_chats(asdict: Optional[bool] = False) -> List[Dict[str, str]]:
     """
-    Retrieve a list of chats from the database.
+    Retrieve a list of chats from the database. Transcripts are not included; use `get_chat_messages` for those.
 
     Returns:
-        List[Dict[str, str]]: A list of dictionaries containing chat data.
+        List[Dict[str, str]]: A list of chat summaries with id, title, time_created, time_modified, message_count
+                              and first_message (a preview of the opening message).
     """
+    message_count = (select(func.count()).where(ChatMessage.chat_id == Content.id)
+                     .correlate(Content).scalar_subquery())
+    first_message = (select(func.substr(ChatMessage.content, 1, CHAT_PREVIEW_LENGTH))
+                     .where(ChatMessage.chat_id == Content.id).order_by(ChatMessage.seq).limit(1)
+                     .correlate(Content).scalar_subquery())
+    query = select(Content.id, Content.title, Content.time_created, Content.time_modified,
+                   message_count.label('message_count'), first_message.label('first_message')) \
+        .where(Content.content_type == 'chat')
     with Session() as session:
-        chats = session.query(Content).filter(Content.content_type == 'chat').all()
+        chats = session.execute(query).mappings().all()
         if asdict:
-            return [c.to_dict() for c in chats]
+            return [dict(c) for c in chats]
         else:
             return chats
 
 def create_chat(content, messages, highlights, return_dict=False):
     # Each highlight object includes a reference to the independent highlight entry (highlight_entry_id)
-    # along with the original text (text) of the highlight
+    # along with the original text (text) of the highlight. The messages go to the chat_messages table.
     chat_entry = Content(
         content_type='chat',
         title=content.get('title', ''),
         content_metadata={
             'chat': {
-                'messages': messages,
                 'highlights': [
                     {
                         'id': highlight.get('id'),  # Unique identifier within the chat
@@ -226,36 +698,350 @@ def create_chat(content, messages, highlights, return_dict=False):
 
     with Session() as session:
         session.add(chat_entry)
+        session.flush()
+        session.add_all(_new_messages(chat_entry.id, 0, messages))
         session.commit()
         if return_dict:
             return chat_entry.to_dict()
     return chat_entry
 
-def get_chat_by_id(chat_id, return_dict=False):
+def _new_messages(chat_id: int, last_seq: int, messages: List[Dict[str, str]]) -> List[ChatMessage]:
+    return [
+        ChatMessage(chat_id=chat_id, seq=last_seq + i, role=message['role'], content=message.get('content') or '')
+        for i, message in enumerate(messages, start=1)
+    ]
+
+def append_chat_messages(chat_id: int, messages: List[Dict[str, str]]) -> Optional[int]:
+    """
+    Append messages to a chat transcript. Only the new messages are written; the stored history is not read.
+
+    Args:
+        chat_id (int): The id of the chat content item.
+        messages (List[Dict[str, str]]): The new messages, each with 'role' and 'content'.
+
+    Returns:
+        Optional[int]: The seq of the last message in the chat, or None if the chat does not exist.
+    """
+    for attempt in range(CHAT_APPEND_ATTEMPTS):
+        with Session() as session:
+            chat_entry = session.get(Content, chat_id)
+            if chat_entry is None:
+                return None
+            last_seq = session.scalar(select(func.max(ChatMessage.seq)).where(ChatMessage.chat_id == chat_id)) or 0
+            session.add_all(_new_messages(chat_id, last_seq, messages))
+            chat_entry.time_modified = datetime.utcnow()
+            try:
+                session.commit()
+                return last_seq + len(messages)
+            except IntegrityError:
+                # another writer took the same seq numbers first; read the new tail and retry
+                session.rollback()
+                if attempt == CHAT_APPEND_ATTEMPTS - 1:
+                    raise
+
+def get_chat_messages(chat_id: int, limit: Optional[int] = None, before_seq: Optional[int] = None) -> List[Dict[str, any]]:
+    """
+    Read a window of a chat transcript, oldest first.
+
+    Args:
+        chat_id (int): The id of the chat content item.
+        limit (Optional[int]): Return at most this many messages, the most recent ones of the window. All if None.
+        before_seq (Optional[int]): Only return messages with a seq lower than this, to page backwards.
+
+    Returns:
+        List[Dict[str, any]]: The messages, each with 'seq', 'role' and 'content'.
+    """
+    query = select(ChatMessage).where(ChatMessage.chat_id == chat_id)
+    if before_seq is not None:
+        query = query.where(ChatMessage.seq < before_seq)
+    query = query.order_by(ChatMessage.seq.desc())
+    if limit is not None:
+        query = query.limit(limit)
+    with Session() as session:
+        messages = session.scalars(query).all()
+        return [message.to_dict() for message in reversed(messages)]
+
+def get_chat_by_id(chat_id, return_dict=False, message_limit=None):
+    """
+    Retrieve a chat. As a dictionary, its content_metadata['chat']['messages'] holds the transcript (the last
+    `message_limit` messages if given).
+    """
     with Session() as session:
         chat_entry = session.query(Content).filter_by(id=chat_id).first()
         if return_dict:
-            return chat_entry.to_dict()
+            chat_dict = chat_entry.to_dict()
+            chat_metadata = dict((chat_dict['content_metadata'] or {}).get('chat', {}))
+            chat_metadata['messages'] = get_chat_messages(chat_id, limit=message_limit)
+            chat_dict['content_metadata'] = {**(chat_dict['content_metadata'] or {}), 'chat': chat_metadata}
+            return chat_dict
     return chat_entry
+
 def update_chat(chat_id, messages, highlights):
+    """
+    Bring a chat up to date with a full transcript: the messages past the stored ones are appended and the
+    highlights are replaced. New code should call `append_chat_messages` with just the new messages.
+    """
     with Session() as session:
         # Retrieve the chat entry by its ID
         chat_entry = session.query(Content).filter_by(id=chat_id).first()
         if not chat_entry:
             # Chat entry not found; handle the error
             return None
-
-        # Update the chat's content_metadata with new messages and highlights
+        stored = session.scalar(select(func.count()).where(ChatMessage.chat_id == chat_id))
         chat_entry.content_metadata = {
             'chat': {
-                'messages': messages,
                 'highlights': highlights
             }
         }
-
-        # Commit the changes to the database
         session.commit()
+    append_chat_messages(chat_id, messages[stored:])
     return chat_entry
+
+# Incremental note edits. A note is stored as a snapshot (Content.content_metadata, at Content.revision) followed by the
+# edits saved since (note_revisions), each a delta against the revision before it. Saving an edit writes one small row
+# instead of the whole document; every NOTE_SNAPSHOT_INTERVAL edits the snapshot is brought up to date and the edits
+# folded into it are deleted. Listings return the snapshot with its revision; get_note_document and get_content_by_id
+# compose the current document.
+class RevisionConflict(Exception):
+    """
+    An edit of a note that was based on an older revision than the note's latest.
+    """
+
+    def __init__(self, revision: int):
+        super().__init__(f"The note is at revision {revision}")
+        self.revision = revision
+
+def _note_edits(session: Session, content_ids: Iterable[int]) -> Dict[int, List[NoteRevision]]:
+    """
+    Load the edits after the snapshots of the given notes, in revision order.
+    """
+    edits = {}
+    for chunk in _chunked(list(content_ids)):
+        query = (select(NoteRevision).where(NoteRevision.content_id.in_(chunk))
+                 .order_by(NoteRevision.content_id, NoteRevision.revision))
+        for edit in session.scalars(query):
+            edits.setdefault(edit.content_id, []).append(edit)
+    return edits
+
+def _compose_note(content_metadata: any, edits: List[NoteRevision]) -> List[Dict[str, any]]:
+    ops = delta.snapshot_ops(content_metadata)
+    for edit in edits:
+        ops = delta.compose(ops, edit.ops)
+    return ops
+
+def _with_note_edits(session: Session, content_list: List[Dict[str, any]]) -> List[Dict[str, any]]:
+    """
+    Bring the notes among content dictionaries up to their latest revision. A note has at most NOTE_SNAPSHOT_INTERVAL
+    edits to compose, and a list without notes (or without their content_metadata and revision) costs no query.
+    """
+    note_ids = [c['id'] for c in content_list if 'id' in c and c.get('content_type', 'note') == 'note'
+                and ('content_metadata' in c or 'revision' in c)]
+    edits = _note_edits(session, note_ids)
+    for content in content_list:
+        note_edits = edits.get(content.get('id'))
+        if note_edits:
+            if 'content_metadata' in content:
+                content['content_metadata'] = {'ops': _compose_note(content['content_metadata'], note_edits)}
+            if 'revision' in content:
+                content['revision'] = note_edits[-1].revision
+    return content_list
+
+def get_note_document(content_id: int) -> Optional[Dict[str, any]]:
+    """
+    Retrieve the current document of a note.
+
+    Args:
+        content_id (int): The id of the note.
+
+    Returns:
+        Optional[Dict[str, any]]: The note's id, its latest revision and its delta, or None if there is no such note.
+    """
+    with Session() as session:
+        note = session.execute(select(Content.content_type, Content.revision, Content.content_metadata)
+                               .where(Content.id == content_id)).first()
+        if note is None or note.content_type != 'note':
+            return None
+        edits = _note_edits(session, [content_id]).get(content_id, [])
+        return {
+            'id': content_id,
+            'revision': edits[-1].revision if edits else note.revision,
+            'delta': {'ops': _compose_note(note.content_metadata, edits)},
+        }
+
+def _latest_revision(session: Session, content_id: int, snapshot_revision: int) -> Tuple[int, Optional[int]]:
+    """
+    Get the latest revision of a note and the length of its document, if an edit recorded it.
+    """
+    latest = session.execute(select(NoteRevision.revision, NoteRevision.length)
+                             .where(NoteRevision.content_id == content_id)
+                             .order_by(NoteRevision.revision.desc()).limit(1)).first()
+    return (latest.revision, latest.length) if latest else (snapshot_revision, None)
+
+def _snapshot_note(session: Session, content_id: int) -> None:
+    """
+    Fold a note's edits into its snapshot, inside the caller's transaction.
+    """
+    content_metadata = session.scalar(select(Content.content_metadata).where(Content.id == content_id))
+    edits = _note_edits(session, [content_id]).get(content_id, [])
+    if not edits:
+        return
+    revision = edits[-1].revision
+    session.execute(update(Content).where(Content.id == content_id)
+                    .values(content_metadata={'ops': _compose_note(content_metadata, edits)}, revision=revision))
+    session.execute(delete(NoteRevision).where(NoteRevision.content_id == content_id, NoteRevision.revision <= revision))
+    # bulk updates bypass the flush hook that maintains the search index
+    search.reindex(session.connection(), [content_id])
+
+def save_note_edit(content_id: int, base_revision: int, ops: List[Dict[str, any]], title: Optional[str] = None,
+                   filename: Optional[str] = None,
+                   snapshot_interval: int = NOTE_SNAPSHOT_INTERVAL) -> Optional[Dict[str, any]]:
+    """
+    Save an edit of a note: the delta ops that turn revision `base_revision` into the next one. Only the edit is
+    written; the document is neither read nor rewritten, except when the edit completes a snapshot interval.
+
+    Args:
+        content_id (int): The id of the note.
+        base_revision (int): The revision the edit was made on; it must be the note's latest.
+        ops (List[Dict[str, any]]): The ops of the edit.
+        title (Optional[str]): A new title for the note, if it changed.
+        filename (Optional[str]): The file the note is stored in, if it is stored in one.
+        snapshot_interval (int): Fold the edits into the snapshot once this many have accumulated.
+
+    Returns:
+        Optional[Dict[str, any]]: The note's id, its new revision and the change_seq of the write, or None if there is
+                                  no such note.
+
+    Raises:
+        RevisionConflict: If the note has a later revision than `base_revision`.
+        delta.DeltaError: If the edit is malformed or does not fit the document.
+    """
+    delta.check_ops(ops)
+    with Session() as session:
+        note = session.execute(select(Content.content_type, Content.revision).where(Content.id == content_id)).first()
+        if note is None or note.content_type != 'note':
+            return None
+        revision, length = _latest_revision(session, content_id, note.revision)
+        if base_revision != revision:
+            raise RevisionConflict(revision)
+        if length is None:
+            snapshot = session.scalar(select(Content.content_metadata).where(Content.id == content_id))
+            length = delta.document_length(delta.snapshot_ops(snapshot))
+        new_length = delta.change_length(ops, length)
+
+        values = {'zotero_dirty': True, 'time_modified': datetime.utcnow()}
+        if title is not None:
+            values['title'] = title
+        if filename is not None:
+            values['filename'] = filename
+        try:
+            session.add(NoteRevision(content_id=content_id, revision=revision + 1, ops=ops, length=new_length))
+            change_seq = session.execute(update(Content).where(Content.id == content_id).values(values)
+                                         .returning(Content.change_seq)).scalar()
+            fields = ['content_metadata'] + (['title'] if title is not None else [])
+            events.record(session, content_id, 'note', 'updated', fields, change_seq)
+            if revision + 1 - note.revision >= snapshot_interval:
+                _snapshot_note(session, content_id)
+            else:
+                # the index holds the note's current text, edits included
+                search.reindex(session.connection(), [content_id])
+            session.commit()
+        except IntegrityError:
+            # another edit of the same revision was saved first
+            session.rollback()
+            raise RevisionConflict(_latest_revision(session, content_id, note.revision)[0])
+        return {'id': content_id, 'revision': revision + 1, 'change_seq': change_seq}
+
+def _chunked(values: List[any], size: int = SQLITE_MAX_PARAMS):
+    """
+    Yield successive slices of `values` that fit in a single `IN (...)` clause.
+    """
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def bulk_upsert_content(session: Session, content_list: List[Dict[str, any]], key: Optional[str] = 'zotero_key') -> Tuple[List[Content], Dict[str, int]]:
+    """
+    Insert or update a batch of content items with a fixed number of queries.
+
+    All rows matching the batch are fetched up front with one `IN (...)` query on `key`, the batch is split into
+    inserts and updates, and the session flushes both sets in bulk on commit. Items whose `zotero_version` is not
+    newer than the stored one are skipped, and so are new Zotero versions of rows with local changes queued for upload:
+    the row keeps its local changes and the version they were made against, so the upload's per-item version check
+    reports the conflict instead of the sync overwriting them. The caller owns the transaction.
+
+    Args:
+        session (Session): The SQLAlchemy session to be used for the database operation.
+        content_list (List[Dict[str, any]]): A list of dictionaries containing the data for the Content instances.
+        key (Optional[str]): The column used to match incoming items to existing rows. If None, every item is inserted.
+
+    Returns:
+        Tuple[List[Content], Dict[str, int]]: The Content instances in input order, and the number of items
+                                              inserted, updated and skipped.
+    """
+    counts = {'inserted': 0, 'updated': 0, 'skipped': 0}
+    resolve_authors(session, _author_names(content_list))
+    existing = {}
+    if key is not None:
+        column = getattr(Content, key)
+        lookup_values = list({content[key] for content in content_list if content.get(key) is not None})
+        for chunk in _chunked(lookup_values):
+            # authors are replaced on update, so load the current collections with the rows
+            for row in session.query(Content).filter(column.in_(chunk)).options(selectinload(Content.authors)):
+                existing[getattr(row, key)] = row
+
+    stored = []
+    new_items = []
+    for content in content_list:
+        lookup_value = content.get(key) if key is not None else None
+        current = existing.get(lookup_value) if lookup_value is not None else None
+        if current is None:
+            current = prepare_new_item(session, content)
+            new_items.append(current)
+            if lookup_value is not None:
+                # later duplicates in the same batch update the pending row instead of inserting twice
+                existing[lookup_value] = current
+            counts['inserted'] += 1
+        elif _is_stale(current, content):
+            counts['skipped'] += 1
+        elif _is_conflict(current, content):
+            logger.warning("Content %s changed both locally and in Zotero; keeping the local changes", current.id)
+            counts['skipped'] += 1
+        else:
+            _apply_update(session, current, content)
+            counts['updated'] += 1
+        stored.append(current)
+
+    session.add_all(new_items)
+    return stored, counts
+
+
+def _is_stale(current: Content, content: Dict[str, any]) -> bool:
+    """
+    Check whether an incoming item carries a Zotero version that is not newer than the stored row.
+    """
+    incoming_version = content.get('zotero_version')
+    return (current.zotero_version is not None and incoming_version is not None
+            and incoming_version <= current.zotero_version)
+
+
+def _is_conflict(current: Content, content: Dict[str, any]) -> bool:
+    """
+    Check whether an incoming Zotero version would overwrite local changes that are not uploaded yet.
+    """
+    return current.zotero_dirty and current.zotero_key is not None and content.get('zotero_version') is not None
+
+
+def _apply_update(session: Session, current: Content, content: Dict[str, any]) -> None:
+    """
+    Copy the column values (and authors, if provided) of an incoming item onto an existing Content instance.
+    """
+    for field, value in content.items():
+        if field in CONTENT_COLUMNS and field != 'id':
+            setattr(current, field, value)
+    if 'authors' in content:
+        current.authors = [construct_author(session, author_data) for author_data in content['authors']]
+
+
 def custom_merge(session: Session, content_data: Dict[str, any], filter_by: Optional[Dict[str, any]] = None) -> None:
     """
     Merge content data into the database using a custom filter.
@@ -265,45 +1051,23 @@ def custom_merge(session: Session, content_data: Dict[str, any], filter_by: Opti
     :param filter_by: A dictionary containing the filter conditions to find an existing record in the database.
                       If None, the function will treat the content data as a new item to be added.
     """
-    if filter_by is None:
-        # Create a new Content instance and add it to the session
-        new_content = prepare_new_item(session,content_data)
-        session.add(new_content)
-    else:
-        existing_content = session.query(Content).filter_by(**filter_by).first()
-
-        if existing_content:
-            # Convert dictionaries to ORM instances
-            content_data['authors'] = [construct_author(session, author_data) for author_data in content_data['authors']]
-            # Add related content if provided, obviously it needs to be in content table already
-            if 'related_content' in content_data:
-                for related_item in content_data['related_content']:
-                    existing_content = session.query(Content).get(related_item)
-                    if existing_content:
-                        new_content.related_content.append(existing_content)
-                        content_data['related_content'] = [Content(**related_data) for related_data in content_data['related_content']]
-            # Update the existing content with the new values
-            for key, value in content_data.items():
-                setattr(existing_content, key, value)
-        else:
-            # Create a new Content instance and add it to the session
-            new_content = prepare_new_item(session,content_data)
-            session.add(new_content)
+    key = next(iter(filter_by)) if filter_by else None
+    bulk_upsert_content(session, [content_data], key)
 
 
-def merge_content(content_list: List[Dict[str, any]], filter_by_key: Optional[str] = None) -> None:
+def merge_content(content_list: List[Dict[str, any]], filter_by_key: Optional[str] = None) -> Dict[str, int]:
     """
-    Merge a list of content data into the database using a custom merge function.
+    Merge a list of content data into the database using the bulk upsert engine.
 
     :param content_list: A list of dictionaries containing the data for the Content instances.
-    :param filter_by_key: The key to be used as a filter in the custom merge function. If None, no filter will be applied.
+    :param filter_by_key: The key used to match existing rows. If None, every item will be inserted.
+    :return: The number of items inserted, updated and skipped.
     """
     with Session() as session:
-        for content in content_list:
-            print(content)
-            filter_by = {filter_by_key: content[filter_by_key]} if filter_by_key else None
-            custom_merge(session, content, filter_by)
+        _, counts = bulk_upsert_content(session, content_list, filter_by_key)
         session.commit()
+    logger.info("Merged %d items: %s", len(content_list), counts)
+    return counts
 
 
 def delete_content(content_list: List[Dict[str, str]]) -> None:
@@ -317,9 +1081,13 @@ def delete_content(content_list: List[Dict[str, str]]) -> None:
         for content in content_list:
             if 'zotero_key' in content:
                 # try deleting by zotero key first (in case the request is coming from Zotero)
-                session.query(Content).filter(Content.zotero_key == content['zotero_key']).delete()
+                query = session.query(Content).filter(Content.zotero_key == content['zotero_key'])
             else:
-                session.query(Content).filter(Content.id == content['id']).delete()
+                query = session.query(Content).filter(Content.id == content['id'])
+            content_ids = [row.id for row in query.with_entities(Content.id)]
+            search.remove(session.connection(), content_ids)
+            session.query(ChatMessage).filter(ChatMessage.chat_id.in_(content_ids)).delete()
+            query.delete()
         session.commit()
 
 def soft_delete_content(content_list: List[Dict[str, str]]) -> None:
@@ -330,14 +1098,25 @@ def soft_delete_content(content_list: List[Dict[str, str]]) -> None:
         content_list (List[Dict[str, str]]): A list of dictionaries containing content data.
     """
     with Session() as session:
-        for content in content_list:
-            if 'zotero_key' in content:
-                # try deleting by zotero key first (in case the request is coming from Zotero)
-                session.query(Content).filter(Content.zotero_key == content['zotero_key']).update({"deleted": True})
-            else:
-                session.query(Content).filter(Content.id == content['id']).update({"deleted": True})
+        _soft_delete(session, content_list)
         session.commit()
 
+def _soft_delete(session: Session, content_list: List[Dict[str, str]]) -> None:
+    """
+    Soft delete content by zotero_key, or by id for items without one, inside the caller's transaction.
+    """
+    # try deleting by zotero key first (in case the request is coming from Zotero)
+    zotero_keys = [content['zotero_key'] for content in content_list if 'zotero_key' in content]
+    ids = [content['id'] for content in content_list if 'zotero_key' not in content]
+    for column, values in ((Content.zotero_key, zotero_keys), (Content.id, ids)):
+        for chunk in _chunked(values):
+            deleted = session.execute(
+                update(Content).where(column.in_(chunk)).values(deleted=True)
+                .returning(Content.id, Content.content_type, Content.change_seq)
+            ).all()
+            for content_id, content_type, change_seq in deleted:
+                events.record(session, content_id, content_type, 'deleted', change_seq=change_seq)
+
 def construct_author(session: Session, author: Dict[str, str]) -> Author:
     """
     Construct an Author instance from the provided data, or returns an existing Author instance if one exists in db.
@@ -348,12 +1127,47 @@ def construct_author(session: Session, author: Dict[str, str]) -> Author:
 
     Returns: An Author instance.
     """
-    existing_author = session.query(Author).filter_by(first_name=author['first_name'], last_name=author['last_name']).first()
-    if existing_author:
-        return existing_author
-    else:
-        new_author = Author(first_name=author['first_name'], last_name=author['last_name'])
-        return new_author
+    name = (author['first_name'], author['last_name'])
+    return resolve_authors(session, [name])[name]
+
+def resolve_authors(session: Session, names: Iterable[Tuple[str, str]]) -> Dict[Tuple[str, str], Author]:
+    """
+    Resolve (first_name, last_name) pairs to Author instances in one query per chunk of names.
+
+    Resolved authors are kept in a per-transaction cache on the session, so authors created earlier in the same
+    batch are reused instead of being inserted twice. The cache is dropped when the transaction ends.
+
+    Args:
+        session (Session): The SQLAlchemy session to be used for the database operation.
+        names (Iterable[Tuple[str, str]]): The (first_name, last_name) pairs to resolve.
+
+    Returns:
+        Dict[Tuple[str, str], Author]: The session's author cache, which contains every requested name.
+    """
+    cache = session.info.setdefault(AUTHOR_CACHE_KEY, {})
+    missing = list({name for name in names if name not in cache})
+    # SQLite scans the table for row-value IN lists, so seek on last_name and match the pair here
+    last_names = list({last_name for _, last_name in missing})
+    for chunk in _chunked(last_names):
+        for author in session.query(Author).filter(Author.last_name.in_(chunk)):
+            cache.setdefault((author.first_name, author.last_name), author)
+    for first_name, last_name in missing:
+        if (first_name, last_name) not in cache:
+            new_author = Author(first_name=first_name, last_name=last_name)
+            session.add(new_author)
+            cache[(first_name, last_name)] = new_author
+    return cache
+
+def _author_names(content_list: List[Dict[str, any]]) -> List[Tuple[str, str]]:
+    """
+    Collect the (first_name, last_name) pairs referenced by a batch of content items.
+    """
+    return [(author['first_name'], author['last_name']) for content in content_list for author in content.get('authors') or []]
+
+@event.listens_for(OrmSession, 'after_commit')
+@event.listens_for(OrmSession, 'after_soft_rollback')
+def _drop_author_cache(session: OrmSession, *args) -> None:
+    session.info.pop(AUTHOR_CACHE_KEY, None)
     
 def prepare_new_item(session: Session, content: Dict[str,str]) -> Content:
     # Create the Content object
@@ -367,10 +1181,10 @@ def prepare_new_item(session: Session, content: Dict[str,str]) -> Content:
     new_content = Content(
         title = content['title'],
         content_type = content['content_type'],
-        zotero_key = content['zotero_key'],
-        zotero_version = content['zotero_version'],
-        content_metadata = content['content_metadata'],
-        filename = content['filename'],
+        zotero_key = content.get('zotero_key'),
+        zotero_version = content.get('zotero_version'),
+        content_metadata = content.get('content_metadata'),
+        filename = content.get('filename'),
         summary = content['summary'] if 'summary' in content else None,
         tags = content['tags'] if 'tags' in content else None,
         deleted = content['deleted'] if 'deleted' in content else False
@@ -388,12 +1202,14 @@ def prepare_new_item(session: Session, content: Dict[str,str]) -> Content:
 
     return new_content
 
-def store_content_list(content_list: List[Dict[str, str]], return_dict: bool=False) -> Tuple[List[Union[Content, Dict[str,str], None]], Union[str, None]]:
+def store_content_list(content_list: List[Dict[str, str]], return_dict: bool=False, key: str = 'zotero_key') -> Tuple[List[Union[Content, Dict[str,str], None]], Union[str, None]]:
     """
     Store a list of content in the database.
 
     Args:
         content_list (List[Dict[str, str]]): A list of dictionaries containing content data.
+        return_dict (bool): Whether to return the stored content as dictionaries.
+        key (str): The column used to match items to existing rows, e.g. 'id' for content edited in the app.
 
     Returns:
         Tuple[List[Union[Content, None]], Union[str, None]]: A tuple containing a list of stored content objects or None,
@@ -405,41 +1221,187 @@ def store_content_list(content_list: List[Dict[str, str]], return_dict: bool=Fal
     with Session() as session:
         try:
             with session.begin():
-                for content in content_list:
-                    new_content = prepare_new_item(session, content)
-                    # Add the Content object to the session
-                    session.add(new_content)
-                    stored_contents.append(new_content)
-                
-            session.commit()
+                stored_contents, counts = bulk_upsert_content(session, content_list, key)
+                session.flush()
+                # ids survive the commit, so the rows can be reloaded in bulk below
+                stored_ids = [content.id for content in stored_contents]
+            logger.info("Stored %d items: %s", len(content_list), counts)
         except Exception as e:
             print(e)
             error_message = str(e)
-            session.rollback()
             stored_contents = [None] * len(content_list)
-        if return_dict:
+        if return_dict and error_message is None:
+            for chunk in _chunked(stored_ids):
+                session.scalars(with_relations(select(Content).where(Content.id.in_(chunk)))).all()
             stored_contents = [content.to_dict() for content in stored_contents]
     return stored_contents, error_message
 
-def sync_content(new_and_modified_items: List[Dict[str, str]], deleted_items: List[Dict[str, str]], sync_key: str = 'zotero_key') -> None:
+def sync_content(new_and_modified_items: List[Dict[str, str]], deleted_items: List[Dict[str, str]], sync_key: str = 'zotero_key') -> Dict[str, int]:
     """
     Sync content with Zotero by merging new and modified items and soft deleting deleted items.
 
     Args:
         new_and_modified_items (List[Dict[str, str]]): A list of dictionaries containing new and modified content data.
         deleted_items (List[Dict[str, str]]): A list of dictionaries containing deleted content data.
+
+    Returns:
+        Dict[str, int]: The number of items inserted, updated, skipped and deleted.
     """
     try:
         # Merge new and modified items
-        merge_content(new_and_modified_items, filter_by_key=sync_key)
+        counts = merge_content(new_and_modified_items, filter_by_key=sync_key)
         # Soft delete deleted items
+        counts['deleted'] = len(deleted_items)
         if deleted_items:
             soft_delete_content(deleted_items)
-        return None
+        return counts
     except Exception as e:
         print(e)
         raise(e)
 
+# Checkpointed Zotero download. A sync commits its pages in chunks, each together with the position after it, so an
+# interrupted sync can resume instead of starting over (see zotero_sync.sync_zotero_down).
+def get_sync_checkpoint() -> Optional[Dict[str, any]]:
+    """
+    Retrieve the checkpoint of an interrupted Zotero sync.
+
+    Returns:
+        Optional[Dict[str, any]]: The collection, since, version and start of the checkpoint, or None if no sync is in
+                                  progress.
+    """
+    with Session() as session:
+        state = session.get(SyncState, 1)
+        if state is None or state.checkpoint_collection is None:
+            return None
+        return {
+            'collection': state.checkpoint_collection,
+            'since': state.checkpoint_since,
+            'version': state.checkpoint_version,
+            'start': state.checkpoint_start,
+        }
+
+def _set_sync_checkpoint(session: Session, checkpoint: Optional[Dict[str, any]]) -> None:
+    checkpoint = checkpoint or {}
+    session.execute(update(SyncState).where(SyncState.id == 1).values(
+        checkpoint_collection=checkpoint.get('collection'),
+        checkpoint_since=checkpoint.get('since'),
+        checkpoint_version=checkpoint.get('version'),
+        checkpoint_start=checkpoint.get('start'),
+    ))
+
+def store_sync_chunk(content_list: List[Dict[str, any]], checkpoint: Dict[str, any]) -> Dict[str, int]:
+    """
+    Upsert a chunk of synced Zotero items and record the sync checkpoint after it, in one transaction.
+
+    Args:
+        content_list (List[Dict[str, any]]): The converted items of the chunk.
+        checkpoint (Dict[str, any]): The collection, since, version and start to resume from after this chunk.
+
+    Returns:
+        Dict[str, int]: The number of items inserted, updated and skipped.
+    """
+    with Session() as session:
+        _, counts = bulk_upsert_content(session, content_list, 'zotero_key')
+        _set_sync_checkpoint(session, checkpoint)
+        session.commit()
+    return counts
+
+def finish_sync(version: Optional[int], deleted_items: List[Dict[str, str]]) -> None:
+    """
+    Complete a Zotero sync in one transaction: soft delete the deleted items, store the library version the sync
+    reached and clear the checkpoint.
+
+    Args:
+        version (Optional[int]): The library version to store; None to keep the stored one.
+        deleted_items (List[Dict[str, str]]): The items deleted in Zotero, by zotero_key.
+    """
+    with Session() as session:
+        _soft_delete(session, deleted_items)
+        if version is not None:
+            _set_latest_version(session, version)
+        _set_sync_checkpoint(session, None)
+        session.commit()
+
+# Zotero upload. Local changes to notes and entries set zotero_dirty (see _mark_zotero_dirty); the uploader reads the
+# queue in batches and writes the results back (see zotero_sync.upload_dirty_content).
+def get_dirty_content(limit: int = 50, after_id: int = 0) -> List[Dict[str, any]]:
+    """
+    Retrieve a batch of content queued for upload to Zotero.
+
+    Args:
+        limit (int): The batch size.
+        after_id (int): Only return rows with a larger id, to page through the queue.
+
+    Returns:
+        List[Dict[str, any]]: The queued rows as dictionaries, in id order.
+    """
+    with Session() as session:
+        content_list = session.scalars(dirty_content_query(limit, after_id)).all()
+        # the upload carries a note's current text, not its snapshot
+        return _with_note_edits(session, [c.to_dict([field for field in Content.DICT_FIELDS if field not in ('authors', 'groups')])
+                                          for c in content_list])
+
+def assign_zotero_keys(keys: Dict[int, Tuple[str, int]]) -> Dict[int, int]:
+    """
+    Store the Zotero keys chosen for content that is not in Zotero yet, before it is uploaded. The upload then creates
+    the items under these keys, so writing them again after a lost response updates them instead of creating
+    duplicates.
+
+    Args:
+        keys (Dict[int, Tuple[str, int]]): For each content id, the key and the change_seq the row was read at.
+
+    Returns:
+        Dict[int, int]: The new change_seq of each row that got its key. A row that was changed since it was read, or
+                        got a key meanwhile, is left alone and not returned.
+    """
+    assigned = {}
+    with Session() as session:
+        for content_id, (zotero_key, change_seq) in keys.items():
+            rows = session.execute(
+                update(Content).where(Content.id == content_id, Content.change_seq == change_seq,
+                                      Content.zotero_key.is_(None))
+                .values(zotero_key=zotero_key).returning(Content.id, Content.content_type, Content.change_seq)
+            ).all()
+            for row_id, content_type, new_change_seq in rows:
+                events.record(session, row_id, content_type, 'updated', ['zotero_key'], new_change_seq)
+                assigned[row_id] = new_change_seq
+        session.commit()
+    return assigned
+
+def store_upload_results(results: List[Dict[str, any]], library_version: Optional[int] = None) -> int:
+    """
+    Record uploaded content in one transaction: store the Zotero key and version of each row and take it off the
+    upload queue, unless it was changed again while the upload was in flight.
+
+    Args:
+        results (List[Dict[str, any]]): For each uploaded row its id, the change_seq it was read at, and the
+                                        zotero_key and zotero_version Zotero returned.
+        library_version (Optional[int]): The library version after the upload, to store as the synced version. Only
+                                         pass it when the upload was conditioned on the stored version, i.e. the
+                                         library had no other changes, so the next sync does not fetch the uploaded
+                                         items back.
+
+    Returns:
+        int: The number of rows updated.
+    """
+    updated = 0
+    with Session() as session:
+        for result in results:
+            # SET expressions see the row before the update, so this compares the change_seq the upload read
+            rows = session.execute(
+                update(Content).where(Content.id == result['id']).values(
+                    zotero_key=result['zotero_key'], zotero_version=result['zotero_version'],
+                    zotero_dirty=case((Content.change_seq == result['change_seq'], False), else_=True))
+                .returning(Content.id, Content.content_type, Content.change_seq)
+            ).all()
+            for content_id, content_type, change_seq in rows:
+                events.record(session, content_id, content_type, 'updated', ['zotero_key', 'zotero_version'], change_seq)
+            updated += len(rows)
+        if library_version is not None:
+            _set_latest_version(session, library_version)
+        session.commit()
+    return updated
+
 def create_group_with_zotero_keys(name: str, group_type: GroupType, zotero_keys: List[str]) -> Group:
     """
     Create a new group with the specified content items.
@@ -0,0 +1,348 @@
+from typing import Any, Dict, List, Optional, Tuple
+import html
+import json
+import math
+import re
+
+"""
+delta.py
+
+Operations on Quill deltas, the format the editor saves notes in. A delta is a list of ops, each one of:
+
+- {'insert': 'text' or an embed such as {'image': url}, 'attributes': {...}}
+- {'retain': n, 'attributes': {...}}: keep n characters, optionally changing their formatting
+- {'delete': n}
+
+A document is a delta of inserts only. An edit is a delta against a document: `compose` applies it, the same way
+quill-delta's `compose` does, and `apply_change` additionally checks that the edit fits the document. Lengths are
+counted as JavaScript counts them, in UTF-16 code units, since that is what the editor's retain and delete ops count;
+an emoji outside the Basic Multilingual Plane is two characters long.
+
+`to_html` renders a document as HTML: inline formats (bold, italic, underline, strike, code, links), images, and the
+line formats headers, lists, blockquotes and code blocks. Any client can save a delta, and the rendered file is served
+from the API's origin, so like Quill's `Link.sanitize` it only keeps links and images with a safe URL scheme.
+"""
+
+INLINE_TAGS = (('code', 'code'), ('strike', 's'), ('underline', 'u'), ('italic', 'em'), ('bold', 'strong'))
+LIST_TAGS = {'ordered': 'ol', 'bullet': 'ul', 'checked': 'ul', 'unchecked': 'ul'}
+LINK_SCHEMES = ('http', 'https', 'mailto')
+IMAGE_SCHEMES = ('http', 'https')
+IMAGE_DATA_URL = re.compile(r'data:image/(png|jpeg|gif|webp);', re.IGNORECASE)
+URL_SCHEME = re.compile(r'([a-z][a-z0-9+.-]*):', re.IGNORECASE)
+
+
+class DeltaError(ValueError):
+    """
+    A delta that is malformed, or does not fit the document it is applied to.
+    """
+
+
+def _text_length(text: str) -> int:
+    # UTF-16 code units: every character outside the BMP counts twice
+    length = len(text)
+    if text.isascii():
+        return length
+    return length + sum(1 for char in text if ord(char) > 0xFFFF)
+
+
+def _text_slice(text: str, start: int, length: int) -> str:
+    if text.isascii() or _text_length(text) == len(text):
+        return text[start:start + length]
+    encoded = text.encode('utf-16-le', 'surrogatepass')
+    return encoded[2 * start:2 * (start + length)].decode('utf-16-le', 'surrogatepass')
+
+
+def op_length(op: Dict[str, Any]) -> int:
+    """
+    :return: The number of characters an op inserts, keeps or deletes; an embed is one character
+    """
+    if 'delete' in op:
+        return op['delete']
+    if 'retain' in op:
+        return op['retain']
+    return _text_length(op['insert']) if isinstance(op['insert'], str) else 1
+
+
+def document_length(ops: List[Dict[str, Any]]) -> int:
+    """
+    :return: The length of a document, in UTF-16 code units
+    """
+    return sum(op_length(op) for op in ops)
+
+
+def snapshot_ops(content_metadata: Any) -> List[Dict[str, Any]]:
+    """
+    :return: The ops of a note's stored document; the editor's delta may have been stored as a JSON string
+    """
+    if isinstance(content_metadata, str):
+        content_metadata = json.loads(content_metadata)
+    return list((content_metadata or {}).get('ops') or [])
+
+
+def check_ops(ops: Any) -> List[Dict[str, Any]]:
+    """
+    Check that a delta is well formed.
+
+    :param ops: The ops of the delta
+    :return: The ops
+    :raises DeltaError: If an op is not a single insert, retain or delete, or has an invalid length or attributes
+    """
+    if not isinstance(ops, list):
+        raise DeltaError("A delta's ops must be a list")
+    for op in ops:
+        if not isinstance(op, dict):
+            raise DeltaError(f"Not an op: {op!r:.100}")
+        kinds = [kind for kind in ('insert', 'retain', 'delete') if kind in op]
+        if len(kinds) != 1 or set(op) - {kinds[0], 'attributes'}:
+            raise DeltaError(f"An op must be exactly one insert, retain or delete: {op!r:.100}")
+        kind, value = kinds[0], op[kinds[0]]
+        if kind == 'insert':
+            if not (isinstance(value, str) and value) and not isinstance(value, dict):
+                raise DeltaError(f"Invalid insert: {op!r:.100}")
+        elif isinstance(value, bool) or not isinstance(value, int) or value <= 0:
+            raise DeltaError(f"Invalid {kind} length: {op!r:.100}")
+        if 'attributes' in op and (kind == 'delete' or not isinstance(op['attributes'], dict)):
+            raise DeltaError(f"Invalid attributes: {op!r:.100}")
+    return ops
+
+
+class _OpIterator:
+    """
+    Walks a delta in pieces of a given length, splitting ops as needed.
+    """
+
+    def __init__(self, ops: List[Dict[str, Any]]):
+        self.ops = ops
+        self.index = 0
+        self.offset = 0
+
+    def has_next(self) -> bool:
+        return self.index < len(self.ops)
+
+    def peek_length(self) -> float:
+        if self.index < len(self.ops):
+            return op_length(self.ops[self.index]) - self.offset
+        return math.inf
+
+    def peek_type(self) -> str:
+        if self.index < len(self.ops):
+            op = self.ops[self.index]
+            return 'delete' if 'delete' in op else 'retain' if 'retain' in op else 'insert'
+        return 'retain'
+
+    def next(self, length: float = math.inf) -> Dict[str, Any]:
+        if self.index >= len(self.ops):
+            # past the end, a delta keeps everything
+            return {'retain': math.inf}
+        op = self.ops[self.index]
+        offset = self.offset
+        remaining = op_length(op) - offset
+        if length >= remaining:
+            length = remaining
+            self.index += 1
+            self.offset = 0
+        else:
+            self.offset += length
+        if 'delete' in op:
+            return {'delete': length}
+        piece = {}
+        if 'retain' in op:
+            piece['retain'] = length
+        elif isinstance(op['insert'], str):
+            piece['insert'] = _text_slice(op['insert'], offset, length)
+        else:
+            piece['insert'] = op['insert']
+        if op.get('attributes'):
+            piece['attributes'] = op['attributes']
+        return piece
+
+
+def _push(ops: List[Dict[str, Any]], op: Dict[str, Any]) -> None:
+    """
+    Append an op, merging it with the previous one where possible. An insert goes before a delete at the same place,
+    which keeps deltas in their canonical form.
+    """
+    index = len(ops)
+    last = ops[-1] if ops else None
+    if last is not None:
+        if 'delete' in op and 'delete' in last:
+            ops[-1] = {'delete': last['delete'] + op['delete']}
+            return
+        if 'delete' in last and 'insert' in op:
+            index -= 1
+            last = ops[index - 1] if index > 0 else None
+            if last is None:
+                ops.insert(0, op)
+                return
+        if last.get('attributes') == op.get('attributes'):
+            if isinstance(last.get('insert'), str) and isinstance(op.get('insert'), str):
+                ops[index - 1] = {**last, 'insert': last['insert'] + op['insert']}
+                return
+            if 'retain' in last and 'retain' in op:
+                ops[index - 1] = {**last, 'retain': last['retain'] + op['retain']}
+                return
+    ops.insert(index, op)
+
+
+def _compose_attributes(a: Optional[Dict[str, Any]], b: Optional[Dict[str, Any]],
+                        keep_null: bool) -> Optional[Dict[str, Any]]:
+    attributes = {**(a or {}), **(b or {})}
+    if not keep_null:
+        # a null attribute removes a format; on an insert there is nothing left to remove
+        attributes = {key: value for key, value in attributes.items() if value is not None}
+    return attributes or None
+
+
+def compose(a: List[Dict[str, Any]], b: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Compose two deltas: the result has the effect of applying `a`, then `b`.
+
+    :param a: The first delta, e.g. a document
+    :param b: The delta applied after it, e.g. an edit of the document
+    :return: The ops of the composed delta
+    """
+    this, other = _OpIterator(a), _OpIterator(b)
+    ops: List[Dict[str, Any]] = []
+    while this.has_next() or other.has_next():
+        if other.peek_type() == 'insert':
+            _push(ops, other.next())
+        elif this.peek_type() == 'delete':
+            _push(ops, this.next())
+        else:
+            length = min(this.peek_length(), other.peek_length())
+            this_op, other_op = this.next(length), other.next(length)
+            if 'retain' in other_op:
+                new_op = {'retain': length} if 'retain' in this_op else {'insert': this_op['insert']}
+                attributes = _compose_attributes(this_op.get('attributes'), other_op.get('attributes'),
+                                                 keep_null='retain' in this_op)
+                if attributes:
+                    new_op['attributes'] = attributes
+                _push(ops, new_op)
+            elif 'retain' in this_op:
+                _push(ops, other_op)
+            # an insert of `a` deleted by `b` leaves nothing
+    # a trailing retain without formats changes nothing
+    if ops and 'retain' in ops[-1] and not ops[-1].get('attributes'):
+        ops.pop()
+    return ops
+
+
+def apply_change(document: List[Dict[str, Any]], change: List[Dict[str, Any]],
+                 length: Optional[int] = None) -> Tuple[List[Dict[str, Any]], int]:
+    """
+    Apply an edit to a document.
+
+    :param document: The ops of the document
+    :param change: The ops of the edit
+    :param length: The length of the document, if known
+    :return: The ops of the edited document and its length
+    :raises DeltaError: If the edit is malformed or retains or deletes past the end of the document
+    """
+    length = change_length(change, document_length(document) if length is None else length)
+    return compose(document, change), length
+
+
+def change_length(change: List[Dict[str, Any]], length: int) -> int:
+    """
+    Get the length of a document after an edit, checking that the edit fits it.
+
+    :param change: The ops of the edit
+    :param length: The length of the document before the edit
+    :return: The length after the edit
+    :raises DeltaError: If the edit is malformed or retains or deletes past the end of the document
+    """
+    check_ops(change)
+    consumed = sum(op_length(op) for op in change if 'insert' not in op)
+    if consumed > length:
+        raise DeltaError(f"The edit spans {consumed} characters of a document of {length}")
+    deleted = sum(op['delete'] for op in change if 'delete' in op)
+    inserted = sum(op_length(op) for op in change if 'insert' in op)
+    return length - deleted + inserted
+
+
+def _safe_url(url: Any, schemes: Tuple[str, ...], image: bool = False) -> Optional[str]:
+    """
+    :return: The URL if it has one of `schemes` (or, for an image, is an image data URL), otherwise None
+    """
+    if not isinstance(url, str):
+        return None
+    # browsers ignore surrounding whitespace and drop tabs and newlines, so 'java\tscript:' is a javascript: URL
+    url = re.sub(r'[\t\n\r]', '', url.strip())
+    if any(ord(char) < 0x20 for char in url):
+        return None
+    if image and IMAGE_DATA_URL.match(url):
+        return url
+    scheme = URL_SCHEME.match(url)
+    return url if scheme and scheme.group(1).lower() in schemes else None
+
+
+def _inline_html(op: Dict[str, Any]) -> str:
+    attributes = op.get('attributes') or {}
+    value = op['insert']
+    if isinstance(value, dict):
+        src = _safe_url(value.get('image'), IMAGE_SCHEMES, image=True)
+        return f'<img src="{html.escape(src)}">' if src else ''
+    text = html.escape(value)
+    for attribute, tag in INLINE_TAGS:
+        if attributes.get(attribute):
+            text = f'<{tag}>{text}</{tag}>'
+    href = _safe_url(attributes.get('link'), LINK_SCHEMES)
+    if href:
+        text = f'<a href="{html.escape(href)}">{text}</a>'
+    return text
+
+
+def _lines(ops: List[Dict[str, Any]]):
+    """
+    Split a document into lines: the HTML of their content and the attributes of the newline ending them.
+    """
+    parts: List[str] = []
+    for op in ops:
+        value = op.get('insert')
+        if not isinstance(value, str):
+            if value is not None:
+                parts.append(_inline_html(op))
+            continue
+        pieces = value.split('\n')
+        for index, piece in enumerate(pieces):
+            if piece:
+                parts.append(_inline_html({**op, 'insert': piece}))
+            if index < len(pieces) - 1:
+                yield ''.join(parts), op.get('attributes') or {}
+                parts = []
+    if parts:
+        yield ''.join(parts), {}
+
+
+def to_html(ops: List[Dict[str, Any]]) -> str:
+    """
+    Render a document as HTML, one block element per line.
+
+    :param ops: The ops of the document
+    :return: HTML
+    """
+    blocks = []
+    open_list = None
+    for content, attributes in _lines(ops):
+        content = content or '<br>'
+        list_tag = LIST_TAGS.get(attributes.get('list'))
+        if list_tag != open_list:
+            if open_list:
+                blocks.append(f'</{open_list}>')
+            if list_tag:
+                blocks.append(f'<{list_tag}>')
+            open_list = list_tag
+        header = attributes.get('header')
+        if list_tag:
+            blocks.append(f'<li>{content}</li>')
+        elif isinstance(header, int) and 1 <= header <= 6:
+            blocks.append(f'<h{header}>{content}</h{header}>')
+        elif attributes.get('blockquote'):
+            blocks.append(f'<blockquote>{content}</blockquote>')
+        elif attributes.get('code-block'):
+            blocks.append(f'<pre>{content}</pre>')
+        else:
+            blocks.append(f'<p>{content}</p>')
+    if open_list:
+        blocks.append(f'</{open_list}>')
+    return ''.join(blocks)
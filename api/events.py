@@ -0,0 +1,191 @@
+from typing import Any, Callable, Dict, Iterable, List, Optional
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
+import logging
+import threading
+import time
+
+from api.models import Content
+
+"""
+events.py
+
+This module turns committed content writes into compact change events and hands them to subscribers, e.g. the
+Socket.IO push in `app.py`. An event describes one content item:
+
+    {'id': 12, 'content_type': 'note', 'op': 'updated', 'fields': ['title', 'time_modified'], 'change_seq': 40}
+
+where `op` is 'created', 'updated' or 'deleted' (soft deletes included) and `fields` lists the changed columns of an
+update. Clients fetch the rows themselves from `/changes`.
+
+Events are collected per transaction in `session.info`: Content instances written by a flush are picked up by an
+`after_flush` hook, and the bulk `query.update()` paths in `database.py` call `record` for the rows they touch. Events
+for the same item within a transaction are merged, and the batch is published after the commit (and dropped on a
+rollback), so subscribers never hear about writes that did not happen.
+
+`ChangeBatcher` coalesces the published events over a short interval and sends them in batches, so a sync that writes
+thousands of rows produces a handful of messages rather than one per row.
+"""
+
+logger = logging.getLogger(__name__)
+
+EVENTS_KEY = 'content_events'
+# columns that change on every write and carry no information for clients
+UNREPORTED_FIELDS = ('change_seq',)
+
+Listener = Callable[[List[Dict[str, Any]]], None]
+_listeners: List[Listener] = []
+
+
+def subscribe(listener: Listener) -> None:
+    """
+    Register a callable that receives the events of every committed transaction.
+
+    :param listener: Called with the list of events; it runs in the committing thread and should return quickly
+    """
+    _listeners.append(listener)
+
+
+def unsubscribe(listener: Listener) -> None:
+    if listener in _listeners:
+        _listeners.remove(listener)
+
+
+def merge_event(pending: Dict[int, Dict[str, Any]], change: Dict[str, Any]) -> None:
+    """
+    Fold an event into the pending events of the same item, keyed by content id.
+
+    :param pending: The pending events, updated in place
+    :param change: The new event
+    """
+    current = pending.get(change['id'])
+    if current is None:
+        pending[change['id']] = dict(change)
+        return
+    merged = {**current, **change}
+    if current['op'] == 'created' and change['op'] == 'updated':
+        # still new to anyone who has not seen it yet
+        merged['op'] = 'created'
+    if merged['op'] == 'updated':
+        merged['fields'] = sorted(set(current.get('fields') or []) | set(change.get('fields') or []))
+    else:
+        merged.pop('fields', None)
+    pending[change['id']] = merged
+
+
+def record(session: Session, content_id: int, content_type: Optional[str], op: str,
+           fields: Optional[Iterable[str]] = None, change_seq: Optional[int] = None) -> None:
+    """
+    Add an event to the session's transaction, to be published once it commits.
+
+    :param session: The session the write happens in
+    :param content_id: The id of the written content item
+    :param content_type: Its content type
+    :param op: 'created', 'updated' or 'deleted'
+    :param fields: The changed columns, for updates
+    :param change_seq: The change sequence the write stamped on the row
+    """
+    change = {'id': content_id, 'content_type': content_type, 'op': op, 'change_seq': change_seq}
+    if op == 'updated':
+        change['fields'] = sorted(set(fields or []) - set(UNREPORTED_FIELDS))
+    merge_event(session.info.setdefault(EVENTS_KEY, {}), change)
+
+
+def _changed_fields(obj: Content) -> List[str]:
+    # get_history rather than inspect().attrs, which memoizes a reference cycle on every instance state
+    return [column.key for column in Content.__table__.columns if get_history(obj, column.key).has_changes()]
+
+
+@event.listens_for(Session, 'after_flush')
+def _record_flushed_content(session: Session, flush_context) -> None:
+    for obj in session.new:
+        if isinstance(obj, Content):
+            record(session, obj.id, obj.content_type, 'created', change_seq=obj.change_seq)
+    for obj in session.dirty:
+        if isinstance(obj, Content) and session.is_modified(obj):
+            op = 'deleted' if obj.deleted and get_history(obj, 'deleted').has_changes() else 'updated'
+            record(session, obj.id, obj.content_type, op, _changed_fields(obj), obj.change_seq)
+    for obj in session.deleted:
+        if isinstance(obj, Content):
+            record(session, obj.id, obj.content_type, 'deleted', change_seq=obj.change_seq)
+
+
+@event.listens_for(Session, 'after_commit')
+def _publish_committed(session: Session) -> None:
+    pending = session.info.pop(EVENTS_KEY, None)
+    if not pending:
+        return
+    changes = list(pending.values())
+    for listener in list(_listeners):
+        try:
+            listener(changes)
+        except Exception:
+            # the write is committed; a failing subscriber must not turn it into an error
+            logger.exception("Change listener %r failed", listener)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _drop_rolled_back(session: Session) -> None:
+    session.info.pop(EVENTS_KEY, None)
+
+
+def _start_thread(task: Callable[[], None]) -> None:
+    threading.Thread(target=task, daemon=True).start()
+
+
+class ChangeBatcher:
+    """
+    Coalesce change events over a short interval and send them in batches.
+
+    The first event after an idle period schedules a flush `interval` seconds later; events arriving until then are
+    merged per content item. A flush sends the pending events in batches of at most `max_batch`.
+    """
+
+    def __init__(self, send: Callable[[Dict[str, Any]], None], interval: float = 0.25, max_batch: int = 500,
+                 start_task: Callable[[Callable[[], None]], Any] = _start_thread, sleep: Callable[[float], None] = time.sleep):
+        """
+        :param send: Called with each batch, {'changes': [...]}
+        :param interval: How long to collect events before sending them, in seconds
+        :param max_batch: The maximum number of events per batch
+        :param start_task: Runs a callable in the background, e.g. `socketio.start_background_task`
+        :param sleep: Sleeps in a way that suits `start_task`, e.g. `socketio.sleep`
+        """
+        self.send = send
+        self.interval = interval
+        self.max_batch = max_batch
+        self.start_task = start_task
+        self.sleep = sleep
+        self._pending: Dict[int, Dict[str, Any]] = {}
+        self._scheduled = False
+        self._lock = threading.Lock()
+
+    def add(self, changes: List[Dict[str, Any]]) -> None:
+        """
+        Queue events for the next batch. Usable as a `subscribe` listener.
+        """
+        with self._lock:
+            for change in changes:
+                merge_event(self._pending, change)
+            if self._scheduled:
+                return
+            self._scheduled = True
+        self.start_task(self._flush_later)
+
+    def _flush_later(self) -> None:
+        self.sleep(self.interval)
+        self.flush()
+
+    def flush(self) -> None:
+        """
+        Send all pending events now.
+        """
+        with self._lock:
+            pending, self._pending = list(self._pending.values()), {}
+            self._scheduled = False
+        pending.sort(key=lambda change: (change.get('change_seq') or 0, change['id']))
+        for i in range(0, len(pending), self.max_batch):
+            try:
+                self.send({'changes': pending[i:i + self.max_batch]})
+            except Exception:
+                logger.exception("Sending %d change events failed", len(pending[i:i + self.max_batch]))
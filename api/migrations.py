@@ -0,0 +1,302 @@
+from typing import Callable, Dict, List, Optional, Tuple
+from sqlalchemy import inspect, select
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.sql import Select
+import os
+import sys
+
+if __name__ == "__main__":
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from api import search
+from api.models import Base, ChatMessage, Content, LibraryState, NoteRevision, SyncState, CONTENT_FTS_DDL
+
+"""
+migrations.py
+
+This module keeps the schema of `locus.db` in step with `models.py`. The schema version is stored in SQLite's
+`PRAGMA user_version`. A new database is created from the models and stamped with the latest version; an existing
+database is upgraded in place by running every migration newer than its stored version, in order.
+
+Migrations are plain functions registered with the `@migration(version)` decorator. Each one must be idempotent
+(`IF NOT EXISTS`, guarded data fixes). SQLite's DDL is transactional, but Python's sqlite3 driver only opens a
+transaction before the first data change, so DDL that runs ahead of it is committed at once, and an upgrade that fails
+later re-runs those migrations on the next start. A database created with `create_all` before it was versioned may
+also have some of a migration's tables and columns already.
+
+The module also contains a query-plan check: `check_query_plans` runs `EXPLAIN QUERY PLAN` over the hot queries
+defined in `database.py` and reports every one that scans a table or index instead of searching it.
+
+Usage:
+    python -m api.migrations [database_url] [--check]
+"""
+
+MIGRATIONS: List[Tuple[int, Callable[[Connection], None]]] = []
+
+# Index scans that check_query_plans accepts, per hot query.
+ALLOWED_SCANS: Dict[str, List[str]] = {
+    # ORDER BY change_seq DESC LIMIT 1: the scan walks the index from its end and stops at the first row
+    'latest_change': ['SCAN content USING COVERING INDEX ix_content_change_seq'],
+}
+
+
+def migration(version: int) -> Callable:
+    """
+    Register a migration function under the given schema version.
+
+    :param version: The schema version the database is at after the migration has run
+    :return: The decorator
+    """
+    def register(func: Callable[[Connection], None]) -> Callable[[Connection], None]:
+        MIGRATIONS.append((version, func))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return func
+    return register
+
+
+@migration(1)
+def add_hot_path_indexes(conn: Connection) -> None:
+    """
+    Merge duplicate authors and add the secondary indexes used by the listing and sync queries.
+    """
+    duplicates = conn.exec_driver_sql(
+        "SELECT MIN(id), first_name, last_name FROM authors GROUP BY last_name, first_name HAVING COUNT(*) > 1"
+    ).all()
+    # IS rather than =, so that names stored as NULL by an old release are merged too
+    for keep_id, first_name, last_name in duplicates:
+        params = (keep_id, first_name, last_name)
+        conn.exec_driver_sql(
+            "UPDATE content_authors SET author_id = ? WHERE author_id IN "
+            "(SELECT id FROM authors WHERE first_name IS ? AND last_name IS ?)", params
+        )
+        conn.exec_driver_sql(
+            "UPDATE authors SET user_id = (SELECT MAX(user_id) FROM authors WHERE first_name IS ? AND last_name IS ?) "
+            "WHERE id = ?", (first_name, last_name, keep_id)
+        )
+        conn.exec_driver_sql(
+            "DELETE FROM authors WHERE id != ? AND first_name IS ? AND last_name IS ?", params
+        )
+    if duplicates:
+        # an item linked to two of the merged authors now has the same link twice
+        conn.exec_driver_sql(
+            "DELETE FROM content_authors WHERE rowid NOT IN "
+            "(SELECT MIN(rowid) FROM content_authors GROUP BY content_id, author_id)"
+        )
+    conn.exec_driver_sql("CREATE UNIQUE INDEX IF NOT EXISTS ix_authors_last_first ON authors (last_name, first_name)")
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_content_deleted_type_modified ON content (deleted, content_type, time_modified)"
+    )
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_content_type_modified ON content (content_type, time_modified)")
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_content_authors_content_id ON content_authors (content_id)")
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_content_authors_author_id ON content_authors (author_id)")
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_group_content_content_id ON group_content (content_id)")
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_content_association_content_id2 ON content_association (content_id2)"
+    )
+
+
+@migration(2)
+def add_content_page_index(conn: Connection) -> None:
+    """
+    Add the index that serves the keyset-paginated content listing in time_modified order.
+    """
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_content_deleted_modified ON content (deleted, time_modified, id)"
+    )
+
+
+@migration(3)
+def add_content_search_index(conn: Connection) -> None:
+    """
+    Create the full-text index over content and fill it from the existing rows.
+    """
+    conn.exec_driver_sql(CONTENT_FTS_DDL)
+    search.reindex(conn, note_edits=False)
+
+
+@migration(4)
+def move_chat_messages_to_table(conn: Connection) -> None:
+    """
+    Move chat transcripts out of content_metadata['chat']['messages'] into the append-only chat_messages table.
+    """
+    ChatMessage.__table__.create(conn, checkfirst=True)
+    chat_table = Content.__table__
+    chats = conn.execute(
+        select(chat_table.c.id, chat_table.c.content_metadata).where(chat_table.c.content_type == 'chat')
+    ).all()
+    moved = []
+    for chat_id, content_metadata in chats:
+        chat = (content_metadata or {}).get('chat', {})
+        if 'messages' not in chat:
+            continue
+        # a crash after a partial copy re-runs this chat from scratch
+        conn.execute(ChatMessage.__table__.delete().where(ChatMessage.__table__.c.chat_id == chat_id))
+        rows = [{'chat_id': chat_id, 'seq': seq, 'role': m.get('role', 'user'), 'content': m.get('content') or ''}
+                for seq, m in enumerate(chat['messages'], start=1)]
+        if rows:
+            conn.execute(ChatMessage.__table__.insert(), rows)
+        remaining = {k: v for k, v in chat.items() if k != 'messages'}
+        conn.execute(chat_table.update().where(chat_table.c.id == chat_id)
+                     .values(content_metadata={**content_metadata, 'chat': remaining}))
+        moved.append(chat_id)
+    search.reindex(conn, moved, note_edits=False)
+
+
+@migration(5)
+def add_library_state(conn: Connection) -> None:
+    """
+    Create the single-row table holding the library's change counter.
+    """
+    # the after_create hook inserts the row
+    LibraryState.__table__.create(conn, checkfirst=True)
+
+
+@migration(6)
+def add_content_change_seq(conn: Connection) -> None:
+    """
+    Add the change sequence behind the change feed. Existing rows start at 0, i.e. before any feed cursor.
+    """
+    if 'change_seq' not in {column['name'] for column in inspect(conn).get_columns('content')}:
+        conn.exec_driver_sql("ALTER TABLE content ADD COLUMN change_seq INTEGER NOT NULL DEFAULT 0")
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_content_change_seq ON content (change_seq, id)")
+
+
+@migration(7)
+def add_sync_state(conn: Connection) -> None:
+    """
+    Create the single-row table holding the Zotero sync checkpoint.
+    """
+    SyncState.__table__.create(conn, checkfirst=True)
+
+
+@migration(8)
+def move_zotero_version_to_sync_state(conn: Connection) -> None:
+    """
+    Keep the synced Zotero library version in `sync_state` instead of the `zotero_version` table, which grew by one
+    row per sync. The newest stored version is carried over.
+    """
+    columns = {column['name'] for column in inspect(conn).get_columns('sync_state')}
+    if 'library_version' not in columns:
+        conn.exec_driver_sql("ALTER TABLE sync_state ADD COLUMN library_version INTEGER")
+    if 'synced_at' not in columns:
+        conn.exec_driver_sql("ALTER TABLE sync_state ADD COLUMN synced_at DATETIME")
+    if inspect(conn).has_table('zotero_version'):
+        latest = conn.exec_driver_sql(
+            "SELECT version, timestamp FROM zotero_version ORDER BY timestamp DESC LIMIT 1").first()
+        if latest is not None:
+            conn.exec_driver_sql("UPDATE sync_state SET library_version = ?, synced_at = ? WHERE id = 1", tuple(latest))
+        conn.exec_driver_sql("DROP TABLE zotero_version")
+
+
+@migration(9)
+def add_content_zotero_dirty(conn: Connection) -> None:
+    """
+    Add the flag that queues local changes for upload to Zotero. Notes that were never uploaded are queued.
+    """
+    if 'zotero_dirty' not in {column['name'] for column in inspect(conn).get_columns('content')}:
+        conn.exec_driver_sql("ALTER TABLE content ADD COLUMN zotero_dirty BOOLEAN NOT NULL DEFAULT 0")
+        conn.exec_driver_sql("UPDATE content SET zotero_dirty = 1 "
+                             "WHERE content_type = 'note' AND zotero_key IS NULL AND deleted = 0")
+    conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_content_zotero_dirty ON content (id) WHERE zotero_dirty = 1")
+
+
+@migration(10)
+def add_note_revisions(conn: Connection) -> None:
+    """
+    Add the revision counter of notes and the table of their incremental edits. Stored notes are at revision 0.
+    """
+    if 'revision' not in {column['name'] for column in inspect(conn).get_columns('content')}:
+        conn.exec_driver_sql("ALTER TABLE content ADD COLUMN revision INTEGER NOT NULL DEFAULT 0")
+    NoteRevision.__table__.create(conn, checkfirst=True)
+
+
+def latest_version() -> int:
+    """
+    Get the schema version the models correspond to.
+
+    :return: The highest registered migration version
+    """
+    return MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+
+def current_version(conn: Connection) -> int:
+    """
+    Get the schema version stored in the database.
+
+    :param conn: An open connection to the database
+    :return: The stored schema version; 0 for a new or never-migrated database
+    """
+    return conn.exec_driver_sql("PRAGMA user_version").scalar()
+
+
+def _set_version(conn: Connection, version: int) -> None:
+    # PRAGMA does not accept bound parameters
+    conn.exec_driver_sql(f"PRAGMA user_version = {int(version)}")
+
+
+def upgrade(engine: Engine) -> int:
+    """
+    Create or upgrade the database schema to the latest version.
+
+    :param engine: The engine of the database to upgrade
+    :return: The schema version after the upgrade
+    """
+    with engine.begin() as conn:
+        if not inspect(conn).has_table('content'):
+            Base.metadata.create_all(conn)
+            _set_version(conn, latest_version())
+            return latest_version()
+
+        version = current_version(conn)
+        for target, func in MIGRATIONS:
+            if target > version:
+                func(conn)
+                _set_version(conn, target)
+                version = target
+        # tables added to the models after the database was created
+        Base.metadata.create_all(conn)
+    return version
+
+
+def explain_query_plan(conn: Connection, statement: Select) -> List[str]:
+    """
+    Get the `EXPLAIN QUERY PLAN` details for a statement.
+
+    :param conn: An open connection to the database
+    :param statement: The statement to explain
+    :return: The detail column of every plan row
+    """
+    compiled = statement.compile(dialect=conn.dialect, compile_kwargs={"literal_binds": True})
+    return [row[3] for row in conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {compiled}")]
+
+
+def check_query_plans(engine: Engine, queries: Optional[Dict[str, Select]] = None) -> Dict[str, List[str]]:
+    """
+    Find hot queries that scan a table or index. Only `SEARCH` plan rows pass, and the scans in `ALLOWED_SCANS`.
+
+    :param engine: The engine of the database to check
+    :param queries: The statements to check, keyed by name; defaults to `database.hot_queries()`
+    :return: The scan plan rows of every offending query, keyed by name; empty if all queries search an index
+    """
+    if queries is None:
+        from api.database import hot_queries
+        queries = hot_queries()
+    full_scans = {}
+    with engine.connect() as conn:
+        for name, statement in queries.items():
+            scans = [detail for detail in explain_query_plan(conn, statement)
+                     if detail.startswith('SCAN') and detail not in ALLOWED_SCANS.get(name, [])]
+            if scans:
+                full_scans[name] = scans
+    return full_scans
+
+
+if __name__ == "__main__":
+    from sqlalchemy import create_engine
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    engine = create_engine(args[0] if args else "sqlite:///locus.db")
+    print(f"Schema version: {upgrade(engine)}")
+    if '--check' in sys.argv:
+        full_scans = check_query_plans(engine)
+        for name, scans in full_scans.items():
+            print(f"Scan in {name}: {'; '.join(scans)}")
+        sys.exit(1 if full_scans else 0)
@@ -1,6 +1,7 @@
-from sqlalchemy import Column, Integer, String, Text, Boolean, ForeignKey, DateTime, Table, JSON, Enum
+from sqlalchemy import Column, Integer, String, Text, Boolean, ForeignKey, DateTime, Table, JSON, Enum, Index, DDL, event, text
 from sqlalchemy.orm import relationship, declarative_base
 from datetime import datetime
+import enum
 from werkzeug.security import generate_password_hash, check_password_hash
 
 
@@ -11,7 +12,9 @@ content_authors = Table(
     'content_authors',
     Base.metadata,
     Column('content_id', Integer, ForeignKey('content.id')),
-    Column('author_id', Integer, ForeignKey('authors.id'))
+    Column('author_id', Integer, ForeignKey('authors.id')),
+    Index('ix_content_authors_content_id', 'content_id'),
+    Index('ix_content_authors_author_id', 'author_id'),
 )
 
 # Association table for relationiships between content items, e.g. a paper and a chat transcript and a note
@@ -19,14 +22,16 @@ content_association = Table(
     'content_association',
     Base.metadata,
     Column('content_id1', Integer, ForeignKey('content.id'), primary_key=True),
-    Column('content_id2', Integer, ForeignKey('content.id'), primary_key=True)
+    Column('content_id2', Integer, ForeignKey('content.id'), primary_key=True),
+    Index('ix_content_association_content_id2', 'content_id2'),
 )
 
 GroupContent = Table(
     'group_content',
     Base.metadata,
     Column('group_id', Integer, ForeignKey('groups.id'), primary_key=True),
-    Column('content_id', Integer, ForeignKey('content.id'), primary_key=True)
+    Column('content_id', Integer, ForeignKey('content.id'), primary_key=True),
+    Index('ix_group_content_content_id', 'content_id'),
 )
 
 
@@ -39,6 +44,10 @@ class Author(Base):
     user_id = Column(Integer, ForeignKey('users.id'), nullable=True)
     user = relationship('User', back_populates='author', uselist=False)
 
+    __table_args__ = (
+        # name lookups during sync are index seeks, and the same person is stored once
+        Index('ix_authors_last_first', 'last_name', 'first_name', unique=True),
+    )
 
     def __repr__(self):
         return f"<Creator(id={self.id}, content_id={self.content_id}, creator_type='{self.creator_type}', name='{self.name}')>"
@@ -102,7 +111,25 @@ class Content(Base):
     time_created = Column(DateTime, default=datetime.utcnow)
     time_modified = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     deleted = Column(Boolean, default=False)
-    
+    # library version of the last write to the row, for the change feed (see database.get_changes)
+    change_seq = Column(Integer, nullable=False, default=0)
+    # changed locally since it was last uploaded to Zotero (see zotero_sync.upload_dirty_content)
+    zotero_dirty = Column(Boolean, nullable=False, default=False)
+    # revision of the note document in content_metadata; later edits are in note_revisions (see database.save_note_edit)
+    revision = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        # listing filters: active items, optionally by type, newest first
+        Index('ix_content_deleted_type_modified', 'deleted', 'content_type', 'time_modified'),
+        # highlights and chats are listed by type regardless of the deleted flag
+        Index('ix_content_type_modified', 'content_type', 'time_modified'),
+        # keyset pagination over the unfiltered listing
+        Index('ix_content_deleted_modified', 'deleted', 'time_modified', 'id'),
+        # the change feed, in write order
+        Index('ix_content_change_seq', 'change_seq', 'id'),
+        # the upload queue; partial, so it only holds the few rows waiting for an upload
+        Index('ix_content_zotero_dirty', 'id', sqlite_where=text('zotero_dirty = 1')),
+    )
 
     # Many-to-many relationship with the Authors table
     authors = relationship('Author', secondary=content_authors, back_populates='contents')
@@ -120,26 +147,98 @@ class Content(Base):
     def __repr__(self):
         return f"<Content(id={self.id}, title='{self.title}', content_type='{self.content_type}')>"
     
+    # keys of to_dict(), in output order
+    DICT_FIELDS = ('id', 'zotero_key', 'zotero_version', 'content_metadata', 'title', 'content_type', 'filename',
+                   'summary', 'tags', 'time_created', 'time_modified', 'deleted', 'change_seq', 'revision', 'authors',
+                   'groups')
+
+    def to_dict(self, fields=None):
+        """
+        Serialize the content item, optionally restricted to a subset of DICT_FIELDS.
+        """
+        data = {}
+        for field in fields or self.DICT_FIELDS:
+            if field == 'authors':
+                data['authors'] = [author.to_dict() for author in self.authors]
+            elif field == 'groups':
+                data['groups'] = [group.to_dict() for group in self.groups]
+            else:
+                data[field] = getattr(self, field)
+            # 'related_content': [related.to_dict() for related in self.related_content],
+        return data
+
+# Full-text index over content (see search.py). It is an FTS5 virtual table, so it is created with raw DDL alongside
+# the mapped tables; its rowid is the content id.
+CONTENT_FTS_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS content_fts "
+    "USING fts5(title, summary, tags, body, tokenize = 'unicode61 remove_diacritics 2')"
+)
+event.listen(Base.metadata, 'after_create', DDL(CONTENT_FTS_DDL).execute_if(dialect='sqlite'))
+event.listen(Base.metadata, 'before_drop', DDL("DROP TABLE IF EXISTS content_fts").execute_if(dialect='sqlite'))
+
+class NoteRevision(Base):
+    """
+    One incremental edit of a note: the delta ops that turn the previous revision into this one. The edits after a
+    note's snapshot (Content.content_metadata, at Content.revision) are kept until the next snapshot replaces them.
+    """
+    __tablename__ = 'note_revisions'
+    id = Column(Integer, primary_key=True)
+    content_id = Column(Integer, ForeignKey('content.id'), nullable=False)
+    revision = Column(Integer, nullable=False)
+    ops = Column(JSON, nullable=False)
+    # length of the document after the edit, so the next edit can be checked without composing the document
+    length = Column(Integer, nullable=False)
+    time_created = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        # one writer per revision; a concurrent edit of the same base fails on this index
+        Index('ix_note_revisions_content_revision', 'content_id', 'revision', unique=True),
+    )
+
+    def __repr__(self):
+        return f"<NoteRevision(content_id={self.content_id}, revision={self.revision})>"
+
+class ChatMessage(Base):
+    """
+    One message of a chat transcript. Messages are append-only; seq numbers them from 1 within their chat.
+    """
+    __tablename__ = 'chat_messages'
+    id = Column(Integer, primary_key=True)
+    chat_id = Column(Integer, ForeignKey('content.id'), nullable=False)
+    seq = Column(Integer, nullable=False)
+    role = Column(String(20), nullable=False) # user, assistant, system
+    content = Column(Text, nullable=False, default='')
+    time_created = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index('ix_chat_messages_chat_seq', 'chat_id', 'seq', unique=True),
+    )
+
+    def __repr__(self):
+        return f"<ChatMessage(chat_id={self.chat_id}, seq={self.seq}, role='{self.role}')>"
+
     def to_dict(self):
         return {
-            'id': self.id,
-            'zotero_key': self.zotero_key,
-            'zotero_version': self.zotero_version,
-            'content_metadata': self.content_metadata,
-            'title': self.title,
-            'content_type': self.content_type,
-            'filename': self.filename,
-            'summary': self.summary,
-            'tags': self.tags,
-            'time_created': self.time_created,
-            'time_modified': self.time_modified,
-            'deleted': self.deleted,
-            'authors': [author.to_dict() for author in self.authors],
-            'groups': [group.to_dict() for group in self.groups],
-            # 'related_content': [related.to_dict() for related in self.related_content],
+            'seq': self.seq,
+            'role': self.role,
+            'content': self.content,
         }
 
-class GroupType(Enum):
+# Full-text index over chat messages (see search.py). It reads the text from chat_messages (external content), and
+# triggers keep it in step with the append-only table.
+CHAT_MESSAGE_FTS_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS chat_message_fts USING fts5(content, content = 'chat_messages', "
+    "content_rowid = 'id', tokenize = 'unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS chat_messages_after_insert AFTER INSERT ON chat_messages BEGIN "
+    "INSERT INTO chat_message_fts (rowid, content) VALUES (new.id, new.content); END",
+    "CREATE TRIGGER IF NOT EXISTS chat_messages_after_delete AFTER DELETE ON chat_messages BEGIN "
+    "INSERT INTO chat_message_fts (chat_message_fts, rowid, content) VALUES ('delete', old.id, old.content); END",
+)
+for statement in CHAT_MESSAGE_FTS_DDL:
+    event.listen(ChatMessage.__table__, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+event.listen(ChatMessage.__table__, 'before_drop', DDL("DROP TABLE IF EXISTS chat_message_fts").execute_if(dialect='sqlite'))
+
+class GroupType(enum.Enum):
     BASE_GROUP = 'base_group'
     FOLIO = 'folio'
 
@@ -147,7 +246,7 @@ class Group(Base):
     __tablename__ = 'groups'
     id = Column(Integer, primary_key=True)
     name = Column(String(200), nullable=False)
-    group_type = Column(GroupType, nullable=False)
+    group_type = Column(Enum(GroupType, values_callable=lambda members: [m.value for m in members]), nullable=False)
     # Many-to-many relationship with the Content table
     content_items = relationship('Content', secondary=GroupContent, back_populates='groups')
 
@@ -164,9 +263,40 @@ class Group(Base):
 
 
 
-class ZoteroVersion(Base):
-    __tablename__ = 'zotero_version'
+
+class SyncState(Base):
+    """
+    Single-row table holding the state of the Zotero download: the library version the last complete sync reached,
+    which the next sync fetches changes since, and, while a sync is in progress, a checkpoint: the position after the
+    last committed page, so an interrupted sync resumes from there (see `zotero_sync.py`).
+    """
+    __tablename__ = 'sync_state'
 
     id = Column(Integer, primary_key=True)
-    version = Column(Integer, nullable=False)
-    timestamp = Column(DateTime, nullable=False)
\ No newline at end of file
+    library_version = Column(Integer, nullable=True)  # None until the first complete sync
+    synced_at = Column(DateTime, nullable=True)  # when library_version was stored
+    checkpoint_collection = Column(String(50), nullable=True)  # None when no sync is in progress
+    checkpoint_since = Column(Integer, nullable=True)  # the version the sync fetches changes since; None for a full sync
+    checkpoint_version = Column(Integer, nullable=True)  # the library version the first page was read at
+    checkpoint_start = Column(Integer, nullable=True)  # offset of the first page not committed yet
+
+    def __repr__(self):
+        return f"<SyncState(library_version={self.library_version}, checkpoint_collection={self.checkpoint_collection}, checkpoint_start={self.checkpoint_start})>"
+
+event.listen(SyncState.__table__, 'after_create', DDL("INSERT INTO sync_state (id) VALUES (1)"))
+
+
+class LibraryState(Base):
+    """
+    Single-row table holding the library's change counter. Every write through the ORM session bumps `version` in the
+    same transaction (see `database.py`), so readers can tell whether anything changed without looking at the data.
+    """
+    __tablename__ = 'library_state'
+
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f"<LibraryState(version={self.version})>"
+
+event.listen(LibraryState.__table__, 'after_create', DDL("INSERT INTO library_state (id, version) VALUES (1, 0)"))
@@ -0,0 +1,250 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, Optional, Union
+import atexit
+import logging
+import os
+import tempfile
+import threading
+
+"""
+note_store.py
+
+This module stores the files of notes edited in the app. A note's file is named after its content id, e.g.
+`note-42.html`, so two notes with the same title never share a file, and a renamed note keeps its file.
+
+Files are written with `write_atomic`: the text goes to a temporary file in the same directory, which is fsynced and
+then renamed over the old file. A reader (`/attachment`, the Zotero upload) therefore sees either the previous version
+or the new one, never a truncated file.
+
+`NoteStore.save` does not write on the caller's thread. It records the text as the note's pending version and leaves
+the write to a background worker, which writes the note NOTE_WRITE_DELAY seconds after the first save that made it
+pending. Further saves in that window only replace the pending text, so an editor autosaving every few keystrokes
+costs one write per window instead of one per save. Until its write is done, `NoteStore.pending` returns the text, and
+`NoteStore.flush` writes it at once; pending notes are flushed when the process exits. A write that fails keeps the
+text pending and is tried again NOTE_WRITE_RETRY_DELAY seconds later. Instead of the text, a save can pass a function
+that renders it, e.g. from a note's current delta; it is called once, when the file is written, so a burst of
+incremental edits costs one rendering. The note's delta is stored in the database with every save, so a pending file
+lost in a crash is the rendering of a version the database has.
+
+Configuration:
+- NOTE_WRITE_DELAY: the seconds a note's write waits for further saves of the same note (default 0.5)
+- NOTE_WRITE_RETRY_DELAY: the seconds before a failed write is tried again (default 5)
+"""
+
+logger = logging.getLogger(__name__)
+
+CONTENT_FILE_PATH = os.getenv("CONTENT_FILE_PATH")
+NOTE_WRITE_DELAY = float(os.getenv("NOTE_WRITE_DELAY", 0.5))
+NOTE_WRITE_RETRY_DELAY = float(os.getenv("NOTE_WRITE_RETRY_DELAY", 5))
+NOTE_FORMATS = ('html', 'delta')
+
+
+def note_filename(content_id: int, storage_fmt: str = 'html') -> str:
+    """
+    Get the name of the file a note is stored in.
+
+    :param content_id: The id of the note
+    :param storage_fmt: 'html' or 'delta'
+    :return: The filename, relative to the storage directory
+    """
+    if storage_fmt not in NOTE_FORMATS:
+        raise ValueError("storage_fmt must be 'html' or 'delta'")
+    return f'note-{content_id}.{storage_fmt}'
+
+
+def _fsync_directory(directory: str) -> None:
+    # makes a rename in the directory durable; directories cannot be opened for this on Windows
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def write_atomic(path: str, text: str) -> None:
+    """
+    Replace a file with new text, so that readers see the old or the new content but never a partial file.
+
+    :param path: The path of the file
+    :param text: The new content
+    """
+    directory = os.path.dirname(path) or '.'
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=f'.{os.path.basename(path)}.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            if hasattr(os, 'fchmod'):
+                # mkstemp creates the file readable by its owner only
+                os.fchmod(f.fileno(), 0o644)
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    _fsync_directory(directory)
+
+
+class NoteStore:
+    """
+    Write-behind storage of note files in a directory, with one pending version per note.
+    """
+
+    def __init__(self, directory: str, delay: float = NOTE_WRITE_DELAY, retry_delay: float = NOTE_WRITE_RETRY_DELAY):
+        """
+        :param directory: The directory the files are stored in
+        :param delay: The seconds a note's write waits for further saves of it
+        :param retry_delay: The seconds before a failed write is tried again
+        """
+        self.directory = directory
+        self.delay = delay
+        self.retry_delay = retry_delay
+        self._closed = False
+        # one worker, so the writes of a note happen in the order they were scheduled
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='note-store')
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        # filename -> the latest text (or its renderer) saved and not yet written
+        self._pending: Dict[str, Union[str, Callable[[], str]]] = {}
+        # filename -> the timer of its scheduled write, until the write is handed to the worker
+        self._timers: Dict[str, threading.Timer] = {}
+        # filenames with a write handed to the worker that has not started
+        self._queued = set()
+        self._counts = {'saves': 0, 'writes': 0, 'coalesced': 0, 'errors': 0}
+
+    def save(self, content_id: int, text: Union[str, Callable[[], str]], storage_fmt: str = 'html') -> str:
+        """
+        Save a version of a note; its file is written in the background.
+
+        :param content_id: The id of the note
+        :param text: The content of the file, or a function that renders it
+        :param storage_fmt: 'html' or 'delta'
+        :return: The filename the note is stored under
+        """
+        filename = note_filename(content_id, storage_fmt)
+        with self._lock:
+            self._counts['saves'] += 1
+            if filename in self._pending:
+                self._counts['coalesced'] += 1
+            self._pending[filename] = text
+            self._schedule_locked(filename, self.delay)
+        return filename
+
+    def pending(self, filename: str) -> Optional[str]:
+        """
+        :return: The text saved for a file that is not written yet, or None if the file is up to date
+        """
+        with self._lock:
+            text = self._pending.get(filename)
+        return text() if callable(text) else text
+
+    def read(self, filename: str) -> Optional[str]:
+        """
+        Read the latest version of a note: the pending text, or the content of its file.
+
+        :return: The text, or None if there is no such note
+        """
+        text = self.pending(filename)
+        if text is not None:
+            return text
+        try:
+            with open(os.path.join(self.directory, filename), encoding='utf-8') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def flush(self, filenames: Optional[Iterable[str]] = None) -> None:
+        """
+        Write pending notes now, on the calling thread, instead of after their delay.
+
+        :param filenames: The files to write; all pending files if None
+        """
+        with self._lock:
+            filenames = [filename for filename in (self._pending if filenames is None else filenames)
+                         if filename in self._pending]
+            for filename in filenames:
+                timer = self._timers.pop(filename, None)
+                if timer is not None:
+                    timer.cancel()
+        for filename in filenames:
+            self._write(filename)
+
+    def close(self) -> None:
+        """
+        Write every pending note and stop the worker. Notes whose write fails stay unwritten.
+        """
+        self.flush()
+        with self._lock:
+            self._closed = True
+            for timer in self._timers.values():
+                timer.cancel()
+            self._timers.clear()
+        self._executor.shutdown(wait=True)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        :return: The number of saves, file writes, saves coalesced into a later write, failed writes and notes pending
+        """
+        with self._lock:
+            return {**self._counts, 'pending': len(self._pending)}
+
+    def _schedule_locked(self, filename: str, delay: float) -> None:
+        # a write that is scheduled or queued already writes the latest text
+        if self._closed or filename in self._timers or filename in self._queued:
+            return
+        if delay > 0:
+            timer = threading.Timer(delay, self._submit, (filename,))
+            timer.daemon = True
+            self._timers[filename] = timer
+            timer.start()
+        else:
+            self._submit_locked(filename)
+
+    def _submit(self, filename: str) -> None:
+        with self._lock:
+            if filename in self._timers and filename not in self._queued:
+                self._submit_locked(filename)
+
+    def _submit_locked(self, filename: str) -> None:
+        self._timers.pop(filename, None)
+        self._queued.add(filename)
+        self._executor.submit(self._write, filename)
+
+    def _write(self, filename: str) -> None:
+        # the latest text is taken under the write lock, so a later write never stores an older version
+        with self._write_lock:
+            with self._lock:
+                self._queued.discard(filename)
+                text = self._pending.get(filename)
+            if text is None:
+                return
+            try:
+                write_atomic(os.path.join(self.directory, filename), text() if callable(text) else text)
+                written = True
+            except Exception:
+                # the file keeps its previous version, and the text stays pending until a retry writes it
+                logger.exception("Writing note file %s failed; retrying in %ss", filename, self.retry_delay)
+                written = False
+            with self._lock:
+                if not written:
+                    self._counts['errors'] += 1
+                    self._schedule_locked(filename, self.retry_delay)
+                    return
+                self._counts['writes'] += 1
+                # a save during the write left newer text, with a write scheduled for it
+                if self._pending.get(filename) is text:
+                    del self._pending[filename]
+
+
+# the store of the app's notes, if it stores files
+note_store: Optional[NoteStore] = NoteStore(CONTENT_FILE_PATH) if CONTENT_FILE_PATH else None
+if note_store is not None:
+    atexit.register(note_store.flush)
@@ -0,0 +1,262 @@
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from sqlalchemy import DateTime, bindparam, event, select, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import get_history
+import html
+import json
+import re
+
+from api import delta
+from api.models import Content, NoteRevision
+
+"""
+search.py
+
+This module maintains the SQLite FTS5 index `content_fts` (created with the schema, see `models.py`) and runs ranked
+full-text queries against it. Each content item has one row in the index, keyed by its id, with four columns:
+
+- title, summary and tags, copied from the content row;
+- body, the text that only lives inside `content_metadata`: the inserts of a saved Quill delta (notes and summaries)
+  or the text of a highlight. A note's body includes the edits saved since its snapshot (see
+  `database.save_note_edit`).
+
+Chat messages live in their own table and are indexed by `chat_message_fts`, which SQLite triggers maintain (see
+`models.py`); `search` merges hits from both indexes per content item.
+
+The index is kept up to date incrementally: an `after_flush` hook re-indexes every Content instance that was added
+or had a searchable attribute changed in the flush, and the bulk `query.update()` / `query.delete()` paths in
+`database.py` call `reindex` / `remove` for the ids they touch. Notes written by a flush are re-indexed with `reindex`
+too, which composes their outstanding edits. Soft-deleted rows stay in the index and are filtered
+out at query time.
+"""
+
+SEARCHABLE_ATTRIBUTES = ('title', 'summary', 'tags', 'content_metadata', 'content_type')
+# bm25 weights for title, summary, tags and body
+RANK_WEIGHTS = (10.0, 2.0, 4.0, 1.0)
+HIGHLIGHT_OPEN = '<mark>'
+HIGHLIGHT_CLOSE = '</mark>'
+# FTS5 marks matches with these; the text is HTML-escaped before they become HIGHLIGHT_OPEN and HIGHLIGHT_CLOSE
+MATCH_OPEN = '\x02'
+MATCH_CLOSE = '\x03'
+INDEX_CHUNK_SIZE = 500
+
+
+def document_body(content_type: str, content_metadata: Any) -> str:
+    """
+    Extract the searchable text stored inside content_metadata.
+
+    :param content_type: The content type of the item
+    :param content_metadata: The item's content_metadata, as a dict or as a JSON string
+    :return: The text to index in the body column
+    """
+    if isinstance(content_metadata, str):
+        try:
+            content_metadata = json.loads(content_metadata)
+        except ValueError:
+            return content_metadata
+    if not isinstance(content_metadata, dict):
+        return ''
+    if content_type == 'chat':
+        # transcripts from before the chat_messages table; current chats keep only highlights here
+        messages = content_metadata.get('chat', {}).get('messages', [])
+        return '\n'.join(m.get('content') or '' for m in messages)
+    if 'ops' in content_metadata:
+        # a Quill delta; embeds (images, formulas) are dicts and carry no text
+        return ''.join(op['insert'] for op in content_metadata['ops'] if isinstance(op.get('insert'), str))
+    if content_type == 'highlight':
+        return content_metadata.get('text') or ''
+    return ''
+
+
+def document_row(content_id: int, title: str, summary: str, tags: str, content_type: str, content_metadata: Any) -> Dict[str, Any]:
+    """
+    Build the index row for a content item.
+    """
+    return {
+        'id': content_id,
+        'title': title or '',
+        'summary': summary or '',
+        'tags': (tags or '').replace(',', ' '),
+        'body': document_body(content_type, content_metadata),
+    }
+
+
+def index_rows(conn: Connection, rows: List[Dict[str, Any]]) -> None:
+    """
+    Replace the index rows of the given documents.
+
+    :param conn: The connection (inside the writing transaction) to use
+    :param rows: Rows built by `document_row`
+    """
+    if not rows:
+        return
+    remove(conn, [row['id'] for row in rows])
+    conn.execute(
+        text("INSERT INTO content_fts (rowid, title, summary, tags, body) VALUES (:id, :title, :summary, :tags, :body)"),
+        rows,
+    )
+
+
+def remove(conn: Connection, content_ids: Iterable[int]) -> None:
+    """
+    Remove content items from the index.
+    """
+    ids = list(content_ids)
+    for i in range(0, len(ids), INDEX_CHUNK_SIZE):
+        chunk = ids[i:i + INDEX_CHUNK_SIZE]
+        conn.execute(text("DELETE FROM content_fts WHERE rowid IN :ids").bindparams(bindparam('ids', expanding=True)),
+                     {'ids': chunk})
+
+
+def reindex(conn: Connection, content_ids: Optional[Iterable[int]] = None, note_edits: bool = True) -> int:
+    """
+    Rebuild the index rows of the given content items from the content table.
+
+    :param conn: The connection (inside the writing transaction) to use
+    :param content_ids: The ids to re-index; all content if None
+    :param note_edits: Whether to include the edits of notes; False in migrations that run before the note_revisions
+                       table exists
+    :return: The number of indexed items
+    """
+    if content_ids is None:
+        conn.exec_driver_sql("DELETE FROM content_fts")
+        ids = conn.exec_driver_sql("SELECT id FROM content").scalars().all()
+    else:
+        ids = list(content_ids)
+    indexed = 0
+    for i in range(0, len(ids), INDEX_CHUNK_SIZE):
+        chunk = ids[i:i + INDEX_CHUNK_SIZE]
+        result = conn.execute(
+            select(Content.id, Content.title, Content.summary, Content.tags, Content.content_type, Content.content_metadata)
+            .where(Content.id.in_(chunk))
+        ).all()
+        rows = [document_row(*row) for row in (_with_note_edits(conn, result) if note_edits else result)]
+        index_rows(conn, rows)
+        indexed += len(rows)
+    return indexed
+
+
+def _with_note_edits(conn: Connection, rows: List[Any]) -> List[Tuple]:
+    """
+    Compose the edits saved since their snapshots into the documents of the notes among content rows.
+    """
+    note_ids = [row.id for row in rows if row.content_type == 'note']
+    if not note_ids:
+        return rows
+    edits: Dict[int, List[list]] = {}
+    for content_id, ops in conn.execute(select(NoteRevision.content_id, NoteRevision.ops)
+                                        .where(NoteRevision.content_id.in_(note_ids))
+                                        .order_by(NoteRevision.content_id, NoteRevision.revision)):
+        edits.setdefault(content_id, []).append(ops)
+    composed = []
+    for row in rows:
+        if row.id in edits:
+            ops = delta.snapshot_ops(row.content_metadata)
+            for change in edits[row.id]:
+                ops = delta.compose(ops, change)
+            row = (*row[:5], {'ops': ops})
+        composed.append(row)
+    return composed
+
+
+@event.listens_for(Session, 'after_flush')
+def _index_flushed_content(session: Session, flush_context) -> None:
+    """
+    Re-index the Content instances written by a flush, and drop the ones it deleted.
+    """
+    rows = []
+    note_ids = []
+    for obj in list(session.new) + list(session.dirty):
+        if not isinstance(obj, Content):
+            continue
+        if obj in session.new or any(get_history(obj, name).has_changes() for name in SEARCHABLE_ATTRIBUTES):
+            if obj.content_type == 'note' and obj not in session.new:
+                # it may have edits saved since its snapshot
+                note_ids.append(obj.id)
+            else:
+                rows.append(document_row(obj.id, obj.title, obj.summary, obj.tags, obj.content_type, obj.content_metadata))
+    deleted_ids = [obj.id for obj in session.deleted if isinstance(obj, Content)]
+    if rows or note_ids or deleted_ids:
+        conn = session.connection()
+        remove(conn, deleted_ids)
+        index_rows(conn, rows)
+        reindex(conn, note_ids)
+
+
+def to_match_query(query: str) -> Optional[str]:
+    """
+    Turn free text into an FTS5 MATCH expression: every word must match, and the last word matches as a prefix so
+    results update while the user types.
+
+    :param query: The text entered by the user
+    :return: The MATCH expression, or None if the text contains no words
+    """
+    words = re.findall(r'\w+', query)
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += '*'
+    return ' '.join(terms)
+
+
+def _marked_html(marked: Optional[str]) -> Optional[str]:
+    """
+    Turn text with FTS5 match markers into HTML, escaping the text itself.
+    """
+    if marked is None:
+        return None
+    return html.escape(marked, quote=False).replace(MATCH_OPEN, HIGHLIGHT_OPEN).replace(MATCH_CLOSE, HIGHLIGHT_CLOSE)
+
+
+def search(conn: Connection, query: str, limit: int = 20, offset: int = 0,
+           content_type: Optional[str] = None) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+    """
+    Run a ranked full-text query over active content.
+
+    :param conn: The connection to use
+    :param query: The text entered by the user
+    :param limit: The page size
+    :param offset: The number of results to skip
+    :param content_type: Only return content of this type
+    :return: The page of results, best match first, and the offset of the next page (None if this is the last page).
+             Each result has the content's id, title, content_type, zotero_key, filename and time_modified, its
+             rank, and the title and a snippet of the best matching column as HTML, with matches in <mark> tags.
+    """
+    match = to_match_query(query)
+    if match is None:
+        return [], None
+    weights = ', '.join(str(w) for w in RANK_WEIGHTS)
+    # chat messages have their own index; a chat ranks by its best hit across both
+    sql = f"""
+        SELECT content.id, content.title, content.content_type, content.zotero_key, content.filename,
+               content.time_modified, hits.rank, COALESCE(hits.title_highlight, content.title) AS title_highlight,
+               hits.snippet
+        FROM (
+            SELECT content_id, MIN(rank) AS rank, title_highlight, snippet FROM (
+                SELECT rowid AS content_id, bm25(content_fts, {weights}) AS rank,
+                       highlight(content_fts, 0, :open, :close) AS title_highlight,
+                       snippet(content_fts, -1, :open, :close, '…', 16) AS snippet
+                FROM content_fts WHERE content_fts MATCH :match
+                UNION ALL
+                SELECT chat_messages.chat_id, bm25(chat_message_fts) * {RANK_WEIGHTS[-1]}, NULL,
+                       snippet(chat_message_fts, 0, :open, :close, '…', 16)
+                FROM chat_message_fts JOIN chat_messages ON chat_messages.id = chat_message_fts.rowid
+                WHERE chat_message_fts MATCH :match
+            ) GROUP BY content_id
+        ) AS hits JOIN content ON content.id = hits.content_id
+        WHERE content.deleted = 0
+        {"AND content.content_type = :content_type" if content_type else ""}
+        ORDER BY hits.rank
+        LIMIT :limit OFFSET :offset
+    """
+    # one extra row tells whether there is a next page
+    params = {'match': match, 'open': MATCH_OPEN, 'close': MATCH_CLOSE, 'limit': limit + 1, 'offset': offset}
+    if content_type:
+        params['content_type'] = content_type
+    results = [dict(row) for row in conn.execute(text(sql).columns(time_modified=DateTime), params).mappings()]
+    for result in results:
+        result['title_highlight'] = _marked_html(result['title_highlight'])
+        result['snippet'] = _marked_html(result['snippet'])
+    next_offset = offset + limit if len(results) > limit else None
+    return results[:limit], next_offset
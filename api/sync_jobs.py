@@ -0,0 +1,168 @@
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+import logging
+import threading
+import time
+import uuid
+
+"""
+sync_jobs.py
+
+This module runs Zotero syncs in the background, so `POST /sync` can return at once instead of holding a worker for
+the whole round trip. `SyncRunner.start` starts a job and returns it; while a job is queued or running, further calls
+return that same job (single flight), so concurrent requests and the periodic sync never run two syncs at once.
+
+A job reports its progress as it goes: the pages fetched, the items read out of the total, the items upserted and an
+estimate of the remaining time. Every change of a job is handed to a `publish` callable, e.g. a Socket.IO emit:
+
+    {'id': '3f2a...', 'status': 'running', 'progress': {'pages': 3, 'items': 300, 'total': 1200, 'upserted': 12,
+     'eta_seconds': 4.5}, 'version': None, 'error': None, 'queued_at': ..., 'started_at': ..., 'finished_at': None}
+
+`status` is 'queued', 'running', 'succeeded' or 'failed'; `version` is the library version a successful sync read.
+"""
+
+logger = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+ACTIVE_STATUSES = (QUEUED, RUNNING)
+# finished jobs kept for lookups by id
+JOB_HISTORY = 20
+
+
+class SyncJob:
+    def __init__(self, trigger: str = 'manual'):
+        self.id = uuid.uuid4().hex
+        self.trigger = trigger
+        self.status = QUEUED
+        self.progress: Dict[str, Any] = {'pages': 0, 'items': 0, 'total': None, 'upserted': 0, 'eta_seconds': None}
+        self.version: Optional[int] = None
+        self.error: Optional[str] = None
+        self.queued_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    @property
+    def active(self) -> bool:
+        return self.status in ACTIVE_STATUSES
+
+    def update_progress(self, progress: Dict[str, int]) -> None:
+        """
+        Record a progress report of `sync_zotero_down` and estimate the remaining time from the rate so far.
+
+        :param progress: The pages fetched, items read, total items, items upserted and the offset the sync started
+                         at, i.e. the items read by an interrupted run it resumed
+        """
+        self.progress.update({key: progress[key] for key in ('pages', 'items', 'total', 'upserted')})
+        elapsed = time.time() - self.started_at
+        done = progress['items'] - progress.get('start', 0)
+        remaining = max(0, progress['total'] - progress['items'])
+        self.progress['eta_seconds'] = round(elapsed / done * remaining, 1) if done > 0 else None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'id': self.id,
+            'trigger': self.trigger,
+            'status': self.status,
+            'progress': dict(self.progress),
+            'version': self.version,
+            'error': self.error,
+            'queued_at': self.queued_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+
+
+def _start_thread(task: Callable[[], None]) -> None:
+    threading.Thread(target=task, daemon=True).start()
+
+
+class SyncRunner:
+    """
+    Run sync jobs in the background, one at a time.
+    """
+
+    def __init__(self, run_sync: Callable[[Callable[[Dict[str, int]], None]], int],
+                 publish: Callable[[Dict[str, Any]], None] = lambda job: None,
+                 start_task: Callable[[Callable[[], None]], Any] = _start_thread,
+                 sleep: Callable[[float], None] = time.sleep):
+        """
+        :param run_sync: Runs a sync, calling the progress callable it is given, and returns the library version
+        :param publish: Called with the job dict whenever a job changes
+        :param start_task: Runs a callable in the background, e.g. `socketio.start_background_task`
+        :param sleep: Sleeps in a way that suits `start_task`, e.g. `socketio.sleep`
+        """
+        self.run_sync = run_sync
+        self.publish = publish
+        self.start_task = start_task
+        self.sleep = sleep
+        self._jobs: 'OrderedDict[str, SyncJob]' = OrderedDict()
+        self._current: Optional[SyncJob] = None
+        self._lock = threading.Lock()
+
+    def start(self, trigger: str = 'manual') -> SyncJob:
+        """
+        Start a sync job, or join the one that is already queued or running.
+
+        :param trigger: What started the job, e.g. 'manual' or 'periodic'
+        :return: The job
+        """
+        with self._lock:
+            if self._current is not None and self._current.active:
+                return self._current
+            job = SyncJob(trigger)
+            self._current = job
+            self._jobs[job.id] = job
+            while len(self._jobs) > JOB_HISTORY:
+                self._jobs.popitem(last=False)
+        self._publish(job)
+        self.start_task(lambda: self._run(job))
+        return job
+
+    def get(self, job_id: str) -> Optional[SyncJob]:
+        return self._jobs.get(job_id)
+
+    @property
+    def current(self) -> Optional[SyncJob]:
+        return self._current
+
+    def _publish(self, job: SyncJob) -> None:
+        try:
+            self.publish(job.to_dict())
+        except Exception:
+            logger.exception("Publishing sync job %s failed", job.id)
+
+    def _run(self, job: SyncJob) -> None:
+        job.status = RUNNING
+        job.started_at = time.time()
+        self._publish(job)
+
+        def progress(report: Dict[str, int]) -> None:
+            job.update_progress(report)
+            self._publish(job)
+
+        try:
+            job.version = self.run_sync(progress)
+            job.status = SUCCEEDED
+            job.progress['eta_seconds'] = 0
+        except Exception as e:
+            logger.exception("Sync job %s failed", job.id)
+            job.status = FAILED
+            job.error = str(e)
+        job.finished_at = time.time()
+        self._publish(job)
+
+    def start_periodic(self, interval: float) -> None:
+        """
+        Start an incremental sync every `interval` seconds in the background. A sync that is still running when the
+        next one is due is joined rather than started again.
+
+        :param interval: The time between syncs, in seconds
+        """
+        def loop():
+            while True:
+                self.sleep(interval)
+                self.start('periodic')
+        self.start_task(loop)
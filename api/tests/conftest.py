@@ -0,0 +1,30 @@
+import os
+import pytest
+
+# The database module builds its engine at import time, so the in-memory switch has to happen before collection.
+os.environ.setdefault("TESTING", "1")
+
+
+@pytest.fixture
+def db():
+    # a fresh schema in the test database, dropped after the test
+    from api import database
+    from api.models import Base
+    Base.metadata.create_all(database.engine)
+    yield
+    Base.metadata.drop_all(database.engine)
+
+
+@pytest.fixture
+def zotero_stub(monkeypatch):
+    from api.tests.zotero_stub import ZoteroStub
+    from api import zotero_http
+    stub = ZoteroStub().start()
+    monkeypatch.setattr(zotero_http, "ZOTERO_API_URL", stub.url)
+    # a fresh governor per test, with short retry delays
+    monkeypatch.setattr(zotero_http, "governor", zotero_http.RequestGovernor(base_delay=0.01))
+    yield stub
+    # shared clients and cached collection keys belong to this stub's library
+    zotero_http.close_clients()
+    zotero_http.collection_keys.clear()
+    stub.stop()
@@ -0,0 +1,160 @@
+import hashlib
+import os
+import pytest
+from flask import Flask
+
+from api import database
+from api.attachments import (PARTIAL_DIR, AttachmentError, AttachmentStore, prefetch_collection_attachments,
+                             send_attachment, store_precompressed)
+from api.tests.zotero_stub import API_KEY, USER_ID
+from api.zotero_http import get_client
+from api.zotero_sync import sync_zotero_down
+
+PDF = b"%PDF-1.4\n" + bytes(range(256)) * 1000
+
+
+@pytest.fixture
+def store(zotero_stub, tmp_path):
+    return AttachmentStore(get_client(USER_ID, API_KEY), str(tmp_path), chunk_size=4096)
+
+
+def stored_files(path):
+    return sorted(name for name in os.listdir(path) if name != PARTIAL_DIR)
+
+
+def test_download_is_stored_by_content_hash(zotero_stub, store, tmp_path):
+    collection = zotero_stub.add_collection("locus")
+    paper = zotero_stub.add_item(collection, "Paper")
+    zotero_stub.add_attachment(collection, paper["key"], "Paper.PDF", PDF)
+
+    attachment, name = store.download_item(paper["key"])
+
+    assert name == hashlib.sha256(PDF).hexdigest() + ".pdf"
+    assert (tmp_path / name).read_bytes() == PDF
+    assert os.listdir(tmp_path / PARTIAL_DIR) == []
+
+
+def test_duplicate_files_are_stored_once(zotero_stub, store, tmp_path):
+    collection = zotero_stub.add_collection("locus")
+    first = zotero_stub.add_attachment(collection, "P1", "a.pdf", PDF)
+    second = zotero_stub.add_attachment(collection, "P2", "same paper.pdf", PDF)
+
+    assert store.download(first) == store.download(second)
+    assert len(stored_files(tmp_path)) == 1
+
+
+def test_interrupted_download_resumes(zotero_stub, store, tmp_path):
+    collection = zotero_stub.add_collection("locus")
+    attachment = zotero_stub.add_attachment(collection, "P1", "paper.pdf", PDF)
+    os.makedirs(tmp_path / PARTIAL_DIR)
+    (tmp_path / PARTIAL_DIR / f"{attachment['key']}.part").write_bytes(PDF[:100000])
+
+    name = store.download(attachment)
+
+    assert zotero_stub.ranges == ["bytes=100000-"]
+    assert (tmp_path / name).read_bytes() == PDF
+
+
+def test_corrupt_download_is_discarded(zotero_stub, store, tmp_path):
+    collection = zotero_stub.add_collection("locus")
+    attachment = zotero_stub.add_attachment(collection, "P1", "paper.pdf", PDF)
+    zotero_stub.files[attachment["key"]] = PDF[:-1] + b"!"
+
+    with pytest.raises(AttachmentError):
+        store.download(attachment)
+    assert stored_files(tmp_path) == []
+    assert os.listdir(tmp_path / PARTIAL_DIR) == []
+
+
+def test_prefetch_collection_fills_in_filenames(db, zotero_stub, tmp_path):
+    collection = zotero_stub.add_collection("locus")
+    papers = [zotero_stub.add_item(collection, f"Paper {i}") for i in range(12)]
+    for i, paper in enumerate(papers[:10]):
+        zotero_stub.add_attachment(collection, paper["key"], f"paper {i}.pdf", PDF + str(i).encode())
+    zotero_stub.add_attachment(collection, papers[10]["key"], "snapshot.html", b"<html></html>", content_type="text/html")
+    sync_zotero_down(API_KEY, USER_ID, "locus")
+    zotero_stub.latency = 0.02
+
+    counts = prefetch_collection_attachments(API_KEY, USER_ID, "locus", str(tmp_path), workers=4)
+
+    assert counts == {"downloaded": 10, "failed": 0, "no_attachment": 2}
+    assert 1 < zotero_stub.max_in_flight <= 4
+    assert len(stored_files(tmp_path)) == 10
+    filenames = {item.zotero_key: item.filename for item in database.get_content_list()}
+    assert filenames[papers[3]["key"]] == hashlib.sha256(PDF + b"3").hexdigest() + ".pdf"
+    assert filenames[papers[11]["key"]] is None
+    # entries with a file are not fetched again
+    assert prefetch_collection_attachments(API_KEY, USER_ID, "locus", str(tmp_path))["downloaded"] == 0
+
+
+def test_sync_keeps_prefetched_filenames(db, zotero_stub, tmp_path):
+    collection = zotero_stub.add_collection("locus")
+    paper = zotero_stub.add_item(collection, "Paper")
+    zotero_stub.add_attachment(collection, paper["key"], "paper.pdf", PDF)
+    sync_zotero_down(API_KEY, USER_ID, "locus")
+    prefetch_collection_attachments(API_KEY, USER_ID, "locus", str(tmp_path))
+
+    zotero_stub.update_item(paper["key"], title="Paper, revised")
+    sync_zotero_down(API_KEY, USER_ID, "locus")
+
+    entry = next(item for item in database.get_content_list() if item.zotero_key == paper["key"])
+    assert entry.title == "Paper, revised"
+    assert entry.filename == hashlib.sha256(PDF).hexdigest() + ".pdf"
+
+
+@pytest.fixture
+def serve(tmp_path):
+    app = Flask(__name__)
+
+    @app.route("/attachment/<filename>")
+    def get_attachment(filename):
+        return send_attachment(str(tmp_path), filename)
+    return app.test_client()
+
+
+def test_content_addressed_files_are_immutable_and_seekable(serve, tmp_path):
+    name = hashlib.sha256(PDF).hexdigest() + ".pdf"
+    (tmp_path / name).write_bytes(PDF)
+
+    response = serve.get(f"/attachment/{name}")
+    assert response.get_data() == PDF
+    assert response.headers["ETag"] == f'"{hashlib.sha256(PDF).hexdigest()}"'
+    assert response.cache_control.immutable and response.cache_control.max_age == 365 * 24 * 60 * 60
+
+    part = serve.get(f"/attachment/{name}", headers={"Range": "bytes=1000-1999"})
+    assert part.status_code == 206
+    assert part.get_data() == PDF[1000:2000]
+    assert part.headers["Content-Range"] == f"bytes 1000-1999/{len(PDF)}"
+
+    assert serve.get(f"/attachment/{name}", headers={"If-None-Match": response.headers["ETag"]}).status_code == 304
+    assert serve.get(f"/attachment/{name}", headers={"Range": f"bytes={len(PDF)}-"}).status_code == 416
+
+
+def test_legacy_files_are_revalidated(serve, tmp_path):
+    (tmp_path / "paper.pdf").write_bytes(PDF)
+
+    response = serve.get("/attachment/paper.pdf")
+    assert response.headers["ETag"] == f'"{hashlib.sha256(PDF).hexdigest()}"'
+    assert response.cache_control.no_cache and not response.cache_control.immutable
+    assert serve.get("/attachment/../secret").status_code == 404
+
+
+def test_precompressed_variant_is_served_to_whole_file_requests(serve, tmp_path):
+    text = b"%PDF-1.4\n" + b"BT /F1 12 Tf (uncompressed page text) Tj ET\n" * 5000
+    name = hashlib.sha256(text).hexdigest() + ".pdf"
+    (tmp_path / name).write_bytes(text)
+    assert store_precompressed(str(tmp_path / name)) is not None
+    # a file that does not compress gets no variant
+    (tmp_path / "random.bin").write_bytes(os.urandom(4096))
+    assert store_precompressed(str(tmp_path / "random.bin")) is None
+
+    response = serve.get(f"/attachment/{name}", headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["Vary"] == "Accept-Encoding"
+    assert len(response.get_data()) < len(text) / 10
+    assert response.headers["ETag"].endswith('-gzip"')
+
+    part = serve.get(f"/attachment/{name}", headers={"Accept-Encoding": "gzip", "Range": "bytes=0-99"})
+    assert "Content-Encoding" not in part.headers
+    assert part.get_data() == text[:100]
+    assert serve.get(f"/attachment/{name}").get_data() == text
@@ -0,0 +1,74 @@
+import pytest
+from flask import Flask, jsonify
+
+from api.cache import ResponseCache, cached_response
+
+
+def test_entries_are_scoped_to_the_library_version():
+    cache = ResponseCache()
+    cache.put("/content", 1, b"[1]", "application/json")
+
+    assert cache.get("/content", 1).body == b"[1]"
+    assert cache.get("/content", 2) is None
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_least_recently_used_entries_are_evicted():
+    cache = ResponseCache(max_entries=2, max_bytes=10)
+    cache.put("/a", 1, b"aaaa", "application/json")
+    cache.put("/b", 1, b"bbbb", "application/json")
+    cache.get("/a", 1)
+    cache.put("/c", 1, b"cccc", "application/json")
+
+    assert cache.get("/b", 1) is None
+    assert cache.get("/a", 1) is not None
+    # the byte bound evicts as well
+    cache.put("/d", 1, b"dddddddd", "application/json")
+    assert cache.stats()["entries"] == 1
+    assert cache.stats()["bytes"] == 8
+    assert cache.stats()["evictions"] == 3
+
+
+@pytest.fixture
+def client():
+    app = Flask(__name__)
+    cache = ResponseCache()
+    state = {"version": 1, "calls": 0}
+
+    @app.route("/items")
+    @cached_response(cache, lambda: state["version"])
+    def items():
+        state["calls"] += 1
+        return jsonify([state["version"]])
+
+    app.config["cache"] = cache
+    app.config["state"] = state
+    return app.test_client()
+
+
+def test_responses_are_cached_until_the_version_changes(client):
+    state = client.application.config["state"]
+    first = client.get("/items")
+    second = client.get("/items")
+    assert first.get_data() == second.get_data()
+    assert first.headers["ETag"] == second.headers["ETag"]
+    assert state["calls"] == 1
+
+    state["version"] = 2
+    third = client.get("/items")
+    assert third.get_json() == [2]
+    assert third.headers["ETag"] != first.headers["ETag"]
+    assert state["calls"] == 2
+
+
+def test_matching_etag_gets_not_modified(client):
+    etag = client.get("/items").headers["ETag"]
+
+    response = client.get("/items", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.get_data() == b""
+    assert client.application.config["cache"].stats()["not_modified"] == 1
+
+    client.application.config["state"]["version"] = 2
+    assert client.get("/items", headers={"If-None-Match": etag}).status_code == 200
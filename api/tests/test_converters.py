@@ -0,0 +1,74 @@
+import copy
+import json
+
+from api.converters import ConversionReport, convert_zotero_items, zotero2Dict
+
+
+def zotero_item(key: str, title: str = "Attention Is All You Need", item_type: str = "journalArticle", **data) -> dict:
+    # parsed from JSON, so strings are not shared between items as in an API response
+    return json.loads(json.dumps({
+        "key": key,
+        "version": 7,
+        "links": {"self": {"href": f"https://api.zotero.org/users/1/items/{key}"}},
+        "data": {"key": key, "version": 7, "itemType": item_type, "title": title, "abstractNote": "Transformers.",
+                 "creators": [{"creatorType": "author", "firstName": "Ashish", "lastName": "Vaswani"}],
+                 "tags": [{"tag": "nlp"}, {"tag": "attention"}], **data},
+    }))
+
+
+def test_items_are_not_changed():
+    items = [zotero_item("AAAA0001", creators=[{"creatorType": "author", "name": "Google Research"}]),
+             zotero_item("AAAA0002", "Full Text PDF", "attachment", filename="paper.pdf")]
+    before = copy.deepcopy(items)
+
+    records = list(convert_zotero_items(items))
+
+    assert items == before
+    entry, attachment = records
+    assert entry["content_type"] == "zotero_entry"
+    assert entry["content_metadata"]["links"] == items[0]["links"]
+    assert entry["content_metadata"]["filename"] is None
+    assert "filename" not in entry
+    assert entry["tags"] == "nlp,attention"
+    assert attachment["content_type"] == "zotero_attachment"
+    assert attachment["summary"] == "attachment for Full Text PDF"
+    assert attachment["filename"] == "paper.pdf"
+
+
+def test_creator_names_are_split_and_interned():
+    items = [zotero_item(f"AAAA000{i}", creators=[
+        {"creatorType": "author", "firstName": "Ashish", "lastName": "Vaswani"},
+        {"creatorType": "author", "name": "Google Research"},
+        {"creatorType": "editor", "name": "UNESCO"},
+    ]) for i in range(2)]
+
+    first, second = convert_zotero_items(items)
+
+    assert first["authors"] == [{"first_name": "Ashish", "last_name": "Vaswani"},
+                                {"first_name": "", "last_name": "Google Research"},
+                                {"first_name": "", "last_name": "UNESCO"}]
+    assert first["authors"][0]["last_name"] is second["authors"][0]["last_name"]
+    assert first["authors"][2]["last_name"] is second["authors"][2]["last_name"]
+    assert first["content_metadata"]["itemType"] is second["content_metadata"]["itemType"]
+
+
+def test_problems_are_reported_instead_of_printed(capsys):
+    report = ConversionReport()
+    items = [zotero_item("AAAA0001", title=""), {"key": "AAAA0002"},
+             zotero_item("AAAA0003", creators=[{"creatorType": "author", "firstName": "", "lastName": ""}]),
+             zotero_item("AAAA0004")]
+
+    records = list(convert_zotero_items(items, report))
+
+    assert [record["zotero_key"] for record in records] == ["AAAA0001", "AAAA0003", "AAAA0004"]
+    assert (report.converted, report.skipped) == (3, 1)
+    assert report.counts() == {"empty title": 1, "malformed item": 1, "unnamed creator": 1}
+    assert [problem.key for problem in report.problems] == ["AAAA0001", "AAAA0002", "AAAA0003"]
+    assert capsys.readouterr().out == ""
+
+
+def test_zotero2Dict_converts_one_item():
+    item = zotero_item("AAAA0001")
+
+    assert zotero2Dict(item) == next(convert_zotero_items([item]))
+    assert "filename" not in item["data"]
@@ -1,8 +1,10 @@
 import pytest
-from api.models import Base, ZoteroVersion, Content
+from api.models import Base, Content, Author
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 import os
+from datetime import datetime
+import threading
 from api import database
 
 # Set up an in-memory test SQLite database
@@ -49,13 +51,12 @@ def sample_content():
 
 
 def test_store_and_get_latest_version():
+    assert database.get_latest_version() is None
     database.store_latest_version(100)
-    latest_version = database.get_latest_version()
-    assert latest_version.version == 100
+    assert database.get_latest_version() == 100
 
     database.store_latest_version(200)
-    latest_version = database.get_latest_version()
-    assert latest_version.version == 200
+    assert database.get_latest_version() == 200
 
 
 def test_store_and_get_content_list(sample_content):
@@ -200,3 +201,420 @@ def test_sync_content(sample_content):
     assert soft_deleted_content[0].zotero_key == sample_content[1]["zotero_key"]
     assert len(non_deleted_content) == 2
 
+
+def zotero_item(key, version, title, authors=None):
+    return {
+        "zotero_key": key,
+        "zotero_version": version,
+        "title": title,
+        "content_type": "zotero_entry",
+        "content_metadata": {"key": key},
+        "filename": None,
+        "tags": "",
+        "authors": authors or [],
+    }
+
+
+class QueryCounter:
+    """Count the statements executed on the database engine inside a `with` block."""
+
+    def __init__(self, match=""):
+        self.match = match
+        self.statements = []
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        if self.match in statement:
+            self.statements.append(statement)
+
+    def __enter__(self):
+        event.listen(database.engine, "before_cursor_execute", self)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(database.engine, "before_cursor_execute", self)
+
+    def __len__(self):
+        return len(self.statements)
+
+
+def test_merge_content_reports_counts():
+    database.merge_content([zotero_item("K1", 1, "One"), zotero_item("K2", 1, "Two")], filter_by_key="zotero_key")
+
+    counts = database.merge_content(
+        [zotero_item("K1", 2, "One v2"), zotero_item("K2", 1, "Two again"), zotero_item("K3", 1, "Three")],
+        filter_by_key="zotero_key",
+    )
+    assert counts == {"inserted": 1, "updated": 1, "skipped": 1}
+
+    titles = {c.zotero_key: c.title for c in database.get_content_list()}
+    assert titles == {"K1": "One v2", "K2": "Two", "K3": "Three"}
+
+
+def test_merge_content_collapses_duplicate_keys_in_batch():
+    counts = database.merge_content([zotero_item("K1", 1, "First"), zotero_item("K1", 2, "Second")], filter_by_key="zotero_key")
+    assert counts == {"inserted": 1, "updated": 1, "skipped": 0}
+
+    content_list = database.get_content_list()
+    assert [c.title for c in content_list] == ["Second"]
+
+
+def test_merge_content_prefetches_existing_rows():
+    database.store_content_list([zotero_item(f"K{i}", 1, f"Item {i}") for i in range(50)])
+
+    with QueryCounter("WHERE content.zotero_key IN") as queries:
+        counts = database.merge_content([zotero_item(f"K{i}", 2, f"Item {i} v2") for i in range(50)], filter_by_key="zotero_key")
+
+    assert counts["updated"] == 50
+    assert len(queries) == 1
+
+
+def test_store_content_list_is_idempotent_for_zotero_items():
+    items = [zotero_item("K1", 1, "One"), zotero_item("K2", 1, "Two")]
+    database.store_content_list(items)
+    stored, error = database.store_content_list(items, return_dict=True)
+
+    assert error is None
+    assert [c["zotero_key"] for c in stored] == ["K1", "K2"]
+    assert len(database.get_content_list()) == 2
+
+
+def test_merge_content_reuses_authors_within_batch():
+    doe = {"first_name": "John", "last_name": "Doe"}
+    roe = {"first_name": "Jane", "last_name": "Roe"}
+    database.store_author(roe)
+
+    database.merge_content(
+        [zotero_item("K1", 1, "One", [doe, roe]), zotero_item("K2", 1, "Two", [doe])],
+        filter_by_key="zotero_key",
+    )
+
+    with database.Session() as session:
+        authors = session.query(Author).order_by(Author.last_name).all()
+        assert [(a.first_name, a.last_name) for a in authors] == [("John", "Doe"), ("Jane", "Roe")]
+        assert {c.zotero_key for c in authors[0].contents} == {"K1", "K2"}
+
+
+def test_resolve_authors_uses_one_query_per_batch():
+    database.store_author({"first_name": "Jane", "last_name": "Roe"})
+    names = [("Jane", "Roe"), ("John", "Doe"), ("Jane", "Roe")]
+
+    with QueryCounter("FROM authors") as queries:
+        with database.Session() as session:
+            authors = database.resolve_authors(session, names)
+            assert database.construct_author(session, {"first_name": "John", "last_name": "Doe"}) is authors[("John", "Doe")]
+
+    assert authors[("Jane", "Roe")].id is not None
+    assert len(queries) == 1
+
+
+def test_get_content_page_walks_all_items_in_order():
+    stored, _ = database.store_content_list([zotero_item(f"K{i}", 1, f"Item {i}") for i in range(7)])
+    # force ties on time_modified so the id tiebreak is exercised
+    with database.Session() as session:
+        session.query(Content).update({"time_modified": datetime(2023, 1, 1)})
+        session.commit()
+
+    pages = []
+    cursor = None
+    while True:
+        items, cursor = database.get_content_page(limit=3, cursor=cursor)
+        pages.append([item["zotero_key"] for item in items])
+        if cursor is None:
+            break
+    assert pages == [["K6", "K5", "K4"], ["K3", "K2", "K1"], ["K0"]]
+
+
+def test_get_content_page_filters_and_projects_fields():
+    doe = {"first_name": "John", "last_name": "Doe"}
+    tagged = zotero_item("K1", 1, "Tagged", [doe])
+    tagged["tags"] = "ml, robotics"
+    note = zotero_item("K2", 1, "Note")
+    note["content_type"] = "note"
+    note["tags"] = "robotics_lab"
+    stored, _ = database.store_content_list([tagged, note, zotero_item("K3", 1, "Plain")], return_dict=True)
+    with database.engine.begin() as conn:
+        conn.exec_driver_sql("INSERT INTO groups (id, name, group_type) VALUES (1, 'Reading list', 'base_group')")
+        conn.exec_driver_sql("INSERT INTO group_content (group_id, content_id) VALUES (1, ?)", (stored[2]["id"],))
+
+    items, _ = database.get_content_page(tag="robotics")
+    assert [item["zotero_key"] for item in items] == ["K1"]
+
+    items, _ = database.get_content_page(content_type="note")
+    assert [item["zotero_key"] for item in items] == ["K2"]
+
+    with database.Session() as session:
+        author_id = session.query(Author).one().id
+    items, _ = database.get_content_page(author_id=author_id, fields=["id", "title", "authors"])
+    assert items == [{"id": items[0]["id"], "title": "Tagged", "authors": [{"id": author_id, "first_name": "John", "last_name": "Doe"}]}]
+
+    items, _ = database.get_content_page(group_id=1, fields=["title"])
+    assert items == [{"title": "Plain"}]
+
+
+def test_get_content_page_rejects_bad_input():
+    with pytest.raises(ValueError):
+        database.get_content_page(cursor="not-a-cursor")
+    with pytest.raises(ValueError):
+        database.get_content_page(fields=["title", "password"])
+
+
+@pytest.mark.parametrize("size", [5, 40])
+def test_listing_functions_use_constant_query_count(size):
+    items = [zotero_item(f"K{i}", 1, f"Item {i}", [{"first_name": "A", "last_name": f"Author {i}"}]) for i in range(size)]
+    for i in range(size):
+        items.append({"title": f"Highlight {i}", "content_type": "highlight", "content_metadata": {}})
+        items.append({"title": f"Chat {i}", "content_type": "chat", "content_metadata": {"chat": {"messages": []}}})
+    stored, _ = database.store_content_list(items, return_dict=True)
+    with database.engine.begin() as conn:
+        conn.exec_driver_sql("INSERT INTO groups (id, name, group_type) VALUES (1, 'Reading list', 'base_group')")
+        conn.exec_driver_sql("INSERT INTO group_content (group_id, content_id) VALUES (1, ?)", (stored[0]["id"],))
+
+    with QueryCounter() as queries:
+        content_list = database.get_content_list(asdict=True)
+    assert len(content_list) == 3 * size
+    grouped = next(c for c in content_list if c["id"] == stored[0]["id"])
+    assert grouped["groups"] == [{"id": 1, "name": "Reading list", "group_type": "base_group"}]
+    # the content rows, then one selectin query each for authors and groups
+    assert len(queries) == 3
+
+    with QueryCounter() as queries:
+        assert len(database.get_highlights(asdict=True)) == size
+    assert len(queries) == 3
+
+    # chat summaries come from a single query with correlated subqueries
+    with QueryCounter() as queries:
+        assert len(database.get_chats(asdict=True)) == size
+    assert len(queries) == 1
+
+    with QueryCounter() as queries:
+        items, _ = database.get_content_page(limit=size, fields=["id", "title", "authors"])
+    assert len(items) == size
+    assert len(queries) == 2
+
+    with QueryCounter("SELECT") as queries:
+        database.store_content_list([zotero_item(f"K{i}", 2, f"Item {i} v2") for i in range(size)], return_dict=True)
+    # content prefetch with its authors, and the bulk reload with its two selectin queries
+    assert len(queries) == 5
+
+
+@pytest.fixture
+def file_db(tmp_path, monkeypatch):
+    engine = database.create_db_engine(f"sqlite:///{tmp_path / 'locus.db'}")
+    Base.metadata.create_all(engine)
+    monkeypatch.setattr(database, "engine", engine)
+    monkeypatch.setattr(database, "Session", sessionmaker(bind=engine))
+    yield engine
+    engine.dispose()
+
+
+def test_create_db_engine_applies_pragmas(file_db, monkeypatch):
+    with file_db.connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+        assert conn.exec_driver_sql("PRAGMA synchronous").scalar() == 1  # NORMAL
+        assert conn.exec_driver_sql("PRAGMA busy_timeout").scalar() == 5000
+
+    monkeypatch.setenv("LOCUS_SQLITE_PRAGMAS", "busy_timeout=250; cache_size=-1000")
+    monkeypatch.setenv("LOCUS_DB_POOL_SIZE", "3")
+    engine = database.create_db_engine(file_db.url.render_as_string())
+    with engine.connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA busy_timeout").scalar() == 250
+        assert conn.exec_driver_sql("PRAGMA cache_size").scalar() == -1000
+    assert engine.pool.size() == 3
+    engine.dispose()
+
+
+def test_concurrent_writers(file_db):
+    chats = [database.create_chat({"title": f"Chat {i}"}, [], [], return_dict=True)["id"] for i in range(16)]
+    errors = []
+
+    def writer(worker):
+        try:
+            for turn in range(10):
+                messages = [{"role": "user", "content": f"{worker}-{n}"} for n in range(turn + 1)]
+                database.update_chat(chats[worker], messages, [])
+                database.store_content_list([{"title": f"Note {worker}-{turn}", "content_type": "note"}])
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=writer, args=(worker,)) for worker in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    with database.Session() as session:
+        assert session.query(Content).filter(Content.content_type == "note").count() == 16 * 10
+    for worker, chat_id in enumerate(chats):
+        assert [m["content"] for m in database.get_chat_messages(chat_id)] == [f"{worker}-{n}" for n in range(10)]
+
+
+def test_chat_messages_are_appended_and_paged():
+    chat_id = database.create_chat({"title": "Chat"}, [{"role": "user", "content": "Hello"}], [], return_dict=True)["id"]
+
+    assert database.append_chat_messages(chat_id, [{"role": "assistant", "content": "Hi"}]) == 2
+    assert database.append_chat_messages(chat_id, [{"role": "user", "content": f"Question {i}"} for i in range(3)]) == 5
+    assert database.append_chat_messages(chat_id + 100, [{"role": "user", "content": "lost"}]) is None
+
+    assert [m["seq"] for m in database.get_chat_messages(chat_id)] == [1, 2, 3, 4, 5]
+    assert [m["content"] for m in database.get_chat_messages(chat_id, limit=2)] == ["Question 1", "Question 2"]
+    assert [m["seq"] for m in database.get_chat_messages(chat_id, limit=2, before_seq=4)] == [2, 3]
+
+    chat = database.get_chat_by_id(chat_id, return_dict=True, message_limit=1)
+    assert chat["content_metadata"]["chat"] == {"highlights": [], "messages": [{"seq": 5, "role": "user", "content": "Question 2"}]}
+
+    summary, = database.get_chats(asdict=True)
+    assert summary["id"] == chat_id
+    assert summary["message_count"] == 5
+    assert summary["first_message"] == "Hello"
+
+
+def test_append_chat_messages_does_not_read_history():
+    chat_id = database.create_chat({"title": "Chat"}, [{"role": "user", "content": "x" * 1000}] * 50, [], return_dict=True)["id"]
+
+    with QueryCounter("chat_messages") as queries:
+        database.append_chat_messages(chat_id, [{"role": "user", "content": "next"}])
+    # the max(seq) seek and the insert
+    assert len(queries) == 2
+    assert all("chat_messages.content" not in statement for statement in queries.statements)
+
+
+def test_writes_bump_library_version():
+    start = database.get_library_version()
+
+    database.store_content_list([zotero_item("K1", 1, "Item")])
+    assert database.get_library_version() == start + 1
+
+    database.get_content_list(asdict=True)
+    database.get_content_page()
+    assert database.get_library_version() == start + 1
+
+    # bulk update through query.update(), then a write that touches neither content nor chats
+    content_id = database.get_content_list()[0].id
+    database.update_content([{"id": content_id, "title": "Renamed"}])
+    database.store_latest_version(7)
+    assert database.get_library_version() == start + 3
+
+    # one bump per transaction, however many rows it writes
+    database.store_content_list([zotero_item(f"K{i}", 1, f"Item {i}") for i in range(2, 20)])
+    assert database.get_library_version() == start + 4
+
+
+def test_change_feed_returns_writes_since_cursor():
+    database.store_content_list([zotero_item(f"K{i}", 1, f"Item {i}") for i in range(3)])
+    feed = database.get_changes()
+    assert [item["zotero_key"] for item in feed["items"]] == ["K0", "K1", "K2"]
+    assert feed["deleted"] == [] and not feed["has_more"]
+
+    cursor = feed["cursor"]
+    assert database.get_changes(cursor)["items"] == []
+
+    database.store_content_list([zotero_item("K1", 2, "Item 1 v2")])
+    database.update_content([{"id": feed["items"][0]["id"], "title": "Renamed"}])
+    database.soft_delete_content([{"zotero_key": "K2"}])
+    changes = database.get_changes(cursor)
+    assert [item["title"] for item in changes["items"]] == ["Item 1 v2", "Renamed"]
+    assert [tombstone["zotero_key"] for tombstone in changes["deleted"]] == ["K2"]
+    assert database.get_changes(changes["cursor"])["items"] == []
+
+
+def test_change_feed_pages_within_one_write():
+    database.store_content_list([zotero_item(f"K{i}", 1, f"Item {i}") for i in range(5)])
+
+    keys, cursor, has_more = [], None, True
+    while has_more:
+        page = database.get_changes(cursor, limit=2)
+        keys += [item["zotero_key"] for item in page["items"]]
+        cursor, has_more = page["cursor"], page["has_more"]
+    assert keys == [f"K{i}" for i in range(5)]
+
+    with pytest.raises(ValueError):
+        database.get_changes("not a cursor")
+
+
+def test_change_cursor_follows_the_latest_write():
+    assert database.get_changes(database.get_change_cursor())["items"] == []
+    database.store_content_list([zotero_item(f"K{i}", 1, f"Item {i}") for i in range(3)])
+
+    # a client that listed everything follows the feed from here
+    cursor = database.get_change_cursor()
+    assert cursor == database.get_changes()["cursor"]
+    database.store_content_list([zotero_item("K1", 2, "Item 1 v2")])
+    assert [item["title"] for item in database.get_changes(cursor)["items"]] == ["Item 1 v2"]
+
+
+def store_note(text="Hello\n"):
+    stored, error = database.store_content_list(
+        [{"content_type": "note", "title": "Note", "content_metadata": {"ops": [{"insert": text}]}, "authors": []}],
+        return_dict=True, key="id")
+    assert error is None
+    return stored[0]
+
+
+def encode_cursor_of(content):
+    return database.encode_change_cursor(content["change_seq"], content["id"])
+
+
+def test_note_edits_are_saved_incrementally():
+    note = store_note()
+    assert note["revision"] == 0
+
+    saved = database.save_note_edit(note["id"], 0, [{"retain": 5}, {"insert": " world"}])
+    assert saved["revision"] == 1
+    database.save_note_edit(note["id"], 1, [{"insert": "Hi. "}], title="Greeting")
+
+    document = database.get_note_document(note["id"])
+    assert document == {"id": note["id"], "revision": 2, "delta": {"ops": [{"insert": "Hi. Hello world\n"}]}}
+    current = database.get_content_by_id(note["id"])
+    assert (current["title"], current["revision"]) == ("Greeting", 2)
+    assert current["content_metadata"] == document["delta"]
+    # every listing and the change feed carry the current document
+    listed = next(c for c in database.get_content_list(asdict=True) if c["id"] == note["id"])
+    page, _ = database.get_content_page(content_type="note", fields=["id", "content_metadata", "revision"])
+    changed, = database.get_changes(encode_cursor_of(note))["items"]
+    for content in (listed, page[0], changed):
+        assert (content["content_metadata"], content["revision"]) == (document["delta"], 2)
+    assert [item["id"] for item in database.search_content("world")[0]] == [note["id"]]
+
+
+def test_note_edits_need_the_latest_revision():
+    note = store_note()
+    database.save_note_edit(note["id"], 0, [{"insert": "a"}])
+
+    with pytest.raises(database.RevisionConflict) as conflict:
+        database.save_note_edit(note["id"], 0, [{"insert": "b"}])
+    assert conflict.value.revision == 1
+    with pytest.raises(database.delta.DeltaError):
+        database.save_note_edit(note["id"], 1, [{"retain": 100}, {"insert": "b"}])
+    assert database.get_note_document(note["id"])["delta"] == {"ops": [{"insert": "aHello\n"}]}
+    assert database.save_note_edit(12345, 0, [{"insert": "b"}]) is None
+
+
+def test_note_edits_are_folded_into_snapshots():
+    note = store_note("\n")
+    for revision in range(7):
+        database.save_note_edit(note["id"], revision, [{"insert": str(revision)}], snapshot_interval=3)
+
+    with database.Session() as session:
+        content = session.get(Content, note["id"])
+        assert (content.revision, content.content_metadata) == (6, {"ops": [{"insert": "543210\n"}]})
+        assert [r.revision for r in session.query(database.NoteRevision)] == [7]
+    assert database.get_note_document(note["id"])["delta"] == {"ops": [{"insert": "6543210\n"}]}
+    # the index holds the current text, edits included
+    assert [item["id"] for item in database.search_content("6543210")[0]] == [note["id"]]
+
+
+def test_saving_a_whole_note_replaces_its_edits():
+    note = store_note()
+    database.save_note_edit(note["id"], 0, [{"insert": "a"}])
+    database.save_note_edit(note["id"], 1, [{"insert": "b"}])
+
+    stored, _ = database.store_content_list(
+        [{"id": note["id"], "content_type": "note", "title": "Note", "content_metadata": {"ops": [{"insert": "New\n"}]},
+          "authors": []}], return_dict=True, key="id")
+
+    assert stored[0]["revision"] == 3
+    assert database.get_note_document(note["id"]) == {"id": note["id"], "revision": 3,
+                                                      "delta": {"ops": [{"insert": "New\n"}]}}
+    database.save_note_edit(note["id"], 3, [{"retain": 3}, {"insert": "!"}])
+    assert database.get_note_document(note["id"])["delta"] == {"ops": [{"insert": "New!\n"}]}
@@ -0,0 +1,75 @@
+import pytest
+
+from api.delta import DeltaError, apply_change, check_ops, compose, document_length, to_html
+
+
+def test_compose_applies_inserts_deletes_and_formats():
+    document = [{"insert": "Hello world\n"}]
+
+    assert compose(document, [{"retain": 6}, {"insert": "big ", "attributes": {"bold": True}}]) == [
+        {"insert": "Hello "}, {"insert": "big ", "attributes": {"bold": True}}, {"insert": "world\n"}]
+    assert compose(document, [{"retain": 5}, {"delete": 6}, {"insert": "!"}]) == [{"insert": "Hello!\n"}]
+    # a null attribute removes the format
+    bold = [{"insert": "ab", "attributes": {"bold": True}}, {"insert": "\n"}]
+    assert compose(bold, [{"retain": 1, "attributes": {"bold": None}}]) == [
+        {"insert": "a"}, {"insert": "b", "attributes": {"bold": True}}, {"insert": "\n"}]
+
+
+def test_compose_of_edits_equals_applying_them_in_turn():
+    document = [{"insert": "one two three\n"}]
+    first = [{"retain": 4}, {"delete": 4}]
+    second = [{"retain": 4}, {"insert": "2 ", "attributes": {"italic": True}}]
+
+    assert compose(compose(document, first), second) == compose(document, compose(first, second))
+
+
+def test_lengths_count_utf16_code_units():
+    # the editor counts an emoji outside the BMP as two characters
+    document = [{"insert": "a\U0001F600b\n"}]
+
+    assert document_length(document) == 5
+    assert compose(document, [{"retain": 3}, {"insert": "X"}]) == [{"insert": "a\U0001F600Xb\n"}]
+    assert compose(document, [{"retain": 1}, {"delete": 2}]) == [{"insert": "ab\n"}]
+
+
+def test_edits_must_be_well_formed_and_fit_the_document():
+    document = [{"insert": "Hello\n"}]
+
+    assert apply_change(document, [{"retain": 6}, {"insert": "x"}]) == ([{"insert": "Hello\nx"}], 7)
+    with pytest.raises(DeltaError):
+        apply_change(document, [{"retain": 5}, {"delete": 2}])
+    for ops in ({"ops": []}, [{"retain": 0}], [{"insert": ""}], [{"delete": 1, "attributes": {}}],
+                [{"insert": "a", "retain": 1}], [{"retain": True}]):
+        with pytest.raises(DeltaError):
+            check_ops(ops)
+
+
+def test_documents_render_as_html():
+    document = [
+        {"insert": "Notes"}, {"insert": "\n", "attributes": {"header": 1}},
+        {"insert": "first"}, {"insert": "\n", "attributes": {"list": "bullet"}},
+        {"insert": "second", "attributes": {"bold": True, "link": "https://example.org"}},
+        {"insert": "\n", "attributes": {"list": "bullet"}},
+        {"insert": "\n<script>\n"},
+    ]
+
+    assert to_html(document) == (
+        '<h1>Notes</h1><ul><li>first</li><li><a href="https://example.org"><strong>second</strong></a></li></ul>'
+        '<p><br></p><p>&lt;script&gt;</p>'
+    )
+
+
+def test_unsafe_links_and_images_are_dropped():
+    document = [
+        {"insert": "a", "attributes": {"link": "javascript:alert(1)"}},
+        {"insert": "b", "attributes": {"link": " JaVa\tScript:alert(1)"}},
+        {"insert": "c", "attributes": {"link": "mailto:ada@example.org"}},
+        {"insert": {"image": "javascript:alert(1)"}},
+        {"insert": {"image": "data:text/html;base64,PHNjcmlwdD4="}},
+        {"insert": {"image": "data:image/png;base64,iVBORw0KGgo="}},
+        {"insert": "\n"},
+    ]
+
+    assert to_html(document) == (
+        '<p>ab<a href="mailto:ada@example.org">c</a><img src="data:image/png;base64,iVBORw0KGgo="></p>'
+    )
@@ -0,0 +1,81 @@
+import pytest
+from api import database, events
+
+
+pytestmark = pytest.mark.usefixtures("db")
+
+
+@pytest.fixture
+def published():
+    batches = []
+    events.subscribe(batches.append)
+    yield batches
+    events.unsubscribe(batches.append)
+
+
+def item(key, version, title):
+    return {"zotero_key": key, "zotero_version": version, "title": title, "content_type": "zotero_entry"}
+
+
+def test_writes_publish_compact_events_after_commit(published):
+    stored, _ = database.store_content_list([item("K1", 1, "One"), item("K2", 1, "Two")], return_dict=True)
+    ids = [content["id"] for content in stored]
+    assert [(e["id"], e["content_type"], e["op"]) for e in published[-1]] == [
+        (ids[0], "zotero_entry", "created"), (ids[1], "zotero_entry", "created")]
+
+    database.store_content_list([item("K1", 2, "One v2")])
+    change, = published[-1]
+    assert change["op"] == "updated"
+    assert "title" in change["fields"] and "change_seq" not in change["fields"]
+
+    database.update_content([{"id": ids[1], "filename": "two.pdf"}])
+    change, = published[-1]
+    assert (change["id"], change["op"], change["fields"]) == (ids[1], "updated", ["filename", "time_modified"])
+    assert change["change_seq"] == database.get_library_version()
+
+    database.soft_delete_content([{"zotero_key": "K1"}, {"id": ids[1]}])
+    assert sorted((e["id"], e["op"]) for e in published[-1]) == [(ids[0], "deleted"), (ids[1], "deleted")]
+
+    highlight = database.create_highlight({"title": "Quote"}, "text", return_dict=True)
+    assert published[-1][0]["id"] == highlight["id"]
+    assert published[-1][0]["content_type"] == "highlight"
+
+
+def test_rolled_back_writes_publish_nothing(published):
+    with pytest.raises(RuntimeError):
+        with database.Session() as session, session.begin():
+            database.bulk_upsert_content(session, [item("K1", 1, "One")])
+            session.flush()
+            raise RuntimeError("abort")
+    assert published == []
+
+
+def test_batcher_coalesces_and_splits_batches():
+    sent = []
+    batcher = events.ChangeBatcher(sent.append, max_batch=2, start_task=lambda task: None)
+
+    batcher.add([{"id": 1, "content_type": "note", "op": "created", "change_seq": 1}])
+    batcher.add([{"id": 1, "content_type": "note", "op": "updated", "fields": ["title"], "change_seq": 2},
+                 {"id": 2, "content_type": "note", "op": "updated", "fields": ["title"], "change_seq": 2}])
+    batcher.add([{"id": 2, "content_type": "note", "op": "updated", "fields": ["tags"], "change_seq": 3},
+                 {"id": 3, "content_type": "note", "op": "deleted", "change_seq": 3}])
+    batcher.flush()
+
+    assert [len(batch["changes"]) for batch in sent] == [2, 1]
+    first, second, third = sent[0]["changes"] + sent[1]["changes"]
+    assert (first["op"], first["change_seq"]) == ("created", 2)
+    assert (second["op"], second["fields"]) == ("updated", ["tags", "title"])
+    assert third["op"] == "deleted"
+
+
+def test_bulk_sync_is_sent_in_few_messages():
+    sent = []
+    batcher = events.ChangeBatcher(sent.append, max_batch=500, start_task=lambda task: None)
+    events.subscribe(batcher.add)
+    try:
+        database.sync_content([item(f"K{i}", 1, f"Item {i}") for i in range(2000)], [])
+    finally:
+        events.unsubscribe(batcher.add)
+    batcher.flush()
+    assert len(sent) == 4
+    assert sum(len(batch["changes"]) for batch in sent) == 2000
@@ -3,7 +3,7 @@ import json
 import pytest
 from pyzotero import zotero
 from pytest_mock import mocker
-from api.models import Base, ZoteroVersion, Content
+from api.models import Base, Content
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy import create_engine
 import os
@@ -93,8 +93,7 @@ def test_sync_zotero_down(db_session, sample_content, mock_zotero_api):
     sync_zotero_down("API_KEY", "USER_ID", "ZOTERO_COLLECTION_NAME")
 
     # Check the latest version
-    latest_version = database.get_latest_version()
-    assert latest_version.version == 2
+    assert database.get_latest_version() == 2
 
     # Check the content in the database
     content_data = database.get_content_list()
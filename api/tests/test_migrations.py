@@ -0,0 +1,200 @@
+import json
+import pytest
+from sqlalchemy import create_engine, inspect, select
+from api.models import Base, Content
+from api import database, migrations, search
+
+OLD_INDEXES = [
+    "ix_authors_last_first",
+    "ix_content_deleted_type_modified",
+    "ix_content_type_modified",
+    "ix_content_deleted_modified",
+    "ix_content_authors_content_id",
+    "ix_content_authors_author_id",
+    "ix_group_content_content_id",
+    "ix_content_association_content_id2",
+    "ix_content_change_seq",
+    "ix_content_zotero_dirty",
+]
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'locus.db'}")
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def unversioned_engine(engine):
+    # a database created by an older release: tables from create_all, no secondary indexes, no version stamp
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        for index in OLD_INDEXES:
+            conn.exec_driver_sql(f"DROP INDEX {index}")
+        conn.exec_driver_sql("DROP TABLE content_fts")
+        conn.exec_driver_sql("DROP TABLE chat_message_fts")
+        conn.exec_driver_sql("DROP TABLE chat_messages")
+        conn.exec_driver_sql("DROP TABLE library_state")
+        conn.exec_driver_sql("DROP TABLE sync_state")
+        conn.exec_driver_sql("DROP TABLE note_revisions")
+        conn.exec_driver_sql("ALTER TABLE content DROP COLUMN change_seq")
+        conn.exec_driver_sql("ALTER TABLE content DROP COLUMN zotero_dirty")
+        conn.exec_driver_sql("ALTER TABLE content DROP COLUMN revision")
+        conn.exec_driver_sql("CREATE TABLE zotero_version (id INTEGER PRIMARY KEY, version INTEGER NOT NULL, timestamp DATETIME NOT NULL)")
+    return engine
+
+
+def index_names(engine, table):
+    return {index["name"] for index in inspect(engine).get_indexes(table)}
+
+
+def test_upgrade_new_database_is_stamped_latest(engine):
+    assert migrations.upgrade(engine) == migrations.latest_version()
+    with engine.connect() as conn:
+        assert migrations.current_version(conn) == migrations.latest_version()
+    assert "ix_content_deleted_type_modified" in index_names(engine, "content")
+
+
+def test_upgrade_existing_database_adds_indexes(unversioned_engine):
+    assert "ix_content_deleted_type_modified" not in index_names(unversioned_engine, "content")
+
+    assert migrations.upgrade(unversioned_engine) == migrations.latest_version()
+
+    assert {"ix_content_deleted_type_modified", "ix_content_type_modified"} <= index_names(unversioned_engine, "content")
+    assert "ix_authors_last_first" in index_names(unversioned_engine, "authors")
+    assert "ix_group_content_content_id" in index_names(unversioned_engine, "group_content")
+    # running again is a no-op
+    assert migrations.upgrade(unversioned_engine) == migrations.latest_version()
+
+
+def test_upgrade_merges_duplicate_authors(unversioned_engine):
+    with unversioned_engine.begin() as conn:
+        conn.exec_driver_sql("INSERT INTO content (id, title, content_type, deleted) VALUES (1, 'A', 'zotero_entry', 0), (2, 'B', 'zotero_entry', 0)")
+        conn.exec_driver_sql("INSERT INTO authors (id, first_name, last_name) VALUES (1, 'John', 'Doe'), (2, 'John', 'Doe'), (3, 'Jane', 'Roe')")
+        conn.exec_driver_sql("INSERT INTO content_authors (content_id, author_id) VALUES (1, 1), (2, 2), (2, 3)")
+
+    migrations.upgrade(unversioned_engine)
+
+    with unversioned_engine.connect() as conn:
+        assert conn.exec_driver_sql("SELECT id FROM authors ORDER BY id").scalars().all() == [1, 3]
+        links = conn.exec_driver_sql("SELECT content_id, author_id FROM content_authors ORDER BY content_id, author_id").all()
+    assert links == [(1, 1), (2, 1), (2, 3)]
+
+
+def test_upgrade_merges_authors_without_duplicate_links(unversioned_engine):
+    with unversioned_engine.begin() as conn:
+        conn.exec_driver_sql("INSERT INTO content (id, title, content_type, deleted) VALUES (1, 'A', 'zotero_entry', 0)")
+        # the models do not allow a NULL first name, so the old table is rebuilt without the constraint
+        conn.exec_driver_sql("DROP TABLE authors")
+        conn.exec_driver_sql("CREATE TABLE authors (id INTEGER PRIMARY KEY, first_name VARCHAR(50), last_name VARCHAR(50), "
+                             "user_id INTEGER)")
+        conn.exec_driver_sql("INSERT INTO authors (id, first_name, last_name) VALUES (1, 'John', 'Doe'), (2, 'John', 'Doe'), "
+                             "(3, NULL, 'UNESCO'), (4, NULL, 'UNESCO')")
+        conn.exec_driver_sql("INSERT INTO content_authors (content_id, author_id) VALUES (1, 1), (1, 2), (1, 3), (1, 4)")
+
+    migrations.upgrade(unversioned_engine)
+
+    with unversioned_engine.connect() as conn:
+        assert conn.exec_driver_sql("SELECT id FROM authors ORDER BY id").scalars().all() == [1, 3]
+        links = conn.exec_driver_sql("SELECT content_id, author_id FROM content_authors ORDER BY author_id").all()
+    assert links == [(1, 1), (1, 3)]
+
+
+def test_hot_queries_use_indexes(engine):
+    migrations.upgrade(engine)
+    assert migrations.check_query_plans(engine) == {}
+
+
+def test_check_query_plans_reports_full_scans(unversioned_engine):
+    # only the columns an old release has
+    queries = {"active_content": database.active_content_query().with_only_columns(Content.id),
+               "highlights": database.content_type_query("highlight").with_only_columns(Content.id)}
+    full_scans = migrations.check_query_plans(unversioned_engine, queries)
+    assert full_scans["active_content"] == ["SCAN content"]
+
+
+def test_check_query_plans_reports_index_scans(engine):
+    migrations.upgrade(engine)
+    # the index latest_change may scan, read in full by another query
+    queries = {"change_seqs": select(Content.change_seq).order_by(Content.change_seq)}
+    full_scans = migrations.check_query_plans(engine, queries)
+    assert full_scans["change_seqs"] == ["SCAN content USING COVERING INDEX ix_content_change_seq"]
+
+
+def test_upgrade_backfills_search_index(unversioned_engine):
+    with unversioned_engine.begin() as conn:
+        conn.exec_driver_sql("INSERT INTO content (id, title, content_type, deleted) VALUES (1, 'Graph neural networks', 'zotero_entry', 0)")
+        conn.exec_driver_sql(
+            "INSERT INTO content (id, title, content_type, content_metadata, deleted) VALUES (2, 'Note', 'note', ?, 0)",
+            ('{"ops": [{"insert": "message passing"}]}',),
+        )
+
+    migrations.upgrade(unversioned_engine)
+
+    with unversioned_engine.connect() as conn:
+        assert search.search(conn, "graph")[0][0]["id"] == 1
+        assert search.search(conn, "passing")[0][0]["id"] == 2
+
+
+def test_upgrade_moves_chat_transcripts_to_table(unversioned_engine):
+    transcript = {"chat": {"messages": [{"role": "user", "content": "What is attention?"},
+                                        {"role": "assistant", "content": "A weighting over tokens."}],
+                           "highlights": [{"id": 1, "text": "attention", "highlight_entry_id": None}]}}
+    with unversioned_engine.begin() as conn:
+        conn.exec_driver_sql(
+            "INSERT INTO content (id, title, content_type, content_metadata, deleted) VALUES (1, 'Chat Session', 'chat', ?, 0)",
+            (json.dumps(transcript),),
+        )
+
+    migrations.upgrade(unversioned_engine)
+
+    with unversioned_engine.connect() as conn:
+        rows = conn.exec_driver_sql("SELECT chat_id, seq, role, content FROM chat_messages ORDER BY seq").all()
+        metadata = json.loads(conn.exec_driver_sql("SELECT content_metadata FROM content WHERE id = 1").scalar())
+        hits, _ = search.search(conn, "weighting")
+    assert rows == [(1, 1, "user", "What is attention?"), (1, 2, "assistant", "A weighting over tokens.")]
+    assert metadata == {"chat": {"highlights": transcript["chat"]["highlights"]}}
+    assert [hit["id"] for hit in hits] == [1]
+
+
+def test_upgrade_adds_state_tables_and_change_seq(unversioned_engine):
+    with unversioned_engine.begin() as conn:
+        conn.exec_driver_sql("INSERT INTO content (title, content_type) VALUES ('Old', 'note')")
+    migrations.upgrade(unversioned_engine)
+    with unversioned_engine.connect() as conn:
+        assert conn.exec_driver_sql("SELECT id, version FROM library_state").all() == [(1, 0)]
+        assert conn.exec_driver_sql("SELECT id, checkpoint_collection FROM sync_state").all() == [(1, None)]
+        assert conn.exec_driver_sql("SELECT change_seq FROM content").scalar() == 0
+    assert "ix_content_change_seq" in index_names(unversioned_engine, "content")
+
+
+def test_upgrade_moves_zotero_version_to_sync_state(unversioned_engine):
+    with unversioned_engine.begin() as conn:
+        conn.exec_driver_sql("INSERT INTO zotero_version (version, timestamp) VALUES "
+                             "(5, '2023-04-01 10:00:00'), (9, '2023-04-03 10:00:00'), (7, '2023-04-02 10:00:00')")
+    migrations.upgrade(unversioned_engine)
+    with unversioned_engine.connect() as conn:
+        assert conn.exec_driver_sql("SELECT library_version, synced_at FROM sync_state").all() == [
+            (9, "2023-04-03 10:00:00")]
+    assert not inspect(unversioned_engine).has_table("zotero_version")
+
+
+def test_upgrade_queues_local_notes_for_upload(unversioned_engine):
+    with unversioned_engine.begin() as conn:
+        conn.exec_driver_sql("INSERT INTO content (id, title, content_type, zotero_key, deleted) VALUES "
+                             "(1, 'Note', 'note', NULL, 0), (2, 'Paper', 'zotero_entry', 'K1', 0), "
+                             "(3, 'Gone', 'note', NULL, 1)")
+    migrations.upgrade(unversioned_engine)
+    with unversioned_engine.connect() as conn:
+        assert conn.exec_driver_sql("SELECT id FROM content WHERE zotero_dirty = 1").scalars().all() == [1]
+    assert "ix_content_zotero_dirty" in index_names(unversioned_engine, "content")
+
+
+def test_upgrade_adds_note_revisions(unversioned_engine):
+    with unversioned_engine.begin() as conn:
+        conn.exec_driver_sql("INSERT INTO content (id, title, content_type, deleted) VALUES (1, 'Note', 'note', 0)")
+    migrations.upgrade(unversioned_engine)
+    with unversioned_engine.connect() as conn:
+        assert conn.exec_driver_sql("SELECT revision FROM content").scalars().all() == [0]
+    assert "ix_note_revisions_content_revision" in index_names(unversioned_engine, "note_revisions")
@@ -0,0 +1,130 @@
+import os
+import threading
+import time
+import pytest
+
+from api import note_store
+from api.note_store import NoteStore, note_filename, write_atomic
+
+
+def wait_until_written(store: NoteStore, timeout: float = 5) -> None:
+    deadline = time.monotonic() + timeout
+    while store.stats()["pending"] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert store.stats()["pending"] == 0
+
+
+def test_write_atomic_replaces_the_file(tmp_path):
+    path = str(tmp_path / "note-1.html")
+    write_atomic(path, "<p>first</p>")
+    write_atomic(path, "<p>second</p>")
+
+    with open(path) as f:
+        assert f.read() == "<p>second</p>"
+    # no temporary files are left behind
+    assert os.listdir(tmp_path) == ["note-1.html"]
+
+
+def test_failed_write_keeps_the_previous_version(tmp_path, monkeypatch):
+    path = str(tmp_path / "note-1.html")
+    write_atomic(path, "<p>first</p>")
+
+    def fail(*args):
+        raise OSError("disk full")
+    monkeypatch.setattr(os, "replace", fail)
+    with pytest.raises(OSError):
+        write_atomic(path, "<p>second</p>")
+
+    with open(path) as f:
+        assert f.read() == "<p>first</p>"
+    assert os.listdir(tmp_path) == ["note-1.html"]
+
+
+def test_readers_never_see_a_partial_file(tmp_path):
+    path = str(tmp_path / "note-1.html")
+    versions = ["<p>" + str(i) * 200_000 + "</p>" for i in range(10)]
+    write_atomic(path, versions[0])
+    done = threading.Event()
+
+    def write():
+        for version in versions * 3:
+            write_atomic(path, version)
+        done.set()
+    writer = threading.Thread(target=write)
+    writer.start()
+    reads = 0
+    while not done.is_set():
+        with open(path) as f:
+            assert f.read() in versions
+        reads += 1
+    writer.join()
+    assert reads
+
+
+def test_rapid_saves_are_coalesced(tmp_path):
+    store = NoteStore(str(tmp_path), delay=0.2)
+    for i in range(5):
+        filename = store.save(7, f"<p>version {i}</p>")
+
+    assert filename == note_filename(7) == "note-7.html"
+    # the save returned before the file was written, and its text is readable meanwhile
+    assert not os.path.exists(tmp_path / filename)
+    assert store.read(filename) == "<p>version 4</p>"
+
+    wait_until_written(store)
+    with open(tmp_path / filename) as f:
+        assert f.read() == "<p>version 4</p>"
+    assert store.stats() == {"saves": 5, "writes": 1, "coalesced": 4, "errors": 0, "pending": 0}
+    store.close()
+
+
+def test_notes_are_stored_by_id(tmp_path):
+    store = NoteStore(str(tmp_path), delay=0)
+    # same title, different notes
+    store.save(1, "<h1>Ideas</h1><p>one</p>")
+    store.save(2, "<h1>Ideas</h1><p>two</p>")
+    wait_until_written(store)
+
+    assert store.read("note-1.html") == "<h1>Ideas</h1><p>one</p>"
+    assert store.read("note-2.html") == "<h1>Ideas</h1><p>two</p>"
+    assert store.read("note-3.html") is None
+    store.close()
+
+
+def test_flush_writes_pending_notes_at_once(tmp_path):
+    store = NoteStore(str(tmp_path), delay=60)
+    store.save(1, "<p>one</p>")
+    store.save(2, "<p>two</p>")
+
+    store.flush(["note-1.html"])
+    assert os.path.exists(tmp_path / "note-1.html")
+    assert store.pending("note-2.html") == "<p>two</p>"
+
+    store.close()
+    with open(tmp_path / "note-2.html") as f:
+        assert f.read() == "<p>two</p>"
+    assert store.stats()["writes"] == 2
+
+
+def test_failed_write_keeps_the_note_pending_and_retries(tmp_path, monkeypatch):
+    store = NoteStore(str(tmp_path), delay=0, retry_delay=0.1)
+    failures = [OSError("disk full")]
+
+    def write_once_failing(path, text):
+        if failures:
+            raise failures.pop()
+        write_atomic(path, text)
+    monkeypatch.setattr(note_store, "write_atomic", write_once_failing)
+    store.save(1, "<p>one</p>")
+
+    deadline = time.monotonic() + 5
+    while store.stats()["errors"] == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    # the newer version is still served while the file is not written
+    assert store.read("note-1.html") == "<p>one</p>"
+
+    wait_until_written(store)
+    with open(tmp_path / "note-1.html") as f:
+        assert f.read() == "<p>one</p>"
+    assert store.stats() == {"saves": 1, "writes": 1, "coalesced": 0, "errors": 1, "pending": 0}
+    store.close()
@@ -0,0 +1,96 @@
+import json
+import pytest
+from api import database
+from api.search import to_match_query
+
+
+pytestmark = pytest.mark.usefixtures("db")
+
+
+def paper(key, title, summary="", tags=""):
+    return {
+        "zotero_key": key,
+        "zotero_version": 1,
+        "title": title,
+        "content_type": "zotero_entry",
+        "content_metadata": {"key": key},
+        "summary": summary,
+        "tags": tags,
+        "authors": [],
+    }
+
+
+def titles(results):
+    return [r["title"] for r in results]
+
+
+def test_search_covers_titles_summaries_tags_notes_and_chats():
+    delta = {"ops": [{"insert": "Reading notes on "}, {"insert": "transformers", "attributes": {"bold": True}}, {"insert": "\n"}]}
+    database.store_content_list([
+        paper("K1", "Attention is all you need", summary="We propose the Transformer architecture."),
+        paper("K2", "Deep residual learning", tags="vision,resnet"),
+        {"title": "My note", "content_type": "note", "content_metadata": json.dumps(delta)},
+    ])
+    database.create_chat({"title": "Chat Session"}, [{"role": "user", "content": "Explain residual connections"}], [])
+
+    assert titles(database.search_content("attention")[0]) == ["Attention is all you need"]
+    assert titles(database.search_content("resnet")[0]) == ["Deep residual learning"]
+    assert set(titles(database.search_content("transformer")[0])) == {"Attention is all you need", "My note"}
+    assert set(titles(database.search_content("residual")[0])) == {"Deep residual learning", "Chat Session"}
+
+
+def test_search_ranks_title_matches_first_and_marks_them():
+    database.store_content_list([
+        paper("K1", "A survey", summary="graph neural networks for molecules"),
+        paper("K2", "Graph neural networks"),
+    ])
+
+    results, next_offset = database.search_content("graph neural")
+    assert titles(results) == ["Graph neural networks", "A survey"]
+    assert results[0]["title_highlight"] == "<mark>Graph</mark> <mark>neural</mark> networks"
+    assert "<mark>graph</mark>" in results[1]["snippet"]
+    assert next_offset is None
+
+
+def test_search_highlights_escape_the_text():
+    database.store_content_list([
+        paper("K1", "<img src=x onerror=alert(1)> graph", summary="molecules <script>alert(1)</script>"),
+    ])
+
+    result = database.search_content("graph")[0][0]
+    assert result["title_highlight"] == "&lt;img src=x onerror=alert(1)&gt; <mark>graph</mark>"
+    result = database.search_content("molecules")[0][0]
+    assert result["snippet"] == "<mark>molecules</mark> &lt;script&gt;alert(1)&lt;/script&gt;"
+
+
+def test_search_follows_updates_and_deletes():
+    database.store_content_list([paper("K1", "Old title"), paper("K2", "Kept")])
+    chat_id = database.create_chat({"title": "Chat"}, [], [], return_dict=True)["id"]
+
+    database.merge_content([{**paper("K1", "New title"), "zotero_version": 2}], filter_by_key="zotero_key")
+    database.update_chat(chat_id, [{"role": "assistant", "content": "Bayesian optimisation"}], [])
+    assert database.search_content("old")[0] == []
+    assert titles(database.search_content("new")[0]) == ["New title"]
+    assert titles(database.search_content("bayesian")[0]) == ["Chat"]
+
+    kept_id = database.search_content("kept")[0][0]["id"]
+    database.update_content([{"id": kept_id, "title": "Renamed"}])
+    assert titles(database.search_content("renamed")[0]) == ["Renamed"]
+
+    database.soft_delete_content([{"zotero_key": "K1"}])
+    assert database.search_content("new")[0] == []
+
+
+def test_search_paginates_and_prefix_matches():
+    database.store_content_list([paper(f"K{i}", f"Robotics paper {i}") for i in range(5)])
+
+    page, next_offset = database.search_content("robot", limit=2)
+    assert len(page) == 2 and next_offset == 2
+    page, next_offset = database.search_content("robot", limit=2, offset=4)
+    assert len(page) == 1 and next_offset is None
+
+
+def test_to_match_query_quotes_user_input():
+    assert to_match_query('graph "neural" OR net-') == '"graph" "neural" "OR" "net"*'
+    assert to_match_query(" ?! ") is None
+    assert database.search_content('"unbalanced (') == ([], None)
@@ -0,0 +1,85 @@
+import threading
+import pytest
+
+from api import database
+from api.sync_jobs import SyncRunner
+from api.zotero_sync import sync_zotero_down
+from api.tests.zotero_stub import API_KEY, USER_ID
+
+
+def wait_for(job, timeout=10):
+    for _ in range(int(timeout / 0.01)):
+        if not job.active:
+            return job
+        threading.Event().wait(0.01)
+    raise AssertionError(f"job still {job.status}")
+
+
+def test_concurrent_starts_share_one_job():
+    release = threading.Event()
+    runs = []
+
+    def run_sync(progress):
+        runs.append(1)
+        release.wait(5)
+        return 7
+
+    runner = SyncRunner(run_sync)
+    first = runner.start()
+    second = runner.start()
+    assert second is first
+    release.set()
+    wait_for(first)
+
+    assert (first.status, first.version, len(runs)) == ("succeeded", 7, 1)
+    # a finished job is not joined; the next start runs a new one
+    third = runner.start()
+    wait_for(third)
+    assert third.id != first.id and len(runs) == 2
+    assert runner.get(first.id) is first
+
+
+def test_failures_are_reported_on_the_job():
+    published = []
+
+    def run_sync(progress):
+        raise RuntimeError("Zotero is down")
+
+    runner = SyncRunner(run_sync, published.append)
+    job = wait_for(runner.start())
+
+    assert (job.status, job.error) == ("failed", "Zotero is down")
+    assert [update["status"] for update in published] == ["queued", "running", "failed"]
+
+
+def test_periodic_sync_starts_jobs_on_the_interval():
+    tasks = []
+    runner = SyncRunner(lambda progress: 1, start_task=tasks.append, sleep=lambda seconds: None)
+    runner.start_periodic(60)
+    loop = tasks.pop()
+
+    # run two rounds of the loop, with the sync tasks it starts left queued
+    iterations = iter(range(2))
+    runner.sleep = lambda seconds: next(iterations)
+    with pytest.raises(StopIteration):
+        loop()
+    assert len(tasks) == 1 and runner.current.trigger == "periodic"
+
+
+def test_sync_job_publishes_progress(zotero_stub, db):
+    collection = zotero_stub.add_collection("locus")
+    for i in range(450):
+        zotero_stub.add_item(collection, f"Paper {i}")
+    published = []
+    runner = SyncRunner(lambda progress: sync_zotero_down(API_KEY, USER_ID, "locus", chunk_size=200,
+                                                          progress=progress), published.append)
+
+    job = wait_for(runner.start())
+
+    assert (job.status, job.version) == ("succeeded", zotero_stub.version)
+    running = [update["progress"] for update in published if update["status"] == "running"]
+    assert [(p["items"], p["total"], p["upserted"]) for p in running[1:]] == [(200, 450, 200), (400, 450, 400),
+                                                                              (450, 450, 450)]
+    assert running[-1]["pages"] == 5
+    assert all(p["eta_seconds"] is not None for p in running[1:])
+    assert published[-1]["progress"]["eta_seconds"] == 0
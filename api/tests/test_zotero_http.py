@@ -0,0 +1,191 @@
+import time
+import pytest
+
+from api.tests.zotero_stub import API_KEY, USER_ID
+from api import zotero_http
+from api.zotero_http import CollectionKeyCache, RequestGovernor, ZoteroClient, ZoteroError, collection_keys, get_client
+from api.zotero_sync import get_all_items, get_changed_items_since
+
+
+@pytest.fixture
+def library(zotero_stub):
+    collection = zotero_stub.add_collection("locus")
+    other = zotero_stub.add_collection("other")
+    for i in range(1050):
+        zotero_stub.add_item(collection, f"Item {i}")
+    zotero_stub.add_item(collection, "PDF", item_type="attachment")
+    zotero_stub.add_item(other, "Elsewhere")
+    return collection
+
+
+def test_fetch_all_keeps_order_within_concurrency_limit(zotero_stub, library):
+    zotero_stub.latency = 0.05
+    with ZoteroClient(USER_ID, API_KEY, concurrency=4) as client:
+        start = time.perf_counter()
+        items, version = client.collection_items(library)
+        elapsed = time.perf_counter() - start
+
+    assert [item["data"]["title"] for item in items] == [f"Item {i}" for i in range(1050)]
+    assert version == zotero_stub.version
+    # 11 pages: the first one, then 10 more at most 4 at a time
+    assert len(zotero_stub.requests_to("/items")) == 11
+    assert 1 < zotero_stub.max_in_flight <= 4
+    assert elapsed < 11 * zotero_stub.latency
+    # pooled keep-alive connections
+    assert zotero_stub.connections <= 4
+
+
+def test_fetch_all_refetches_when_library_changes(zotero_stub, library):
+    changed = []
+
+    def change_once(path):
+        if "start=500&" in path and not changed:
+            changed.append(zotero_stub.update_item("I0000000", title="Renamed"))
+    zotero_stub.hooks.append(change_once)
+
+    with ZoteroClient(USER_ID, API_KEY) as client:
+        items, version = client.collection_items(library)
+    assert len(items) == 1050
+    assert version == zotero_stub.version
+    assert len(zotero_stub.requests_to("start=0&")) == 2
+
+
+def test_fetch_all_gives_up_on_a_library_that_keeps_changing(zotero_stub, library, monkeypatch):
+    zotero_stub.hooks.append(lambda path: zotero_stub.update_item("I0000000") if "start=100&" in path else None)
+    with ZoteroClient(USER_ID, API_KEY) as client:
+        with pytest.raises(ZoteroError):
+            client.collection_items(library)
+
+
+def test_sync_functions_use_parallel_fetcher(zotero_stub, library):
+    version, items = get_all_items(API_KEY, USER_ID, "locus")
+    assert len(items) == 1050
+    assert version == zotero_stub.version
+
+    zotero_stub.update_item("I0000003", title="Changed")
+    zotero_stub.delete_item("I0000004")
+    new_version, changed, deleted = get_changed_items_since(API_KEY, USER_ID, "locus", version, get_deleted=True)
+    assert [item["data"]["title"] for item in changed] == ["Changed"]
+    assert new_version == zotero_stub.version
+
+
+def test_shared_client_caches_collection_keys(zotero_stub, library):
+    client = get_client(USER_ID, API_KEY)
+    assert get_client(USER_ID, API_KEY) is client
+    before = collection_keys.stats()
+
+    assert client.collection_key("locus") == library
+    assert client.collection_key("locus", zotero_stub.version) == library
+    get_all_items(API_KEY, USER_ID, "locus")
+    assert len(zotero_stub.requests_to("/collections\\?")) == 1
+    assert collection_keys.stats()["hits"] - before["hits"] == 2
+
+    # a newer library version lists the collections again
+    zotero_stub.add_collection("new")
+    assert client.collection_key("new", zotero_stub.version) is not None
+    assert len(zotero_stub.requests_to("/collections\\?")) == 2
+    assert collection_keys.stats()["invalidated"] - before["invalidated"] == 1
+
+
+def test_collection_keys_expire():
+    now = [0.0]
+    cache = CollectionKeyCache(ttl=60, clock=lambda: now[0])
+    cache.store("lib", [{"data": {"name": "locus", "key": "ABCD"}}], 5)
+
+    assert cache.lookup("lib", "locus", 5) == "ABCD"
+    assert cache.lookup("lib", "other") is None
+    now[0] = 61
+    assert cache.lookup("lib", "locus") is None
+    assert cache.stats() == {"hits": 1, "misses": 2, "expired": 1, "invalidated": 0, "libraries": 1}
+
+
+def test_throttled_requests_wait_for_retry_after(zotero_stub, library):
+    zotero_stub.throttle(2, retry_after=0.2)
+    with ZoteroClient(USER_ID, API_KEY) as client:
+        start = time.perf_counter()
+        assert client.collection_key("locus") == library
+        elapsed = time.perf_counter() - start
+
+    stats = zotero_http.stats()["requests"]
+    assert elapsed >= 0.4
+    assert (stats["throttled"], stats["retries"], stats["pauses"], stats["gave_up"]) == (2, 2, 2, 0)
+    assert stats["concurrency_limit"] < 4
+
+
+def test_server_errors_are_retried_without_shrinking_concurrency(zotero_stub, library):
+    zotero_stub.throttle(2, status=502)
+    with ZoteroClient(USER_ID, API_KEY) as client:
+        items, version = client.collection_items(library)
+
+    stats = zotero_http.stats()["requests"]
+    assert len(items) == 1050
+    assert (stats["server_errors"], stats["retries"], stats["concurrency_limit"]) == (2, 2, 4)
+
+
+def test_requests_give_up_after_max_retries(zotero_stub, library):
+    zotero_stub.throttle(5)
+    governor = RequestGovernor(max_retries=2, base_delay=0.01)
+    with ZoteroClient(USER_ID, API_KEY, request_governor=governor) as client:
+        with pytest.raises(ZoteroError):
+            client.collections()
+    assert (governor.stats()["requests"], governor.stats()["gave_up"]) == (3, 1)
+    assert len(zotero_stub.faults) == 2
+
+
+def test_backoff_header_pauses_later_requests(zotero_stub, library):
+    zotero_stub.backoff = 0.3
+    with ZoteroClient(USER_ID, API_KEY) as client:
+        client.collections()
+        start = time.perf_counter()
+        client.deleted(since=0)
+        assert time.perf_counter() - start >= 0.25
+    assert zotero_http.stats()["requests"]["pauses"] == 1
+
+
+def test_parallel_fetch_survives_throttling(zotero_stub, library):
+    zotero_stub.latency = 0.01
+
+    def throttle_once(path):
+        if "start=300&" in path and not zotero_stub.throttled_once:
+            zotero_stub.throttled_once = True
+            zotero_stub.throttle(3)
+    zotero_stub.throttled_once = False
+    zotero_stub.hooks.append(throttle_once)
+
+    with ZoteroClient(USER_ID, API_KEY) as client:
+        items, _ = client.collection_items(library)
+
+    assert [item["data"]["title"] for item in items] == [f"Item {i}" for i in range(1050)]
+    assert zotero_http.stats()["requests"]["throttled"] == 3
+
+
+def test_governor_adapts_concurrency():
+    governor = RequestGovernor(rate=0, max_concurrency=8)
+    for _ in range(2):
+        governor.acquire()
+        governor.release(throttled=True)
+    assert governor.limit == 2
+
+    limits = []
+    for _ in range(12):
+        governor.acquire()
+        governor.release()
+        limits.append(governor.limit)
+    # one more slot after as many successes in a row as the limit
+    assert limits == [2, 3, 3, 3, 4, 4, 4, 4, 5, 5, 5, 5]
+
+
+def test_governor_token_bucket_paces_requests():
+    governor = RequestGovernor(rate=50, burst=2)
+    start = time.monotonic()
+    for _ in range(7):
+        governor.acquire()
+        governor.release()
+    # two from the burst, then one every 20 ms
+    assert time.monotonic() - start >= 0.09
+    assert governor.stats()["waited_seconds"] >= 0.09
+
+
+def test_retry_delays_are_jittered_and_capped():
+    governor = RequestGovernor(base_delay=1, max_delay=10, jitter=lambda: 0.5)
+    assert [governor.retry_delay(attempt) for attempt in range(6)] == [0.5, 1, 2, 4, 5, 5]
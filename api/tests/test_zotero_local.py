@@ -0,0 +1,220 @@
+import hashlib
+import os
+import sqlite3
+import pytest
+
+from api import database
+from api.converters import zotero2Dict
+from api.models import Content
+from api.tests.zotero_stub import API_KEY, USER_ID
+from api.zotero_local import ZoteroLocalError, ZoteroLocalLibrary, import_zotero_sqlite, open_zotero_db
+from api.zotero_sync import sync_zotero_down
+
+PDF = b"%PDF-1.4\n" + bytes(range(256)) * 100
+
+# the tables of zotero.sqlite the importer reads
+SCHEMA = """
+CREATE TABLE libraries (libraryID INTEGER PRIMARY KEY, type TEXT NOT NULL, editable INT, filesEditable INT,
+                        version INT NOT NULL DEFAULT 0, storageVersion INT, lastSync INT);
+CREATE TABLE itemTypes (itemTypeID INTEGER PRIMARY KEY, typeName TEXT, templateItemTypeID INT, display INT);
+CREATE TABLE fields (fieldID INTEGER PRIMARY KEY, fieldName TEXT, fieldFormatID INT);
+CREATE TABLE items (itemID INTEGER PRIMARY KEY, itemTypeID INT NOT NULL,
+                    dateAdded TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    dateModified TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    clientDateModified TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP, libraryID INT NOT NULL,
+                    key TEXT NOT NULL, version INT NOT NULL DEFAULT 0, synced INT NOT NULL DEFAULT 0);
+CREATE TABLE itemDataValues (valueID INTEGER PRIMARY KEY, value UNIQUE);
+CREATE TABLE itemData (itemID INT, fieldID INT, valueID, PRIMARY KEY (itemID, fieldID));
+CREATE TABLE creatorTypes (creatorTypeID INTEGER PRIMARY KEY, creatorType TEXT);
+CREATE TABLE creators (creatorID INTEGER PRIMARY KEY, firstName TEXT, lastName TEXT, fieldMode INT);
+CREATE TABLE itemCreators (itemID INT NOT NULL, creatorID INT NOT NULL, creatorTypeID INT NOT NULL DEFAULT 1,
+                           orderIndex INT NOT NULL DEFAULT 0, PRIMARY KEY (itemID, orderIndex));
+CREATE TABLE tags (tagID INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE);
+CREATE TABLE itemTags (itemID INT NOT NULL, tagID INT NOT NULL, type INT NOT NULL, PRIMARY KEY (itemID, tagID));
+CREATE TABLE collections (collectionID INTEGER PRIMARY KEY, collectionName TEXT NOT NULL, parentCollectionID INT,
+                          clientDateModified TIMESTAMP, libraryID INT NOT NULL, key TEXT NOT NULL,
+                          version INT NOT NULL DEFAULT 0, synced INT NOT NULL DEFAULT 0);
+CREATE TABLE collectionItems (collectionID INT NOT NULL, itemID INT NOT NULL, orderIndex INT NOT NULL DEFAULT 0,
+                              PRIMARY KEY (collectionID, itemID));
+CREATE TABLE itemAttachments (itemID INTEGER PRIMARY KEY, parentItemID INT, linkMode INT, contentType TEXT,
+                              charsetID INT, path TEXT, syncState INT, storageModTime INT, storageHash TEXT,
+                              lastProcessedModificationTime INT);
+CREATE TABLE itemNotes (itemID INTEGER PRIMARY KEY, parentItemID INT, note TEXT, title TEXT);
+CREATE TABLE deletedItems (itemID INTEGER PRIMARY KEY, dateDeleted DEFAULT CURRENT_TIMESTAMP NOT NULL);
+INSERT INTO libraries VALUES (1, 'user', 1, 1, 740, 12, 0);
+INSERT INTO itemTypes (itemTypeID, typeName) VALUES (1, 'note'), (2, 'attachment'), (3, 'journalArticle'),
+                                                    (4, 'book'), (5, 'annotation');
+INSERT INTO fields (fieldID, fieldName) VALUES (1, 'title'), (2, 'abstractNote'), (3, 'date'), (4, 'DOI');
+INSERT INTO creatorTypes VALUES (1, 'author'), (2, 'editor');
+"""
+
+
+class FixtureLibrary:
+    """
+    Build a Zotero database with the rows the desktop app would write.
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.storage = os.path.join(os.path.dirname(self.path), "storage")
+        self.conn = sqlite3.connect(self.path)
+        self.conn.executescript(SCHEMA)
+        self.next_id = 1
+
+    def _item(self, item_type_id, version, key=None):
+        item_id = self.next_id
+        self.next_id += 1
+        key = key or f"K{item_id:07d}"
+        self.conn.execute("INSERT INTO items (itemID, itemTypeID, dateAdded, dateModified, libraryID, key, version) "
+                          "VALUES (?, ?, '2023-04-02 08:34:50', '2023-04-03 09:00:00', 1, ?, ?)",
+                          (item_id, item_type_id, key, version))
+        return item_id, key
+
+    def add_collection(self, name, key):
+        cursor = self.conn.execute("INSERT INTO collections (collectionName, libraryID, key) VALUES (?, 1, ?)",
+                                   (name, key))
+        return cursor.lastrowid
+
+    def add_item(self, collection_id, title, item_type_id=3, version=700, creators=(), tags=(), **fields):
+        item_id, key = self._item(item_type_id, version)
+        for field, value in {"title": title, **fields}.items():
+            self.conn.execute("INSERT OR IGNORE INTO itemDataValues (value) VALUES (?)", (value,))
+            self.conn.execute("INSERT INTO itemData SELECT ?, fieldID, (SELECT valueID FROM itemDataValues WHERE value = ?) "
+                              "FROM fields WHERE fieldName = ?", (item_id, value, field))
+        for index, (first, last, field_mode) in enumerate(creators):
+            creator_id = self.conn.execute("INSERT INTO creators (firstName, lastName, fieldMode) VALUES (?, ?, ?)",
+                                           (first, last, field_mode)).lastrowid
+            self.conn.execute("INSERT INTO itemCreators VALUES (?, ?, 1, ?)", (item_id, creator_id, index))
+        for name, tag_type in tags:
+            self.conn.execute("INSERT OR IGNORE INTO tags (name) VALUES (?)", (name,))
+            self.conn.execute("INSERT INTO itemTags SELECT ?, tagID, ? FROM tags WHERE name = ?", (item_id, tag_type, name))
+        if collection_id is not None:
+            self.conn.execute("INSERT INTO collectionItems (collectionID, itemID) VALUES (?, ?)", (collection_id, item_id))
+        return item_id, key
+
+    def add_pdf(self, parent_id, filename, content=PDF, link_mode=0):
+        item_id, key = self._item(2, 700)
+        self.conn.execute("INSERT INTO itemAttachments (itemID, parentItemID, linkMode, contentType, path) "
+                          "VALUES (?, ?, ?, 'application/pdf', ?)", (item_id, parent_id, link_mode, f"storage:{filename}"))
+        if content is not None:
+            os.makedirs(os.path.join(self.storage, key))
+            with open(os.path.join(self.storage, key, filename), "wb") as f:
+                f.write(content)
+        return key
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+@pytest.fixture
+def zotero_db(tmp_path):
+    (tmp_path / "zotero").mkdir()
+    library = FixtureLibrary(tmp_path / "zotero" / "zotero.sqlite")
+    collection = library.add_collection("locus", "COLL0001")
+    other = library.add_collection("other", "COLL0002")
+    library.paper_id, library.paper_key = library.add_item(
+        collection, "Attention Is All You Need", abstractNote="Transformers.", date="2017", DOI="10.1/x",
+        creators=[("Ashish", "Vaswani", 0), ("", "Google Brain", 1)], tags=[("nlp", 0), ("auto", 1)])
+    library.conn.execute("INSERT INTO collectionItems (collectionID, itemID) VALUES (?, ?)", (other, library.paper_id))
+    library.add_pdf(library.paper_id, "Vaswani - Attention.pdf")
+    book_id, _ = library.add_item(collection, "A Book", item_type_id=4, version=650)
+    library.add_pdf(book_id, "missing.pdf", content=None)
+    trashed_id, _ = library.add_item(collection, "Trashed")
+    library.conn.execute("INSERT INTO deletedItems (itemID) VALUES (?)", (trashed_id,))
+    library.add_item(collection, "A note", item_type_id=1)
+    library.add_item(other, "Elsewhere")
+    for i in range(30):
+        library.add_item(collection, f"Paper {i}")
+    library.close()
+    return library
+
+
+def stored_content():
+    with database.Session() as session:
+        return {c.title: c.to_dict() for c in session.query(Content)}
+
+
+def test_import_loads_the_collection(db, zotero_db, tmp_path):
+    files = tmp_path / "files"
+
+    counts = import_zotero_sqlite(zotero_db.path, "locus", storage_dir=str(files), chunk_size=8)
+
+    assert counts == {"items": 32, "inserted": 32, "updated": 0, "skipped": 0, "files": 1, "missing_files": 1,
+                      "version": 740}
+    content = stored_content()
+    assert len(content) == 32
+    assert not {"Trashed", "A note", "Elsewhere"} & set(content)
+    paper = content["Attention Is All You Need"]
+    assert (paper["zotero_key"], paper["zotero_version"], paper["content_type"]) == (zotero_db.paper_key, 700, "zotero_entry")
+    assert (paper["summary"], paper["tags"]) == ("Transformers.", "auto,nlp")
+    assert [(a["first_name"], a["last_name"]) for a in paper["authors"]] == [("Ashish", "Vaswani"), ("", "Google Brain")]
+    metadata = paper["content_metadata"]
+    assert (metadata["DOI"], metadata["collections"], metadata["dateAdded"]) == ("10.1/x", ["COLL0001", "COLL0002"],
+                                                                               "2023-04-02T08:34:50Z")
+    assert paper["filename"] == hashlib.sha256(PDF).hexdigest() + ".pdf"
+    assert (files / paper["filename"]).read_bytes() == PDF
+    assert content["A Book"]["filename"] is None
+    assert database.get_latest_version() == 740
+    # imported like synced items, so nothing is queued for upload
+    assert database.get_dirty_content() == []
+
+
+def test_items_have_the_shape_of_the_api(zotero_db):
+    conn = open_zotero_db(zotero_db.path)
+    library = ZoteroLocalLibrary(conn)
+    item, = library.items([zotero_db.paper_id])
+    conn.close()
+
+    assert set(item) >= {"key", "version", "links", "data"}
+    assert item["data"]["itemType"] == "journalArticle"
+    assert item["data"]["tags"] == [{"tag": "auto", "type": 1}, {"tag": "nlp"}]
+    converted = zotero2Dict(item)
+    assert (converted["title"], converted["zotero_key"]) == ("Attention Is All You Need", zotero_db.paper_key)
+
+
+def test_creators_are_named_as_by_the_api(zotero_db):
+    conn = open_zotero_db(zotero_db.path)
+    item, = ZoteroLocalLibrary(conn).items([zotero_db.paper_id])
+    conn.close()
+    # the same item, as the API serves it
+    api_item = {**item, "data": {**item["data"], "creators": [
+        {"creatorType": "author", "firstName": "Ashish", "lastName": "Vaswani"},
+        {"creatorType": "author", "name": "Google Brain"}]}}
+
+    assert item["data"]["creators"] == api_item["data"]["creators"]
+    assert zotero2Dict(item)["authors"] == zotero2Dict(api_item)["authors"] == [
+        {"first_name": "Ashish", "last_name": "Vaswani"}, {"first_name": "", "last_name": "Google Brain"}]
+
+
+def test_import_does_not_write_to_the_zotero_database(db, zotero_db, tmp_path):
+    before = os.path.getmtime(zotero_db.path), os.path.getsize(zotero_db.path)
+    conn = open_zotero_db(zotero_db.path)
+    with pytest.raises(sqlite3.OperationalError):
+        conn.execute("DELETE FROM items")
+    conn.close()
+
+    import_zotero_sqlite(zotero_db.path, "locus", storage_dir=None)
+
+    assert (os.path.getmtime(zotero_db.path), os.path.getsize(zotero_db.path)) == before
+
+
+def test_import_reports_unknown_collections(db, zotero_db, tmp_path):
+    with pytest.raises(ZoteroLocalError):
+        import_zotero_sqlite(zotero_db.path, "nope", storage_dir=None)
+    with pytest.raises(ZoteroLocalError):
+        import_zotero_sqlite(str(tmp_path / "missing.sqlite"), "locus")
+
+
+def test_sync_after_import_is_incremental(db, zotero_db, zotero_stub):
+    import_zotero_sqlite(zotero_db.path, "locus", storage_dir=None)
+    collection = zotero_stub.add_collection("locus")
+    zotero_stub.version = 740
+    zotero_stub.add_item(collection, "Added after the import")
+
+    sync_zotero_down(API_KEY, USER_ID, "locus")
+
+    items_requests = zotero_stub.requests_to("/items")
+    assert len(items_requests) == 1 and "since=740" in items_requests[0]
+    assert len(stored_content()) == 33
+    assert database.get_latest_version() == 741
@@ -14,6 +14,8 @@ from api.zotero_sync import (
     get_collection_id_by_name,
     sync_zotero_down,
     create_item_in_collection,
+    upload_dirty_content,
+    sync_zotero_up_down,
 )
 from typing import Dict
 
@@ -84,3 +86,295 @@ def test_get_collection_id_by_name():
 
 # Additional tests for sync_zotero_down and sync_zotero_up_down can be added here.
 # These tests may require mocking the database functions to avoid modifying the actual database.
+
+
+# Sync tests against the local stub server (see zotero_stub.py)
+from api import database
+from api.models import Base, Content
+from api.tests import zotero_stub as stub_api
+from api.zotero_http import ZoteroError
+import gc
+import tracemalloc
+
+
+@pytest.fixture
+def stub_library(zotero_stub):
+    collection = zotero_stub.add_collection("locus")
+    for i in range(450):
+        zotero_stub.add_item(collection, f"Item {i}", creators=[{"creatorType": "author", "firstName": "Ada", "lastName": f"L{i % 7}"}])
+    zotero_stub.add_item(collection, "", item_type="note")
+    return zotero_stub
+
+
+def stored_titles():
+    with database.Session() as session:
+        return sorted(title for title, in session.query(Content.title).filter(Content.deleted == False))
+
+
+def test_sync_commits_in_chunks(db, stub_library, mocker):
+    chunks = mocker.spy(database, "store_sync_chunk")
+    mocker.patch("api.zotero_sync.store_sync_chunk", chunks)
+
+    version = sync_zotero_down(stub_api.API_KEY, stub_api.USER_ID, "locus", chunk_size=200)
+
+    assert version == stub_library.version
+    assert database.get_latest_version() == version
+    assert [len(call.args[0]) for call in chunks.call_args_list] == [200, 200, 50]
+    assert len(stored_titles()) == 450
+    assert database.get_sync_checkpoint() is None
+
+
+def test_interrupted_sync_resumes_from_checkpoint(db, stub_library, mocker):
+    calls = []
+
+    def fail_third_chunk(content_list, checkpoint):
+        calls.append(checkpoint["start"])
+        if len(calls) == 3:
+            raise ConnectionError("lost the database")
+        return database.store_sync_chunk(content_list, checkpoint)
+    mocker.patch("api.zotero_sync.store_sync_chunk", fail_third_chunk)
+
+    with pytest.raises(ConnectionError):
+        sync_zotero_down(stub_api.API_KEY, stub_api.USER_ID, "locus", chunk_size=100)
+    assert database.get_sync_checkpoint()["start"] == 200
+    assert len(stored_titles()) == 200
+
+    stub_library.requests.clear()
+    mocker.patch("api.zotero_sync.store_sync_chunk", database.store_sync_chunk)
+    sync_zotero_down(stub_api.API_KEY, stub_api.USER_ID, "locus", chunk_size=100)
+
+    item_requests = stub_library.requests_to("/items")
+    assert "start=200&" in item_requests[0]
+    assert not any("start=0&" in path or "start=100&" in path for path in item_requests)
+    assert len(stored_titles()) == 450
+    assert database.get_sync_checkpoint() is None
+
+
+def test_resume_starts_over_when_library_changed(db, stub_library, mocker):
+    original = database.store_sync_chunk
+
+    def fail_second_chunk(content_list, checkpoint):
+        if checkpoint["start"] == 200:
+            raise ConnectionError("lost the database")
+        return original(content_list, checkpoint)
+    mocker.patch("api.zotero_sync.store_sync_chunk", fail_second_chunk)
+    with pytest.raises(ConnectionError):
+        sync_zotero_down(stub_api.API_KEY, stub_api.USER_ID, "locus")
+
+    stub_library.update_item("I0000000", title="Renamed")
+    mocker.patch("api.zotero_sync.store_sync_chunk", original)
+    stub_library.requests.clear()
+    sync_zotero_down(stub_api.API_KEY, stub_api.USER_ID, "locus")
+
+    resumed, restarted = stub_library.requests_to("/items")[:2]
+    assert "start=100&" in resumed and "start=0&" in restarted
+    assert "Renamed" in stored_titles()
+    assert len(stored_titles()) == 450
+
+
+def test_incremental_sync_applies_changes(db, stub_library):
+    sync_zotero_down(stub_api.API_KEY, stub_api.USER_ID, "locus")
+    stub_library.update_item("I0000001", title="Changed")
+    stub_library.requests.clear()
+
+    version = sync_zotero_down(stub_api.API_KEY, stub_api.USER_ID, "locus")
+
+    assert version == stub_library.version
+    assert "Changed" in stored_titles()
+    assert len(stub_library.requests_to("/items")) == 1
+
+
+def test_unchanged_library_sync_writes_nothing(db, stub_library):
+    version = sync_zotero_down(stub_api.API_KEY, stub_api.USER_ID, "locus")
+    library_version = database.get_library_version()
+    stub_library.requests.clear()
+
+    assert sync_zotero_down(stub_api.API_KEY, stub_api.USER_ID, "locus") == version
+
+    # one conditional request answered with 304; the cached collection key saves the listing
+    assert stub_library.requests_to("/") == stub_library.requests_to("/items")
+    assert len(stub_library.requests) == 1
+    assert database.get_library_version() == library_version
+
+
+def test_sync_applies_deletions_since_previous_version(db, stub_library):
+    version = sync_zotero_down(stub_api.API_KEY, stub_api.USER_ID, "locus")
+    stub_library.delete_item("I0000002")
+    stub_library.update_item("I0000003", title="Changed")
+    stub_library.requests.clear()
+
+    sync_zotero_down(stub_api.API_KEY, stub_api.USER_ID, "locus")
+
+    assert stub_library.requests_to("/deleted") == [f"/users/{stub_api.USER_ID}/deleted?since={version}"]
+    assert "Item 2" not in stored_titles()
+    assert "Changed" in stored_titles()
+    assert database.get_latest_version() == stub_library.version
+
+
+def test_sync_memory_does_not_grow_with_library(db, zotero_stub):
+    collection = zotero_stub.add_collection("locus")
+
+    def peak_for(count):
+        Base.metadata.drop_all(database.engine)
+        Base.metadata.create_all(database.engine)
+        zotero_stub.items = []
+        for i in range(count):
+            zotero_stub.add_item(collection, f"Item {i}", abstractNote="x" * 2000)
+        # the objects earlier tests left would delay full collections of the sync's garbage cycles
+        gc.collect()
+        gc.freeze()
+        tracemalloc.start()
+        sync_zotero_down(stub_api.API_KEY, stub_api.USER_ID, "locus")
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        gc.unfreeze()
+        return peak
+
+    small, large = peak_for(400), peak_for(2000)
+    # five times the items; the full-list sync needed about five times the memory
+    assert large < 2 * small
+
+
+def save_notes(count):
+    stored, error = database.store_content_list(
+        [{"content_type": "note", "title": f"Note {i}", "content_metadata": {"ops": [{"insert": f"Text {i}\n"}]},
+          "tags": "draft", "authors": []} for i in range(count)], return_dict=True)
+    assert error is None
+    return stored
+
+
+def zotero_state(content_id):
+    with database.Session() as session:
+        content = session.get(Content, content_id)
+        return content.zotero_key, content.zotero_version, content.zotero_dirty
+
+
+def test_upload_creates_notes_in_batches(db, stub_library):
+    sync_zotero_down(stub_api.API_KEY, stub_api.USER_ID, "locus")
+    notes = save_notes(120)
+    assert len(database.get_dirty_content(200)) == 120
+
+    counts = upload_dirty_content(stub_api.API_KEY, stub_api.USER_ID, "locus")
+
+    assert counts == {"created": 120, "updated": 0, "unchanged": 0, "failed": 0, "deferred": 0}
+    assert stub_library.write_batches == [50, 50, 20]
+    key, version, dirty = zotero_state(notes[0]["id"])
+    uploaded = next(item for item in stub_library.items if item["key"] == key)
+    assert (uploaded["data"]["itemType"], uploaded["version"], dirty) == ("note", version, False)
+    assert uploaded["data"]["note"] == "<h1>Note 0</h1><p>Text 0</p>"
+    assert uploaded["data"]["collections"] == [stub_library.collections[0]["key"]]
+    assert database.get_dirty_content() == []
+    # the upload was the only change, so the next sync has nothing to fetch
+    assert database.get_latest_version() == stub_library.version
+
+
+def test_sync_down_does_not_queue_uploads(db, stub_library):
+    sync_zotero_down(stub_api.API_KEY, stub_api.USER_ID, "locus")
+    stub_library.update_item("I0000003", title="Changed")
+    sync_zotero_down(stub_api.API_KEY, stub_api.USER_ID, "locus")
+
+    assert database.get_dirty_content() == []
+
+
+def test_upload_updates_edited_entries(db, stub_library):
+    sync_zotero_down(stub_api.API_KEY, stub_api.USER_ID, "locus")
+    with database.Session() as session:
+        entry_id, = session.query(Content.id).filter(Content.zotero_key == "I0000004").one()
+    database.update_content([{"id": entry_id, "summary": "A local summary"}])
+
+    counts = upload_dirty_content(stub_api.API_KEY, stub_api.USER_ID, "locus")
+
+    assert (counts["updated"], stub_library.write_batches) == (1, [1])
+    item = next(item for item in stub_library.items if item["key"] == "I0000004")
+    assert item["data"]["abstractNote"] == "A local summary"
+    assert zotero_state(entry_id) == ("I0000004", item["version"], False)
+
+
+def test_upload_keeps_rows_edited_during_upload_queued(db, stub_library):
+    sync_zotero_down(stub_api.API_KEY, stub_api.USER_ID, "locus")
+    note = save_notes(1)[0]
+    stub_library.hooks.append(lambda path: database.update_content([{"id": note["id"], "title": "Edited"}]))
+
+    upload_dirty_content(stub_api.API_KEY, stub_api.USER_ID, "locus")
+
+    key, version, dirty = zotero_state(note["id"])
+    assert key is not None and dirty
+    assert [c["id"] for c in database.get_dirty_content()] == [note["id"]]
+
+
+def test_upload_stops_when_library_changed(db, stub_library):
+    sync_zotero_down(stub_api.API_KEY, stub_api.USER_ID, "locus")
+    notes = save_notes(3)
+    stub_library.update_item("I0000003", title="Changed remotely")
+
+    counts = upload_dirty_content(stub_api.API_KEY, stub_api.USER_ID, "locus")
+
+    assert (counts["created"], counts["deferred"]) == (0, 3)
+    assert stub_library.write_batches == []
+    assert len(database.get_dirty_content()) == 3
+
+    # after the next sync the precondition holds again
+    sync_zotero_down(stub_api.API_KEY, stub_api.USER_ID, "locus")
+    assert upload_dirty_content(stub_api.API_KEY, stub_api.USER_ID, "locus")["created"] == 3
+
+
+def test_upload_reports_items_changed_in_zotero(db, stub_library):
+    sync_zotero_down(stub_api.API_KEY, stub_api.USER_ID, "locus")
+    with database.Session() as session:
+        entry_id, = session.query(Content.id).filter(Content.zotero_key == "I0000005").one()
+    database.update_content([{"id": entry_id, "title": "Local title"}])
+    # the item changes in Zotero and the stored library version catches up without the item being synced
+    stub_library.update_item("I0000005", title="Remote title")
+    database.store_latest_version(stub_library.version)
+
+    counts = upload_dirty_content(stub_api.API_KEY, stub_api.USER_ID, "locus")
+
+    assert counts["failed"] == 1
+    assert zotero_state(entry_id)[2]
+
+
+def test_sync_down_keeps_local_edits_of_items_changed_in_zotero(db, stub_library):
+    sync_zotero_down(stub_api.API_KEY, stub_api.USER_ID, "locus")
+    with database.Session() as session:
+        entry_id, = session.query(Content.id).filter(Content.zotero_key == "I0000006").one()
+    database.update_content([{"id": entry_id, "summary": "A local summary"}])
+    stub_library.update_item("I0000006", title="Remote title")
+
+    counts = sync_zotero_up_down(stub_api.API_KEY, stub_api.USER_ID, "locus")
+
+    # the upload is made against the version the local edit started from, so Zotero rejects it
+    assert counts["failed"] == 1
+    current = database.get_content_by_id(entry_id)
+    assert (current["summary"], current["title"]) == ("A local summary", "Item 6")
+    assert zotero_state(entry_id)[2]
+    item = next(item for item in stub_library.items if item["key"] == "I0000006")
+    assert item["data"]["title"] == "Remote title"
+
+
+def test_sync_needs_the_collection(db, stub_library):
+    save_notes(1)
+
+    with pytest.raises(ZoteroError, match="no collection named 'lotus'"):
+        sync_zotero_down(stub_api.API_KEY, stub_api.USER_ID, "lotus")
+    with pytest.raises(ZoteroError, match="no collection named 'lotus'"):
+        upload_dirty_content(stub_api.API_KEY, stub_api.USER_ID, "lotus")
+    assert stub_library.write_batches == []
+    assert len(database.get_dirty_content()) == 1
+
+
+def test_upload_with_a_lost_response_does_not_duplicate_notes(db, stub_library):
+    sync_zotero_down(stub_api.API_KEY, stub_api.USER_ID, "locus")
+    notes = save_notes(3)
+    stub_library.lost_writes = 1
+
+    # the retry of the applied write is refused, so the upload does not learn of the new items
+    assert upload_dirty_content(stub_api.API_KEY, stub_api.USER_ID, "locus")["deferred"] == 3
+    assert len(database.get_dirty_content()) == 3
+
+    sync_zotero_down(stub_api.API_KEY, stub_api.USER_ID, "locus")
+    counts = upload_dirty_content(stub_api.API_KEY, stub_api.USER_ID, "locus")
+
+    assert (counts["created"], counts["unchanged"]) == (0, 3)
+    assert len([item for item in stub_library.items if item["data"]["itemType"] == "note"]) == 1 + 3
+    key, _, dirty = zotero_state(notes[0]["id"])
+    assert any(item["key"] == key for item in stub_library.items) and not dirty
@@ -0,0 +1,313 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+import hashlib
+import json
+import re
+import threading
+import time
+
+"""
+A local stand-in for the Zotero Web API, for tests that exercise the HTTP sync code. It serves one user library from
+memory, with the paging headers of the real API (Total-Results, Last-Modified-Version), answers If-Modified-Since-Version
+with 304 Not Modified while the library is unchanged, and can inject latency into every request. Items can be written
+with POST /items, in batches of up to 50 objects, with If-Unmodified-Since-Version preconditions and write tokens, and a
+write can be applied with its response lost. It can throttle: answer the next requests with 429 (or another status)
+and Retry-After, or send a Backoff header. It records the
+requests it served, the connections it accepted, the size of every write batch and the peak number of requests in
+flight.
+"""
+
+API_KEY = "stub-api-key"
+USER_ID = "12345"
+
+
+class ZoteroStub:
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.version = 0
+        self.collections: List[dict] = []
+        self.items: List[dict] = []
+        self.deleted: Dict[str, int] = {}
+        # attachment key -> file content
+        self.files: Dict[str, bytes] = {}
+        # the Range header of every file request, None for whole-file requests
+        self.ranges: List[Optional[str]] = []
+        self.requests: List[str] = []
+        # the number of objects in every write request
+        self.write_batches: List[int] = []
+        self.in_flight = 0
+        self.connections = 0
+        self.max_in_flight = 0
+        # (status, headers) served instead of the next requests
+        self.faults: List[Tuple[int, Dict[str, str]]] = []
+        # the next writes are applied, but answered with a 500 as if the response was lost
+        self.lost_writes = 0
+        # the Zotero-Write-Token of every applied write; a write reusing one fails with 412
+        self.write_tokens = set()
+        # seconds sent in a Backoff header with the next successful response
+        self.backoff: Optional[float] = None
+        # callables run with the request path before every request is served
+        self.hooks = []
+        # the filtered item list of a collection listing, reused by its pages: (query, library state) -> items
+        self._listings: Dict[tuple, Tuple[tuple, List[dict]]] = {}
+        self._lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def start(self) -> "ZoteroStub":
+        stub = self
+
+        class Handler(StubHandler):
+            pass
+        Handler.stub = stub
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def add_collection(self, name: str) -> str:
+        key = f"C{len(self.collections):07d}"
+        self.version += 1
+        self.collections.append({"key": key, "version": self.version, "data": {"key": key, "name": name}})
+        return key
+
+    def add_item(self, collection: str, title: str, item_type: str = "journalArticle", **data) -> dict:
+        self.version += 1
+        key = data.pop("key", f"I{len(self.items):07d}")
+        item = {
+            "key": key,
+            "version": self.version,
+            "library": {"type": "user", "id": int(USER_ID)},
+            "links": {},
+            "meta": {},
+            "data": {"key": key, "version": self.version, "itemType": item_type, "title": title,
+                     "creators": [], "tags": [], "collections": [collection], "dateAdded": "2023-04-02T08:34:50Z",
+                     "dateModified": "2023-04-02T08:34:50Z", **data},
+        }
+        self.items.append(item)
+        return item
+
+    def add_attachment(self, collection: str, parent: str, filename: str, content: bytes,
+                       content_type: str = "application/pdf", **data) -> dict:
+        attachment = self.add_item(collection, filename, item_type="attachment", parentItem=parent,
+                                   contentType=content_type, linkMode="imported_file", filename=filename,
+                                   md5=hashlib.md5(content).hexdigest(), **data)
+        self.files[attachment["key"]] = content
+        return attachment
+
+    def update_item(self, key: str, **data) -> dict:
+        self.version += 1
+        item = next(item for item in self.items if item["key"] == key)
+        item["version"] = item["data"]["version"] = self.version
+        item["data"].update(data)
+        return item
+
+    def delete_item(self, key: str) -> None:
+        self.version += 1
+        self.items = [item for item in self.items if item["key"] != key]
+        self.deleted[key] = self.version
+
+    def collection_items(self, collection: str, since: int = 0, item_type: Optional[str] = None) -> List[dict]:
+        state = (self.version, id(self.items), len(self.items))
+        listing = (collection, since, item_type)
+        with self._lock:
+            cached = self._listings.get(listing)
+        if cached is not None and cached[0] == state:
+            return cached[1]
+        items = [item for item in self.items if collection in item["data"]["collections"] and item["version"] > since]
+        if item_type == "-attachment":
+            items = [item for item in items if item["data"]["itemType"] != "attachment"]
+        elif item_type:
+            items = [item for item in items if item["data"]["itemType"] == item_type]
+        with self._lock:
+            self._listings[listing] = (state, items)
+        return items
+
+    def throttle(self, count: int = 1, status: int = 429, retry_after: Optional[float] = None) -> None:
+        headers = {"Retry-After": str(retry_after)} if retry_after is not None else {}
+        self.faults.extend([(status, headers)] * count)
+
+    def requests_to(self, pattern: str) -> List[str]:
+        return [path for path in self.requests if re.search(pattern, path)]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # keep-alive, so clients can reuse connections
+    protocol_version = "HTTP/1.1"
+    stub: ZoteroStub = None
+
+    def setup(self):
+        super().setup()
+        with self.stub._lock:
+            self.stub.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.serve(self.route)
+
+    def do_POST(self):
+        self.serve(self.route_write)
+
+    def serve(self, route):
+        stub = self.stub
+        with stub._lock:
+            stub.requests.append(self.path)
+            stub.in_flight += 1
+            stub.max_in_flight = max(stub.max_in_flight, stub.in_flight)
+        try:
+            if stub.latency:
+                time.sleep(stub.latency)
+            for hook in stub.hooks:
+                hook(self.path)
+            with stub._lock:
+                fault = stub.faults.pop(0) if stub.faults else None
+            if fault:
+                # read the body of a write, so the connection can be kept alive
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                return self.send_json(fault[0], "Throttled", fault[1])
+            route()
+        finally:
+            with stub._lock:
+                stub.in_flight -= 1
+
+    def route(self):
+        stub = self.stub
+        if self.headers.get("Zotero-API-Key") != API_KEY:
+            return self.send_json(403, "Forbidden")
+        url = urlparse(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        prefix = f"/users/{USER_ID}"
+        if not url.path.startswith(prefix):
+            return self.send_json(404, "Not found")
+        path = url.path[len(prefix):]
+
+        if_modified_since = self.headers.get("If-Modified-Since-Version")
+        if if_modified_since is not None and stub.version <= int(if_modified_since):
+            return self.send_not_modified()
+        if path == "/collections":
+            return self.send_page(stub.collections, query)
+        match = re.fullmatch(r"/collections/(\w+)/items", path)
+        if match:
+            return self.send_page(stub.collection_items(match.group(1), int(query.get("since", 0)),
+                                                        query.get("itemType")), query)
+        match = re.fullmatch(r"/items/(\w+)/children", path)
+        if match:
+            return self.send_page([item for item in stub.items if item["data"].get("parentItem") == match.group(1)], query)
+        match = re.fullmatch(r"/items/(\w+)/file", path)
+        if match:
+            if match.group(1) not in stub.files:
+                return self.send_json(404, "Not found")
+            return self.send_file(stub.files[match.group(1)])
+        if path == "/deleted":
+            since = int(query.get("since", 0))
+            keys = [key for key, version in stub.deleted.items() if version > since]
+            return self.send_json(200, {"items": keys, "collections": [], "searches": [], "tags": [], "settings": []})
+        return self.send_json(404, "Not found")
+
+    def route_write(self):
+        stub = self.stub
+        objects = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"[]")
+        if self.headers.get("Zotero-API-Key") != API_KEY:
+            return self.send_json(403, "Forbidden")
+        if urlparse(self.path).path != f"/users/{USER_ID}/items":
+            return self.send_json(404, "Not found")
+        if len(objects) > 50:
+            return self.send_json(413, "Only 50 objects can be written at once")
+        if_unmodified_since = self.headers.get("If-Unmodified-Since-Version")
+        write_token = self.headers.get("Zotero-Write-Token")
+        with stub._lock:
+            if write_token in stub.write_tokens:
+                return self.send_json(412, "Write token already used")
+            if if_unmodified_since is not None and stub.version > int(if_unmodified_since):
+                return self.send_json(412, f"Library has been modified since version {if_unmodified_since}")
+            if write_token is not None:
+                stub.write_tokens.add(write_token)
+            stub.write_batches.append(len(objects))
+            result = {"successful": {}, "success": {}, "unchanged": {}, "failed": {}}
+            # one new library version for all the writes of a request
+            version = stub.version + 1
+            for index, data in enumerate(objects):
+                index = str(index)
+                data = dict(data)
+                key = data.pop("key", None)
+                expected = data.pop("version", None)
+                item = next((item for item in stub.items if item["key"] == key), None)
+                if item is None:
+                    key = key or f"N{len(stub.items):07d}"
+                    item = {"key": key, "version": version, "library": {"type": "user", "id": int(USER_ID)},
+                            "links": {}, "meta": {},
+                            "data": {"key": key, "version": version, "tags": [], "collections": [], **data}}
+                    stub.items.append(item)
+                elif expected is not None and expected < item["version"]:
+                    result["failed"][index] = {"key": key, "code": 412,
+                                               "message": f"Item has been modified since version {expected}"}
+                    continue
+                elif all(item["data"].get(field) == value for field, value in data.items()):
+                    result["unchanged"][index] = key
+                    continue
+                else:
+                    item["version"] = item["data"]["version"] = version
+                    item["data"].update(data)
+                result["successful"][index] = item
+                result["success"][index] = key
+            if result["successful"]:
+                stub.version = version
+            lost = stub.lost_writes > 0
+            if lost:
+                stub.lost_writes -= 1
+        if lost:
+            return self.send_json(500, "Internal Server Error")
+        self.send_json(200, result)
+
+    def send_page(self, objects: List[dict], query: Dict[str, str]):
+        start = int(query.get("start", 0))
+        limit = int(query.get("limit", 25))
+        self.send_json(200, objects[start:start + limit], {"Total-Results": str(len(objects))})
+
+    def send_file(self, content: bytes):
+        requested = self.headers.get("Range")
+        self.stub.ranges.append(requested)
+        start = int(re.fullmatch(r"bytes=(\d+)-", requested).group(1)) if requested else 0
+        if start >= len(content) and requested:
+            self.send_response(416)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(206 if requested else 200)
+        self.send_header("Content-Type", "application/pdf")
+        self.send_header("Content-Length", str(len(content) - start))
+        if requested:
+            self.send_header("Content-Range", f"bytes {start}-{len(content) - 1}/{len(content)}")
+        self.end_headers()
+        self.wfile.write(content[start:])
+
+    def send_not_modified(self):
+        self.send_response(304)
+        self.send_header("Last-Modified-Version", str(self.stub.version))
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def send_json(self, status: int, body, headers: Optional[Dict[str, str]] = None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Last-Modified-Version", str(self.stub.version))
+        if self.stub.backoff is not None and status < 400:
+            self.send_header("Backoff", str(self.stub.backoff))
+            self.stub.backoff = None
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
@@ -0,0 +1,615 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Tuple
+from requests.adapters import HTTPAdapter
+import logging
+import os
+import random
+import requests
+import threading
+import time
+import uuid
+
+"""
+zotero_http.py
+
+This module contains a small client for the Zotero Web API (v3) used by the sync code. Unlike pyzotero, which pages
+through a listing one request at a time, `ZoteroClient.fetch_all` reads `Total-Results` from the first page and then
+fetches the remaining `start=` offsets in parallel, with a configurable concurrency limit. `ZoteroClient.iter_pages`
+does the same as a stream: it yields the pages in order while at most that many are fetched ahead, so a consumer can
+process a large listing in bounded memory. All requests go through one `requests.Session` whose connection pool is
+sized to that limit, so the pages reuse kept-alive connections.
+
+Zotero has no snapshot reads, so a write to the library while the pages are being fetched could shift items between
+pages. Every page reports the library version it was served at (`Last-Modified-Version`); if the versions disagree the
+listing is fetched again.
+
+Every request of every client goes through one `RequestGovernor`, since the API's limits apply to all of them:
+- a token bucket caps the request rate
+- a `Backoff` header, or `Retry-After` on a 429 or 503, pauses all requests for the given number of seconds
+- 429 and 5xx responses and connection errors are retried with jittered exponential delays
+- the number of requests in flight is halved on throttling and grows back by one after a run of successes
+The throttle events are counted in `stats()`, which /metrics reports.
+
+Configuration:
+- ZOTERO_API_URL: the API root, e.g. a local stub server in tests (default https://api.zotero.org)
+- ZOTERO_FETCH_CONCURRENCY: the maximum number of pages fetched at once (default 4)
+- ZOTERO_RATE_LIMIT: the sustained request rate, in requests per second (default 10)
+- ZOTERO_RATE_BURST: the requests that can be sent at once after an idle period (default 20)
+- ZOTERO_MAX_RETRIES: retries of a throttled or failed request before giving up (default 5)
+"""
+
+logger = logging.getLogger(__name__)
+
+ZOTERO_API_URL = os.getenv("ZOTERO_API_URL", "https://api.zotero.org")
+ZOTERO_FETCH_CONCURRENCY = int(os.getenv("ZOTERO_FETCH_CONCURRENCY", 4))
+# the largest page the API serves
+PAGE_SIZE = 100
+# the most objects the API accepts in one write request
+WRITE_BATCH_SIZE = 50
+# the characters of Zotero object keys
+ZOTERO_KEY_CHARS = "23456789ABCDEFGHIJKLMNPQRSTUVWXYZ"
+# attempts at a consistent listing while the library keeps changing
+FETCH_ATTEMPTS = 3
+REQUEST_TIMEOUT = 30
+ZOTERO_COLLECTION_TTL = float(os.getenv("ZOTERO_COLLECTION_TTL", 3600))
+ZOTERO_RATE_LIMIT = float(os.getenv("ZOTERO_RATE_LIMIT", 10))
+ZOTERO_RATE_BURST = int(os.getenv("ZOTERO_RATE_BURST", 20))
+ZOTERO_MAX_RETRIES = int(os.getenv("ZOTERO_MAX_RETRIES", 5))
+# statuses that are worth retrying; 429 and 503 also mean the API is throttling us
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+THROTTLE_STATUSES = (429, 503)
+# the first retry delay and the cap of the exponential delays, in seconds
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 60.0
+
+
+class ZoteroError(Exception):
+    pass
+
+
+class PreconditionFailed(ZoteroError):
+    """
+    The library changed since the version a write was conditioned on (412).
+    """
+    pass
+
+
+def _header_seconds(response: requests.Response, name: str) -> Optional[float]:
+    try:
+        return float(response.headers[name])
+    except (KeyError, ValueError):
+        return None
+
+
+class RequestGovernor:
+    """
+    Pace, pause and retry the requests of all Zotero clients: a token bucket, header-driven pauses, jittered retries
+    and an adaptive limit on the requests in flight.
+    """
+
+    def __init__(self, rate: float = ZOTERO_RATE_LIMIT, burst: int = ZOTERO_RATE_BURST,
+                 max_concurrency: int = ZOTERO_FETCH_CONCURRENCY, max_retries: int = ZOTERO_MAX_RETRIES,
+                 base_delay: float = RETRY_BASE_DELAY, max_delay: float = RETRY_MAX_DELAY,
+                 clock: Callable[[], float] = time.monotonic, sleep: Callable[[float], None] = time.sleep,
+                 jitter: Callable[[], float] = random.random):
+        """
+        :param rate: The sustained request rate, in requests per second; 0 for no limit
+        :param burst: The size of the token bucket
+        :param max_concurrency: The most requests in flight; the limit shrinks below it on throttling
+        :param max_retries: The retries of a request before its last response (or error) is returned (raised)
+        :param base_delay: The delay before the first retry without a Retry-After, in seconds; it doubles per retry
+        :param max_delay: The cap of the retry delay, in seconds
+        :param clock: Returns the current time in seconds
+        :param sleep: Sleeps between retries
+        :param jitter: Returns a random number in [0, 1) to spread the retry delays
+        """
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.clock = clock
+        self.sleep = sleep
+        self.jitter = jitter
+        self.limit = self.max_concurrency
+        self.in_flight = 0
+        self._tokens = float(self.burst)
+        self._refilled_at = clock()
+        self._paused_until = 0.0
+        # successful requests since the limit last changed
+        self._successes = 0
+        self._condition = threading.Condition()
+        self.requests = 0
+        self.throttled = 0
+        self.server_errors = 0
+        self.connection_errors = 0
+        self.retries = 0
+        self.gave_up = 0
+        self.pauses = 0
+        self.paused_seconds = 0.0
+        self.waited_seconds = 0.0
+
+    def _take_token(self, now: float) -> float:
+        """
+        Take a token if one is available; otherwise return the time until the next one.
+        """
+        if self.rate <= 0:
+            return 0.0
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+    def acquire(self) -> None:
+        """
+        Wait until a request may be sent: no pause is in effect, a slot below the concurrency limit is free and the
+        token bucket has a token.
+        """
+        started = self.clock()
+        with self._condition:
+            while True:
+                now = self.clock()
+                wait = self._paused_until - now
+                if wait <= 0 and self.in_flight >= self.limit:
+                    self._condition.wait()
+                    continue
+                if wait <= 0:
+                    wait = self._take_token(now)
+                    if wait <= 0:
+                        self.in_flight += 1
+                        self.requests += 1
+                        self.waited_seconds += now - started
+                        return
+                self._condition.wait(wait)
+
+    def release(self, throttled: bool = False) -> None:
+        """
+        Free the slot of a finished request and adapt the concurrency limit: halve it on throttling, and raise it by
+        one after as many successes in a row as the limit.
+        """
+        with self._condition:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(1, self.limit // 2)
+                self._successes = 0
+            else:
+                self._successes += 1
+                if self.limit < self.max_concurrency and self._successes >= self.limit:
+                    self.limit += 1
+                    self._successes = 0
+            self._condition.notify_all()
+
+    def pause(self, seconds: float) -> None:
+        """
+        Hold back all requests for `seconds`, e.g. as asked by a Backoff or Retry-After header.
+        """
+        with self._condition:
+            until = self.clock() + seconds
+            if until > self._paused_until:
+                self.paused_seconds += until - max(self._paused_until, self.clock())
+                self._paused_until = until
+                self.pauses += 1
+            self._condition.notify_all()
+
+    def retry_delay(self, attempt: int) -> float:
+        """
+        The delay before retry number `attempt` (from 0): a random share of an exponentially growing cap ("full
+        jitter"), so clients that were throttled together do not retry together.
+        """
+        return self.jitter() * min(self.max_delay, self.base_delay * 2 ** attempt)
+
+    def request(self, send: Callable[[], requests.Response]) -> requests.Response:
+        """
+        Send a request under the governor, retrying it while it is throttled or fails.
+
+        :param send: Sends the request and returns the response
+        :return: The response; after the last retry it may still have an error status
+        :raises requests.ConnectionError: If the connection keeps failing
+        """
+        for attempt in range(self.max_retries + 1):
+            self.acquire()
+            try:
+                response = send()
+            except (requests.ConnectionError, requests.Timeout):
+                self.release()
+                with self._condition:
+                    self.connection_errors += 1
+                if attempt == self.max_retries:
+                    with self._condition:
+                        self.gave_up += 1
+                    raise
+                delay = self.retry_delay(attempt)
+            else:
+                throttled = response.status_code in THROTTLE_STATUSES
+                self.release(throttled)
+                backoff = _header_seconds(response, "Backoff")
+                retry_after = _header_seconds(response, "Retry-After") if throttled else None
+                if backoff or retry_after:
+                    self.pause(max(backoff or 0, retry_after or 0))
+                if response.status_code not in RETRY_STATUSES:
+                    return response
+                with self._condition:
+                    if throttled:
+                        self.throttled += 1
+                    else:
+                        self.server_errors += 1
+                if attempt == self.max_retries:
+                    with self._condition:
+                        self.gave_up += 1
+                    return response
+                response.close()
+                # a Retry-After pause already holds the retry back
+                delay = 0 if retry_after else self.retry_delay(attempt)
+            with self._condition:
+                self.retries += 1
+            logger.info("Retrying a Zotero request (attempt %d) in %.2fs", attempt + 2, delay)
+            if delay:
+                self.sleep(delay)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._condition:
+            return {'requests': self.requests, 'throttled': self.throttled, 'server_errors': self.server_errors,
+                    'connection_errors': self.connection_errors, 'retries': self.retries, 'gave_up': self.gave_up,
+                    'pauses': self.pauses, 'paused_seconds': round(self.paused_seconds, 3),
+                    'waited_seconds': round(self.waited_seconds, 3), 'concurrency_limit': self.limit,
+                    'in_flight': self.in_flight}
+
+
+def new_item_key() -> str:
+    """
+    Generate a key for a new Zotero item. A write of an object with a key that does not exist yet creates the item
+    under that key, so a repeated write updates it instead of creating another one.
+    """
+    return ''.join(random.choices(ZOTERO_KEY_CHARS, k=8))
+
+
+class Page(NamedTuple):
+    start: int
+    items: List[dict]
+    total: int
+    version: int
+
+
+class ZoteroClient:
+    """
+    A Zotero Web API client for one user library, with pooled connections and parallel paging.
+    """
+
+    def __init__(self, user_id: str, api_key: str, base_url: Optional[str] = None,
+                 concurrency: int = ZOTERO_FETCH_CONCURRENCY, timeout: float = REQUEST_TIMEOUT,
+                 request_governor: Optional[RequestGovernor] = None):
+        """
+        :param user_id: Zotero user ID
+        :param api_key: Zotero API key
+        :param base_url: The API root; defaults to ZOTERO_API_URL
+        :param concurrency: The maximum number of requests in flight during `fetch_all`
+        :param timeout: The timeout of a single request, in seconds
+        :param request_governor: Paces and retries the requests; defaults to the shared `governor`
+        """
+        self.library_url = f"{(base_url or ZOTERO_API_URL).rstrip('/')}/users/{user_id}"
+        self.concurrency = max(1, concurrency)
+        self.timeout = timeout
+        self.governor = request_governor or governor
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update({"Zotero-API-Key": api_key, "Zotero-API-Version": "3"})
+
+    def close(self) -> None:
+        self.session.close()
+
+    def __enter__(self) -> "ZoteroClient":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _send(self, method: str, url: str, **kwargs) -> requests.Response:
+        return self.governor.request(lambda: self.session.request(method, url, timeout=self.timeout, **kwargs))
+
+    def get(self, path: str, params: Optional[Dict[str, Any]] = None,
+            if_modified_since: Optional[int] = None) -> requests.Response:
+        """
+        Send a GET request for a path below the library, e.g. '/collections'.
+
+        :param path: The path relative to the library URL
+        :param params: The query parameters
+        :param if_modified_since: A library version; if the library has not changed since, the API answers 304 Not
+                                  Modified without a body
+        :return: The response
+        :raises ZoteroError: If the API answers with an error status
+        """
+        headers = {"If-Modified-Since-Version": str(if_modified_since)} if if_modified_since is not None else None
+        response = self._send("GET", self.library_url + path, params=params, headers=headers)
+        if response.status_code >= 400:
+            raise ZoteroError(f"GET {path} failed with {response.status_code}: {response.text[:200]}")
+        return response
+
+    def write_items(self, items: List[dict], if_unmodified_since: Optional[int] = None) -> Tuple[Dict[str, Any], int]:
+        """
+        Create or update up to WRITE_BATCH_SIZE items in one request. Objects with a key update that item; an object
+        that also carries a version fails on its own (412 in 'failed') if the item changed since.
+
+        :param items: The item data
+        :param if_unmodified_since: A library version; the whole request fails if the library changed since
+        :return: The write result ('successful', 'success', 'unchanged' and 'failed', keyed by the index of the
+                 object in `items`) and the library version after the write
+        :raises PreconditionFailed: If the library changed since `if_unmodified_since`
+        :raises ZoteroError: If the API answers with another error status
+        """
+        if len(items) > WRITE_BATCH_SIZE:
+            raise ValueError(f"At most {WRITE_BATCH_SIZE} items can be written at once, got {len(items)}")
+        # the token lets the API recognise a retried write that it already applied, with or without a precondition
+        headers = {"Zotero-Write-Token": uuid.uuid4().hex}
+        if if_unmodified_since is not None:
+            headers["If-Unmodified-Since-Version"] = str(if_unmodified_since)
+        response = self._send("POST", self.library_url + "/items", json=items, headers=headers)
+        if response.status_code == 412:
+            raise PreconditionFailed(f"Library changed since version {if_unmodified_since}")
+        if response.status_code >= 400:
+            raise ZoteroError(f"POST /items failed with {response.status_code}: {response.text[:200]}")
+        return response.json(), int(response.headers.get("Last-Modified-Version", 0))
+
+    def _fetch_page(self, path: str, params: Dict[str, Any], start: int,
+                    if_modified_since: Optional[int] = None) -> Optional[Page]:
+        response = self.get(path, {**params, "start": start, "limit": PAGE_SIZE}, if_modified_since)
+        if response.status_code == 304:
+            return None
+        items = response.json()
+        return Page(start, items, int(response.headers.get("Total-Results", start + len(items))),
+                    int(response.headers.get("Last-Modified-Version", 0)))
+
+    def iter_pages(self, path: str, params: Optional[Dict[str, Any]] = None, start: int = 0,
+                   if_modified_since: Optional[int] = None) -> Iterator[Page]:
+        """
+        Stream the pages of a listing in order. After the first page, up to `concurrency` pages are fetched ahead in
+        parallel; the rest are requested as the consumer catches up.
+
+        :param path: The path of the listing relative to the library URL, e.g. '/collections/ABCD1234/items'
+        :param params: The query parameters, without start and limit
+        :param start: The offset to start from, e.g. to resume an interrupted download
+        :param if_modified_since: A library version; the first page is requested conditionally, and if the library
+                                  has not changed since, no pages are yielded
+        :return: An iterator over the pages; each carries its offset, the total result count and the library version
+                 it was read at
+        """
+        params = dict(params or {})
+        first = self._fetch_page(path, params, start, if_modified_since)
+        if first is None:
+            return
+        yield first
+        offsets = iter(range(start + PAGE_SIZE, first.total, PAGE_SIZE))
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            window = deque(pool.submit(self._fetch_page, path, params, offset)
+                           for offset in islice(offsets, self.concurrency))
+            while window:
+                page = window.popleft().result()
+                offset = next(offsets, None)
+                if offset is not None:
+                    window.append(pool.submit(self._fetch_page, path, params, offset))
+                yield page
+
+    def fetch_all(self, path: str, params: Optional[Dict[str, Any]] = None) -> Tuple[List[dict], int]:
+        """
+        Fetch every page of a listing, the pages after the first in parallel.
+
+        :param path: The path of the listing relative to the library URL, e.g. '/collections/ABCD1234/items'
+        :param params: The query parameters, without start and limit
+        :return: The items in the API's order, and the library version they were read at
+        :raises ZoteroError: If the library keeps changing while the pages are fetched
+        """
+        for attempt in range(FETCH_ATTEMPTS):
+            pages = list(self.iter_pages(path, params))
+            version = pages[0].version
+            if all(page.version == version for page in pages):
+                return [item for page in pages for item in page.items], version
+            logger.info("Library changed while fetching %s (attempt %d), fetching again", path, attempt + 1)
+        raise ZoteroError(f"Library kept changing while fetching {path}")
+
+    def collections(self) -> List[dict]:
+        """
+        Get all collections of the library.
+        """
+        return self.fetch_all("/collections")[0]
+
+    def collection_key(self, name: str, version: Optional[int] = None) -> Optional[str]:
+        """
+        Get the key of a collection by its name, from `collection_keys` if possible.
+
+        :param name: The name of the collection
+        :param version: The latest library version the caller knows of; a cached map read at an older version is
+                        not used
+        :return: The key, or None if the library has no collection of that name
+        """
+        key = collection_keys.lookup(self.library_url, name, version)
+        if key is None:
+            collections, listing_version = self.fetch_all("/collections")
+            key = collection_keys.store(self.library_url, collections, listing_version).get(name)
+        return key
+
+    @staticmethod
+    def _collection_items_query(collection_key: str, since: Optional[int],
+                                item_type: Optional[str]) -> Tuple[str, Dict[str, Any]]:
+        params = {}
+        if since is not None:
+            params["since"] = since
+        if item_type:
+            params["itemType"] = item_type
+        return f"/collections/{collection_key}/items", params
+
+    def collection_items(self, collection_key: str, since: Optional[int] = None,
+                         item_type: Optional[str] = "-attachment") -> Tuple[List[dict], int]:
+        """
+        Get the items of a collection.
+
+        :param collection_key: The key of the collection
+        :param since: Only return items modified after this library version
+        :param item_type: An itemType filter; by default attachments are left out
+        :return: The items, and the library version they were read at
+        """
+        return self.fetch_all(*self._collection_items_query(collection_key, since, item_type))
+
+    def iter_collection_items(self, collection_key: str, since: Optional[int] = None, start: int = 0,
+                              item_type: Optional[str] = "-attachment",
+                              if_modified_since: Optional[int] = None) -> Iterator[Page]:
+        """
+        Stream the items of a collection page by page; see `iter_pages`.
+
+        :param collection_key: The key of the collection
+        :param since: Only return items modified after this library version
+        :param start: The offset to start from
+        :param item_type: An itemType filter; by default attachments are left out
+        :param if_modified_since: Yield nothing if the library has not changed since this version
+        :return: An iterator over the pages
+        """
+        path, params = self._collection_items_query(collection_key, since, item_type)
+        return self.iter_pages(path, params, start, if_modified_since)
+
+    def children(self, item_key: str) -> List[dict]:
+        """
+        Get the child items (attachments and notes) of an item.
+        """
+        return self.fetch_all(f"/items/{item_key}/children")[0]
+
+    def download(self, attachment_key: str, offset: int = 0) -> requests.Response:
+        """
+        Open a streaming download of an attachment's file. The caller reads it with `iter_content` and closes it.
+
+        :param attachment_key: The key of the attachment item
+        :param offset: The byte to resume from with a Range request; the response is 206 Partial Content if the
+                       server honoured it and 200 with the whole file otherwise
+        :return: The open response
+        :raises ZoteroError: If the API answers with an error status
+        """
+        headers = {"Range": f"bytes={offset}-"} if offset else None
+        response = self._send("GET", f"{self.library_url}/items/{attachment_key}/file", headers=headers, stream=True)
+        if response.status_code == 416 and offset:
+            # the partial file is already complete (or longer than the file); fetch it whole
+            response.close()
+            return self.download(attachment_key)
+        if response.status_code >= 400:
+            response.close()
+            raise ZoteroError(f"Downloading {attachment_key} failed with {response.status_code}")
+        return response
+
+    def deleted(self, since: int) -> Dict[str, List[str]]:
+        """
+        Get the keys of the objects deleted after a library version.
+
+        :param since: The library version
+        :return: The deleted keys by object type, e.g. {'items': [...], 'collections': [...]}
+        """
+        return self.get("/deleted", {"since": since}).json()
+
+
+class CollectionKeyCache:
+    """
+    A TTL cache of the collection name-to-key map of each library, scoped to the library version it was read at.
+    """
+
+    def __init__(self, ttl: float = ZOTERO_COLLECTION_TTL, clock=time.monotonic):
+        """
+        :param ttl: How long a map is used after it was read, in seconds
+        :param clock: Returns the current time in seconds
+        """
+        self.ttl = ttl
+        self.clock = clock
+        # library URL -> (name -> key, library version, expiry time)
+        self._entries: Dict[str, Tuple[Dict[str, str], int, float]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.invalidated = 0
+
+    def lookup(self, library_url: str, name: str, version: Optional[int] = None) -> Optional[str]:
+        """
+        :param library_url: The library the collection belongs to
+        :param name: The name of the collection
+        :param version: The latest library version the caller knows of
+        :return: The cached key, or None if the map is missing, stale or does not contain the name
+        """
+        with self._lock:
+            entry = self._entries.get(library_url)
+            if entry is not None and entry[2] <= self.clock():
+                self.expired += 1
+                entry = None
+            elif entry is not None and version is not None and version > entry[1]:
+                self.invalidated += 1
+                entry = None
+            key = entry[0].get(name) if entry is not None else None
+            if key is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return key
+
+    def store(self, library_url: str, collections: List[dict], version: int) -> Dict[str, str]:
+        """
+        Cache the collections of a library.
+
+        :param library_url: The library the collections belong to
+        :param collections: The collections as listed by the API
+        :param version: The library version the listing was read at
+        :return: The name-to-key map
+        """
+        keys = {}
+        for collection in collections:
+            # the first of several same-named collections wins, like a scan of the listing would
+            keys.setdefault(collection['data']['name'], collection['data']['key'])
+        with self._lock:
+            self._entries[library_url] = (keys, version, self.clock() + self.ttl)
+        return keys
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'expired': self.expired,
+                    'invalidated': self.invalidated, 'libraries': len(self._entries)}
+
+
+collection_keys = CollectionKeyCache()
+governor = RequestGovernor()
+
+_clients: Dict[Tuple[str, str, str], ZoteroClient] = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(user_id: str, api_key: str) -> ZoteroClient:
+    """
+    Get the shared client of a library, creating it on first use. The client is not closed by its users.
+
+    :param user_id: Zotero user ID
+    :param api_key: Zotero API key
+    :return: The client
+    """
+    registry_key = (ZOTERO_API_URL, str(user_id), api_key)
+    with _clients_lock:
+        client = _clients.get(registry_key)
+        if client is None:
+            client = _clients[registry_key] = ZoteroClient(user_id, api_key)
+        return client
+
+
+def close_clients() -> None:
+    """
+    Close and forget all shared clients.
+    """
+    with _clients_lock:
+        clients = list(_clients.values())
+        _clients.clear()
+    for client in clients:
+        client.close()
+
+
+def stats() -> Dict[str, Any]:
+    return {'clients': len(_clients), 'collection_keys': collection_keys.stats(), 'requests': governor.stats()}
@@ -0,0 +1,297 @@
+import argparse
+import hashlib
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+import logging
+
+if __name__ == "__main__":
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from api.attachments import CONTENT_FILE_PATH, PDF_CONTENT_TYPE, blob_name
+from api.converters import ConversionReport, convert_zotero_items
+from api.database import finish_sync, store_sync_chunk
+
+"""
+zotero_local.py
+
+This module imports a collection straight from the database of the Zotero desktop app (`zotero.sqlite`), for a first
+sync of a large library without paging through the Web API. The database is opened read-only. Items are read in
+chunks and rebuilt in the shape the API serves them (key, version and a `data` dict with the item's fields, creators,
+tags and collections), so they go through `convert_zotero_items` and `store_sync_chunk` like synced items do. The PDF of every
+entry is copied from Zotero's `storage/` folder into the content directory under its content hash, as a download by
+`attachments.py` would store it. Finally the library version the desktop app last synced is stored, so the next
+`sync_zotero_down` only asks the API for what changed since.
+
+Only the files of the app's own storage are imported; linked files are left out, as they are by the sync. Changes
+made in the desktop app that it has not synced yet are imported as they are and are not uploaded.
+
+Usage:
+    python -m api.zotero_local ~/Zotero/zotero.sqlite [--collection locus] [--storage ~/Zotero/storage]
+"""
+
+logger = logging.getLogger(__name__)
+
+# items read per round of queries; below SQLite's limit of host parameters
+IMPORT_CHUNK_SIZE = 500
+# item types that are not stored as content of their own
+SKIPPED_ITEM_TYPES = ('note', 'attachment', 'annotation')
+# itemAttachments.linkMode of files kept in Zotero's storage folder: imported_file, imported_url
+STORED_LINK_MODES = (0, 1)
+STORAGE_PREFIX = 'storage:'
+
+
+class ZoteroLocalError(Exception):
+    pass
+
+
+def open_zotero_db(path: str) -> sqlite3.Connection:
+    """
+    Open a Zotero database read-only.
+
+    :param path: The path of zotero.sqlite
+    :return: The connection
+    :raises ZoteroLocalError: If the file does not exist or is locked by a running Zotero
+    """
+    if not os.path.exists(path):
+        raise ZoteroLocalError(f"No Zotero database at {path}")
+    conn = sqlite3.connect(f"file:{os.path.abspath(path)}?mode=ro", uri=True)
+    conn.row_factory = sqlite3.Row
+    try:
+        conn.execute("SELECT 1 FROM items LIMIT 1")
+    except sqlite3.OperationalError as e:
+        conn.close()
+        raise ZoteroLocalError(f"Cannot read {path} ({e}); close Zotero and try again") from e
+    return conn
+
+
+def _chunked(values: Iterable, size: int) -> Iterator[List]:
+    values = iter(values)
+    while chunk := list(islice(values, size)):
+        yield chunk
+
+
+def _placeholders(values: List) -> str:
+    return ','.join('?' * len(values))
+
+
+def _api_date(value: Optional[str]) -> Optional[str]:
+    # the database stores UTC as 'YYYY-MM-DD HH:MM:SS', the API serves ISO 8601
+    return value.replace(' ', 'T') + 'Z' if value else value
+
+
+class ZoteroLocalLibrary:
+    """
+    Read the user library of a Zotero database in the shape of the Web API.
+    """
+
+    def __init__(self, conn: sqlite3.Connection):
+        """
+        :param conn: A connection to zotero.sqlite, see `open_zotero_db`
+        """
+        self.conn = conn
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view')")}
+        # Zotero 5.0.80 and later keep custom fields and types next to the built-in ones in *Combined views
+        self.fields_table = 'fieldsCombined' if 'fieldsCombined' in tables else 'fields'
+        self.item_types_table = 'itemTypesCombined' if 'itemTypesCombined' in tables else 'itemTypes'
+        row = conn.execute("SELECT libraryID, version FROM libraries WHERE type = 'user'").fetchone()
+        if row is None:
+            raise ZoteroLocalError("The database has no user library")
+        self.library_id = row['libraryID']
+        self.version = row['version']
+
+    def collection_key(self, name: str) -> Optional[str]:
+        row = self.conn.execute("SELECT key FROM collections WHERE libraryID = ? AND collectionName = ? "
+                                "ORDER BY collectionID LIMIT 1", (self.library_id, name)).fetchone()
+        return row['key'] if row else None
+
+    def item_ids(self, collection_key: str) -> List[int]:
+        """
+        Get the ids of the entries directly in a collection, without notes, attachments and items in the trash.
+        """
+        return [row[0] for row in self.conn.execute(f"""
+            SELECT i.itemID FROM items i
+            JOIN collectionItems ci ON ci.itemID = i.itemID
+            JOIN collections c ON c.collectionID = ci.collectionID
+            JOIN {self.item_types_table} t ON t.itemTypeID = i.itemTypeID
+            WHERE c.key = ? AND c.libraryID = ? AND t.typeName NOT IN ({_placeholders(SKIPPED_ITEM_TYPES)})
+              AND i.itemID NOT IN (SELECT itemID FROM deletedItems)
+            ORDER BY i.itemID""", (collection_key, self.library_id, *SKIPPED_ITEM_TYPES))]
+
+    def items(self, item_ids: List[int]) -> List[dict]:
+        """
+        Build the API representation of items, with a fixed number of queries.
+
+        :param item_ids: The ids of the items
+        :return: The items, in the order of `item_ids`
+        """
+        marks = _placeholders(item_ids)
+        items = {}
+        for row in self.conn.execute(f"""
+                SELECT i.itemID, i.key, i.version, i.dateAdded, i.dateModified, t.typeName FROM items i
+                JOIN {self.item_types_table} t ON t.itemTypeID = i.itemTypeID
+                WHERE i.itemID IN ({marks})""", item_ids):
+            items[row['itemID']] = {
+                'key': row['key'],
+                'version': row['version'],
+                'library': {'type': 'user', 'id': self.library_id},
+                'links': {},
+                'meta': {},
+                'data': {'key': row['key'], 'version': row['version'], 'itemType': row['typeName'], 'creators': [],
+                         'tags': [], 'collections': [], 'dateAdded': _api_date(row['dateAdded']),
+                         'dateModified': _api_date(row['dateModified'])},
+            }
+        for row in self.conn.execute(f"""
+                SELECT d.itemID, f.fieldName, v.value FROM itemData d
+                JOIN {self.fields_table} f ON f.fieldID = d.fieldID
+                JOIN itemDataValues v ON v.valueID = d.valueID
+                WHERE d.itemID IN ({marks})""", item_ids):
+            items[row['itemID']]['data'][row['fieldName']] = row['value']
+        for row in self.conn.execute(f"""
+                SELECT ic.itemID, ct.creatorType, c.firstName, c.lastName, c.fieldMode FROM itemCreators ic
+                JOIN creators c ON c.creatorID = ic.creatorID
+                JOIN creatorTypes ct ON ct.creatorTypeID = ic.creatorTypeID
+                WHERE ic.itemID IN ({marks}) ORDER BY ic.itemID, ic.orderIndex""", item_ids):
+            # single-field names (fieldMode 1) are kept in lastName; served as 'name', as the API does
+            if row['fieldMode'] == 1:
+                creator = {'creatorType': row['creatorType'], 'name': row['lastName'] or ''}
+            else:
+                creator = {'creatorType': row['creatorType'], 'firstName': row['firstName'] or '',
+                           'lastName': row['lastName'] or ''}
+            items[row['itemID']]['data']['creators'].append(creator)
+        for row in self.conn.execute(f"""
+                SELECT it.itemID, t.name, it.type FROM itemTags it JOIN tags t ON t.tagID = it.tagID
+                WHERE it.itemID IN ({marks}) ORDER BY it.itemID, t.name""", item_ids):
+            tag = {'tag': row['name']}
+            if row['type']:
+                tag['type'] = row['type']
+            items[row['itemID']]['data']['tags'].append(tag)
+        for row in self.conn.execute(f"""
+                SELECT ci.itemID, c.key FROM collectionItems ci JOIN collections c ON c.collectionID = ci.collectionID
+                WHERE ci.itemID IN ({marks}) ORDER BY ci.itemID, c.collectionID""", item_ids):
+            items[row['itemID']]['data']['collections'].append(row['key'])
+        return [items[item_id] for item_id in item_ids]
+
+    def stored_pdfs(self, item_ids: List[int]) -> Dict[int, Tuple[str, str]]:
+        """
+        Find the first PDF attachment of every entry whose file is kept in Zotero's storage folder.
+
+        :param item_ids: The ids of the entries
+        :return: The attachment key and file name by the id of the entry
+        """
+        pdfs = {}
+        for row in self.conn.execute(f"""
+                SELECT a.parentItemID, i.key, a.path FROM itemAttachments a JOIN items i ON i.itemID = a.itemID
+                WHERE a.parentItemID IN ({_placeholders(item_ids)}) AND a.contentType = ?
+                  AND a.linkMode IN ({_placeholders(STORED_LINK_MODES)}) AND a.path LIKE '{STORAGE_PREFIX}%'
+                  AND a.itemID NOT IN (SELECT itemID FROM deletedItems)
+                ORDER BY a.parentItemID, a.itemID""", (*item_ids, PDF_CONTENT_TYPE, *STORED_LINK_MODES)):
+            pdfs.setdefault(row['parentItemID'], (row['key'], row['path'][len(STORAGE_PREFIX):]))
+        return pdfs
+
+
+def copy_to_content_store(path: str, storage_dir: str) -> str:
+    """
+    Copy a file into the content directory under its content hash, unless a file with that content is stored already.
+
+    :param path: The file to copy
+    :param storage_dir: The content directory
+    :return: The name of the stored file
+    """
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(block)
+    name = blob_name(sha256.hexdigest(), {'data': {'filename': os.path.basename(path),
+                                                   'contentType': PDF_CONTENT_TYPE}})
+    target = os.path.join(storage_dir, name)
+    if not os.path.exists(target):
+        # copy to a temporary file first, so a stored name always holds the whole file
+        with tempfile.NamedTemporaryFile(dir=storage_dir, delete=False) as tmp:
+            try:
+                with open(path, 'rb') as f:
+                    shutil.copyfileobj(f, tmp)
+            except BaseException:
+                os.remove(tmp.name)
+                raise
+        os.replace(tmp.name, target)
+    return name
+
+
+def import_zotero_sqlite(db_path: str, collection_name: str, zotero_storage: Optional[str] = None,
+                         storage_dir: Optional[str] = CONTENT_FILE_PATH,
+                         chunk_size: int = IMPORT_CHUNK_SIZE) -> Dict[str, int]:
+    """
+    Import a collection from a Zotero desktop database and store the library version it was synced to.
+
+    :param db_path: The path of zotero.sqlite
+    :param collection_name: The name of the collection to import
+    :param zotero_storage: Zotero's attachment folder; defaults to the storage folder next to the database
+    :param storage_dir: The content directory PDFs are copied to; None to import no files
+    :param chunk_size: The number of items read and committed at a time
+    :return: The number of items read, inserted, updated and skipped, the PDFs copied and those whose file is missing,
+             and the library version stored
+    :raises ZoteroLocalError: If the database cannot be read or has no such collection
+    """
+    zotero_storage = zotero_storage or os.path.join(os.path.dirname(os.path.abspath(db_path)), 'storage')
+    counts = {'items': 0, 'inserted': 0, 'updated': 0, 'skipped': 0, 'files': 0, 'missing_files': 0}
+    report = ConversionReport()
+    conn = open_zotero_db(db_path)
+    try:
+        library = ZoteroLocalLibrary(conn)
+        collection_key = library.collection_key(collection_name)
+        if collection_key is None:
+            raise ZoteroLocalError(f"No collection named {collection_name!r} in {db_path}")
+        if storage_dir:
+            os.makedirs(storage_dir, exist_ok=True)
+
+        for item_ids in _chunked(library.item_ids(collection_key), chunk_size):
+            pdfs = library.stored_pdfs(item_ids) if storage_dir else {}
+            files = {}
+            for item_id, (attachment_key, filename) in pdfs.items():
+                path = os.path.join(zotero_storage, attachment_key, filename)
+                if os.path.exists(path):
+                    files[item_id] = copy_to_content_store(path, storage_dir)
+                    counts['files'] += 1
+                else:
+                    # not downloaded by the desktop app; the PDF prefetch can fetch it later
+                    counts['missing_files'] += 1
+            content_list = []
+            for item_id, content in zip(item_ids, convert_zotero_items(library.items(item_ids), report)):
+                if item_id in files:
+                    # a missing file keeps the name an earlier import or prefetch stored
+                    content['filename'] = files[item_id]
+                content_list.append(content)
+            for key, value in store_sync_chunk(content_list, None).items():
+                counts[key] += value
+            counts['items'] += len(content_list)
+            logger.debug("Imported %d items", counts['items'])
+
+        finish_sync(library.version, [])
+        counts['version'] = library.version
+    finally:
+        conn.close()
+    if report:
+        logger.warning("Problems in the imported items: %s", report.counts())
+    logger.info("Imported %s from %s: %s", collection_name, db_path, counts)
+    return counts
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    from api.database import engine
+    from api.migrations import upgrade
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description="Import a collection from the Zotero desktop database")
+    parser.add_argument("db_path", help="the path of zotero.sqlite")
+    parser.add_argument("--collection", default=os.getenv("ZOTERO_COLLECTION", "locus"))
+    parser.add_argument("--storage", help="Zotero's attachment folder (default: storage next to the database)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    upgrade(engine)
+    print(import_zotero_sqlite(args.db_path, args.collection, args.storage, os.getenv("CONTENT_FILE_PATH")))
@@ -1,18 +1,29 @@
 import os
-from typing import List, Dict, Optional, Tuple, Union
+from itertools import chain
+from typing import Callable, Iterable, Iterator, List, Dict, NamedTuple, Optional, Tuple, Union
 from pyzotero import zotero
 if __name__ == "__main__":
     import sys
     sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from api.database import store_latest_version, get_latest_version, sync_content, store_content_list, create_group_with_zotero_keys
+from api.database import get_latest_version, store_content_list, create_group_with_zotero_keys, get_sync_checkpoint, store_sync_chunk, finish_sync, get_dirty_content, assign_zotero_keys, store_upload_results
 from api.models import Content, Author
-from api.converters import zotero2Content, zotero2Dict
+from api.converters import ConversionReport, content2Zotero, convert_zotero_items, zotero2Content, zotero2Dict
+from api.zotero_http import WRITE_BATCH_SIZE, Page, PreconditionFailed, ZoteroClient, ZoteroError, get_client, new_item_key
+from api.attachments import AttachmentStore
+from api.note_store import note_store
 from dotenv import load_dotenv
 load_dotenv()
 
 CONTENT_FILE_PATH = os.getenv("CONTENT_FILE_PATH")
+# number of items committed per transaction during a sync; chunks are cut at page boundaries
+ZOTERO_SYNC_CHUNK_SIZE = int(os.getenv("ZOTERO_SYNC_CHUNK_SIZE", 100))
+# child items that are not stored as content of their own
+SKIPPED_ITEM_TYPES = ('note', 'attachment')
+import logging
 import requests
 
+logger = logging.getLogger(__name__)
+
 """
 zotero_sync.py
 
@@ -30,12 +41,27 @@ Functions:
 - get_collection_id_by_name(zot, collection_name): Retrieves the collection ID of a specified Zotero collection
   by its name.
 - sync_zotero_down(api_key, user_id, collection_name): Syncs the local database with the Zotero library, updating
-  the local database with new, modified, and deleted items.
+  the local database with new, modified, and deleted items. It streams the collection page by page, commits every
+  chunk together with a checkpoint, and resumes an interrupted sync from the last committed chunk.
+- upload_dirty_content(api_key, user_id, collection_name): Uploads the notes and entries changed locally to Zotero,
+  up to 50 items per request, each request conditioned on the library version the last one left.
 - sync_zotero_up_down(api_key, user_id, collection_name): Syncs the local database with the Zotero library in
   both directions (download new items from Zotero, upload new items to Zotero).
 """
 
 
+def _collection_key(client: ZoteroClient, collection_name: str, version: Optional[int] = None) -> str:
+    """
+    Get the key of the collection to sync, which must exist: without it the items requests would fail with an
+    unclear 404, and new items would be created outside any collection.
+
+    :raises ZoteroError: If the library has no collection of that name
+    """
+    key = client.collection_key(collection_name, version)
+    if key is None:
+        raise ZoteroError(f"The Zotero library has no collection named {collection_name!r}")
+    return key
+
 def get_changed_items_since(api_key: str, user_id: str, collection_name: str, latest_version: int, get_deleted: bool = False) -> Tuple[int, List[dict], Optional[List[dict]]]:
     """
     Get items that have been added, modified, or deleted since the given version.
@@ -47,18 +73,18 @@ def get_changed_items_since(api_key: str, user_id: str, collection_name: str, la
     :param get_deleted: If True, also returns a list of deleted items; otherwise, returns None
     :return: Tuple containing the latest version of the collection, a list of changed items, and (if get_deleted=True) a list of deleted items
     """
-    zot = zotero.Zotero(user_id, 'user', api_key)
-    collection_id = get_collection_id_by_name(zot, collection_name)
-    
-    # Get items that have changed since the latest version
-    changed_items = zot.everything(zot.collection_items(collection_id, since=latest_version, itemType="-attachment"))
-    latest_version = int(zot.request.headers["Last-Modified-Version"])
-    
+    client = get_client(user_id, api_key)
+    collection_id = _collection_key(client, collection_name, latest_version)
+
+    # Get items that have changed since the latest version; pages are fetched in parallel
+    changed_items, new_version = client.collection_items(collection_id, since=latest_version)
+
     if get_deleted:
-        deleted_items = zot.deleted(since=latest_version, collection=collection_id)
-        return latest_version, changed_items, deleted_items["items"]
+        # deletions since the version the caller has, not the one just read, or they would be missed
+        deleted_items = client.deleted(since=latest_version)
+        return new_version, changed_items, deleted_items["items"]
     else:
-        return latest_version, changed_items, None
+        return new_version, changed_items, None
     # zot = zotero.Zotero(user_id, 'user', api_key)
     # collection_id = get_collection_id_by_name(zot, collection_name)
     
@@ -80,19 +106,18 @@ def get_all_items(api_key: str, user_id: str, collection_name: str) -> Tuple[int
     :param collection_name: Name of the Zotero collection to fetch items from
     :return: Tuple containing the latest version of the collection and a list of all items in the collection
     """
-    zot = zotero.Zotero(user_id, 'user', api_key)
-    collection_id = get_collection_id_by_name(zot, collection_name)
+    client = get_client(user_id, api_key)
+    collection_id = _collection_key(client, collection_name)
 
-    # Get all items in the collection
-    items = zot.everything(zot.collection_items(collection_id, itemType="-attachment"))
-    latest_version = int(zot.request.headers["Last-Modified-Version"])
+    # Get all items in the collection; pages are fetched in parallel
+    items, latest_version = client.collection_items(collection_id)
     return latest_version, items
 
-def get_collection_id_by_name(zot: zotero.Zotero, collection_name: str) -> Union[str, None]:
+def get_collection_id_by_name(zot: Union[zotero.Zotero, ZoteroClient], collection_name: str) -> Union[str, None]:
     """
     Get the ID of a Zotero collection with the specified name.
     
-    :param zot: Zotero API instance
+    :param zot: Zotero API instance (pyzotero or ZoteroClient)
     :param collection_name: Name of the Zotero collection to find
     :return: Collection ID if found, None otherwise
     """
@@ -112,60 +137,32 @@ def create_item_in_collection(api_key: str, user_id: str, collection_name: str,
     :param item_data: Dictionary containing the item data
     :return: Item ID if the item was added successfully, None otherwise
     """
-    zot = zotero.Zotero(user_id, 'user', api_key)
-    collection_id = get_collection_id_by_name(zot, collection_name)
+    client = get_client(user_id, api_key)
+    collection_id = client.collection_key(collection_name)
     if not collection_id:
         return None
     # Create a new item with the given item_data
     item_data["collections"] = [collection_id]
-    response = zot.create_items([item_data])
-    if response:
+    response, _ = client.write_items([item_data])
+    if response.get('successful'):
         item_data = response['successful']['0'] #item_id is item_data["key"]
         return item_data
 
     return None
 
 
-def download_zotero_attachment(api_key: str, user_id: str, item_key: str, download_dir: str) -> str:
+def download_zotero_attachment(api_key: str, user_id: str, item_key: str, download_dir: str) -> Optional[Tuple[dict, str]]:
     """
-    Download the attachment for a Zotero item if it exists.
+    Download the PDF attachment for a Zotero item if it exists. The file is streamed to disk and stored under the
+    SHA-256 of its content (see `attachments.py`).
 
     :param api_key: Zotero API key
     :param user_id: Zotero user ID
     :param item_key: The key of the Zotero item.
     :param download_dir: The directory where the attachment should be downloaded.
-    :return: The downloaded attachment item or None if no attachment found.
+    :return: The attachment item and the name of the stored file, or None if no attachment found.
     """
-    # Retrieve the child items (attachments) of the Zotero item
-    zot = zotero.Zotero(user_id, 'user', api_key)
-    attachments = zot.children(item_key)
-
-    # Iterate through attachments to find the PDF
-    for attachment in attachments:
-        if attachment.get('data', {}).get('contentType') == 'application/pdf':
-            # # If a PDF attachment is found, download it
-            # # attachment_url = zot.file [1]['links']['enclosure']['href']
-            # attachment_url = attachment['links']['enclosure']['href']
-            # response = requests.get(attachment_url, headers={"Authorization": f"Bearer {api_key}"}, stream=True)
-            
-            # # Save the PDF to the specified directory
-            # filename = os.path.join(download_dir, attachment['data']['filename'])
-            # with open(filename, 'wb') as f:
-            #     for chunk in response.iter_content(chunk_size=8192):
-            #         if chunk:  # Filter out keep-alive chunks
-            #             f.write(chunk)
-            # If a PDF attachment is found, download it
-            attachment_key = attachment['data']['key']
-            file_content = zot.file(attachment_key)
-
-            # Save the PDF to the specified directory
-            filename = os.path.join(download_dir, attachment['data']['filename'])
-            with open(filename, 'wb') as f:
-                f.write(file_content)
-
-            return attachment
-
-    return None
+    return AttachmentStore(get_client(user_id, api_key), download_dir).download_item(item_key)
 
 def store_attachment_for_item(api_key: str, user_id: str, item_key: str) -> bool:
     """
@@ -176,10 +173,11 @@ def store_attachment_for_item(api_key: str, user_id: str, item_key: str) -> bool
     :param item_key: The key of the Zotero item.
     :return: True if the attachment was added successfully, False otherwise.
     """
-    attachment = download_zotero_attachment(api_key, user_id, item_key, CONTENT_FILE_PATH)
-    if attachment:
+    downloaded = download_zotero_attachment(api_key, user_id, item_key, CONTENT_FILE_PATH)
+    if downloaded:
+        attachment, filename = downloaded
         # Add the attachment to the db
-        store_content_list([zotero2Dict(attachment)])
+        store_content_list([{**zotero2Dict(attachment), "filename": filename}])
         # create a group with the item key and the attachment key
         new_group = create_group_with_zotero_keys(attachment["data"]["parentItem"],attachment["key"])
         
@@ -213,38 +211,233 @@ def store_attachment_for_item(api_key: str, user_id: str, item_key: str) -> bool
 #     return item
 
 
-def sync_zotero_down(api_key: str, user_id: str, collection_name: str) -> None:
+class SyncChunk(NamedTuple):
+    content: List[dict]
+    next_start: int  # offset of the first page after the chunk
+    total: int
+    changed: bool  # whether a page of the chunk was read at another library version than the first page
+    pages: int  # number of pages the chunk was built from
+
+
+def iter_sync_chunks(pages: Iterable[Page], version: int, chunk_size: int = ZOTERO_SYNC_CHUNK_SIZE,
+                     report: Optional[ConversionReport] = None) -> Iterator[SyncChunk]:
+    """
+    Convert a stream of item pages into chunks of content dicts, cut at page boundaries.
+
+    :param pages: The pages of the collection listing
+    :param version: The library version the first page was read at
+    :param chunk_size: The minimum number of items per chunk (except the last)
+    :param report: Collects the problems found while converting the items
+    :return: An iterator over the chunks
+    """
+    pending = []
+    changed = False
+    page_count = 0
+    page = None
+    for page in pages:
+        pending.extend(convert_zotero_items(
+            (item for item in page.items if item.get('data', {}).get('itemType') not in SKIPPED_ITEM_TYPES), report))
+        changed = changed or page.version != version
+        page_count += 1
+        if len(pending) >= chunk_size:
+            yield SyncChunk(pending, page.start + len(page.items), page.total, changed, page_count)
+            pending = []
+            page_count = 0
+    # the last chunk also carries a change seen on trailing pages without stored items
+    if page is not None and (pending or changed or page_count):
+        yield SyncChunk(pending, page.start + len(page.items), page.total, changed, page_count)
+
+
+def sync_zotero_down(api_key: str, user_id: str, collection_name: str, chunk_size: int = ZOTERO_SYNC_CHUNK_SIZE,
+                     progress: Optional[Callable[[Dict[str, int]], None]] = None) -> int:
     """
     Download new and updated items from Zotero and store them in the local database.
-    
+
+    The collection is streamed page by page; every chunk of `chunk_size` items is committed together with a checkpoint,
+    so memory use does not grow with the library and an interrupted sync resumes after the last committed chunk.
+    If the library changed while the pages were read, items may have moved between pages; the stored version is then
+    left as it was, so the next sync fetches the same changes again. An incremental sync asks for the changes with
+    If-Modified-Since-Version, so when nothing changed it ends after a 304 without writing to the database.
+
     :param api_key: Zotero API key
     :param user_id: Zotero user ID
     :param collection_name: Name of the Zotero collection to sync
+    :param chunk_size: The number of items to commit at a time
+    :param progress: Called after every committed chunk with the pages fetched, the items read (including those of an
+                     interrupted run), the total number of items to read, the items upserted so far and the offset the
+                     sync started at
+    :return: The library version the sync read, or the stored one if the library has not changed
+    :raises ZoteroError: If the library has no collection of that name
     """
-    latest_version = get_latest_version()
-    if latest_version:
-        remote_version, new_and_modified, deleted = get_changed_items_since(api_key, user_id, collection_name, latest_version.version, get_deleted=True)
-        print(f"New and modified items: {new_and_modified}")
-        print(f"Deleted items: {deleted}")
-        sync_content([zotero2Dict(n) for n in new_and_modified], [zotero2Dict(d) for d in deleted])
-    else:
-        remote_version, content_list = get_all_items(api_key, user_id, collection_name)
-        # print(content_list)
-        # store_content_list([c['data'] for c in content_list])
-        store_content_list([zotero2Dict(c)  for c in content_list if c['data']['itemType'] not in ['note', 'attachment']])
-    store_latest_version(remote_version)
+    since = get_latest_version()
+    client = get_client(user_id, api_key)
+    collection_id = _collection_key(client, collection_name, since)
+
+    checkpoint = get_sync_checkpoint()
+    start = 0
+    if checkpoint and checkpoint['collection'] == collection_id and checkpoint['since'] == since:
+        start = checkpoint['start']
+    # conditional on the stored version, so an unchanged library costs one 304 and no writes
+    pages = client.iter_collection_items(collection_id, since=since, start=start,
+                                         if_modified_since=since if not start else None)
+    first = next(pages, None)
+    if first is None:
+        logger.info("%s is up to date at version %d", collection_name, since)
+        return since
+    if start and first.version != checkpoint['version']:
+        # offsets from before a change to the library no longer line up; the upserts are idempotent
+        logger.info("Library changed since the interrupted sync, starting over")
+        pages.close()
+        start = 0
+        pages = client.iter_collection_items(collection_id, since=since)
+        first = next(pages)
+    elif start:
+        logger.info("Resuming sync of %s at item %d", collection_name, start)
+    remote_version = first.version
+
+    counts = {'inserted': 0, 'updated': 0, 'skipped': 0}
+    changed = False
+    pages_fetched = 0
+    report = ConversionReport()
+    for chunk in iter_sync_chunks(chain([first], pages), remote_version, chunk_size, report):
+        chunk_counts = store_sync_chunk(chunk.content, {
+            'collection': collection_id, 'since': since, 'version': remote_version, 'start': chunk.next_start,
+        })
+        for key, value in chunk_counts.items():
+            counts[key] += value
+        changed = changed or chunk.changed
+        pages_fetched += chunk.pages
+        logger.debug("Synced %d of %d items", chunk.next_start, chunk.total)
+        if progress:
+            progress({'pages': pages_fetched, 'items': chunk.next_start, 'total': chunk.total,
+                      'upserted': counts['inserted'] + counts['updated'], 'start': start})
+
+    # deletions since the version the changes were fetched against; any made during the sync are after it too
+    deleted = client.deleted(since=since)['items'] if since is not None else []
+
+    if report:
+        logger.warning("Problems in the synced items: %s", report.counts())
+        logger.debug("Item problems: %s", report.problems)
+    if changed:
+        logger.warning("Library changed during the sync; keeping version %s so the next sync repeats it", since)
+    finish_sync(None if changed else remote_version, [{'zotero_key': key} for key in deleted])
+    logger.info("Synced %s to version %d: %s, %d deleted", collection_name, remote_version, counts, len(deleted))
     return remote_version
 
-def sync_zotero_up_down(api_key: str, user_id: str, collection_name: str) -> None:
+def _note_html(content: dict) -> Optional[str]:
+    """
+    Read the HTML a note was saved as, if it was stored in a file.
+    """
+    if content['content_type'] != 'note' or not content.get('filename') or not CONTENT_FILE_PATH:
+        return None
+    # a note saved moments ago may not be written yet
+    pending = note_store.pending(content['filename']) if note_store is not None else None
+    if pending is not None:
+        return pending
+    path = os.path.join(CONTENT_FILE_PATH, content['filename'])
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return f.read()
+
+def _with_item_keys(batch: List[dict]) -> List[dict]:
+    """
+    Assign Zotero keys to the new content of an upload batch before it is written, see `database.assign_zotero_keys`.
+    Content edited since the batch was read is left out; it stays queued for the next upload.
+    """
+    keys = {content['id']: (new_item_key(), content['change_seq']) for content in batch if not content['zotero_key']}
+    if not keys:
+        return batch
+    assigned = assign_zotero_keys(keys)
+    ready = []
+    for content in batch:
+        if content['id'] in keys:
+            if content['id'] not in assigned:
+                continue
+            content = {**content, 'zotero_key': keys[content['id']][0], 'change_seq': assigned[content['id']]}
+        ready.append(content)
+    return ready
+
+def upload_dirty_content(api_key: str, user_id: str, collection_name: str,
+                         batch_size: int = WRITE_BATCH_SIZE) -> Dict[str, int]:
+    """
+    Upload the notes and entries changed locally to Zotero.
+
+    The upload queue (content with zotero_dirty set) is read in batches of `batch_size`, and each batch is written with
+    one request. New notes are created in the collection, under keys stored on them before the request, so a request
+    whose outcome was lost (a timeout, a retry refused because the first attempt had changed the library) is repeated
+    by the next upload without duplicating them. Content that is already in Zotero is updated, and an item that changed
+    in Zotero since it was synced fails on its own and stays queued. Every request carries If-Unmodified-Since-Version
+    with the library version the sync or the previous batch left, so a library changed by someone else stops the
+    upload; the next sync down brings in those changes first. The versions Zotero returns are stored on the rows, which
+    leave the queue unless they were edited again during the upload.
+
+    :param api_key: Zotero API key
+    :param user_id: Zotero user ID
+    :param collection_name: Name of the Zotero collection new items are added to
+    :param batch_size: The number of items per request, at most 50
+    :return: The number of items created, updated, unchanged, failed, and deferred by a changed library
+    :raises ZoteroError: If the library has no collection of that name
+    """
+    client = get_client(user_id, api_key)
+    collection_id = _collection_key(client, collection_name)
+    library_version = get_latest_version()
+    counts = {'created': 0, 'updated': 0, 'unchanged': 0, 'failed': 0, 'deferred': 0}
+    after_id = 0
+    while True:
+        batch = get_dirty_content(batch_size, after_id)
+        if not batch:
+            break
+        after_id = batch[-1]['id']
+        batch = _with_item_keys(batch)
+        if not batch:
+            continue
+        items = [content2Zotero(content, collection_id, _note_html(content)) for content in batch]
+        try:
+            response, new_version = client.write_items(items, if_unmodified_since=library_version)
+        except PreconditionFailed:
+            logger.warning("Library changed since version %s; leaving the upload for after the next sync", library_version)
+            counts['deferred'] = len(batch)
+            break
+
+        results = []
+        for index, item in response.get('successful', {}).items():
+            content = batch[int(index)]
+            counts['created' if content['zotero_version'] is None else 'updated'] += 1
+            results.append({'id': content['id'], 'change_seq': content['change_seq'],
+                            'zotero_key': item['key'], 'zotero_version': item['version']})
+        for index, key in response.get('unchanged', {}).items():
+            content = batch[int(index)]
+            counts['unchanged'] += 1
+            results.append({'id': content['id'], 'change_seq': content['change_seq'],
+                            'zotero_key': key, 'zotero_version': content['zotero_version']})
+        for index, failure in response.get('failed', {}).items():
+            # failed rows stay queued; after_id moves past them, so they are retried by the next upload
+            counts['failed'] += 1
+            logger.warning("Uploading content %s failed with %s: %s", batch[int(index)]['id'], failure.get('code'),
+                           failure.get('message'))
+        # the precondition held, so the new version only adds this batch's writes and can be stored as synced
+        store_upload_results(results, new_version if library_version is not None else None)
+        library_version = new_version
+    logger.info("Uploaded to %s: %s", collection_name, counts)
+    return counts
+
+def sync_zotero_up_down(api_key: str, user_id: str, collection_name: str) -> Dict[str, int]:
     """
     Sync both ways; download new items from Zotero, upload new items to Zotero.
-    
+
+    The download runs first, so the upload is conditioned on a library version that includes everyone else's changes.
+    Content changed both locally and in Zotero keeps its local changes through the download, and its upload fails and
+    stays queued (see `database.bulk_upsert_content`).
+
     :param api_key: Zotero API key
     :param user_id: Zotero user ID
     :param collection_name: Name of the Zotero collection to sync
+    :return: The upload counts, see `upload_dirty_content`
     """
-    pass
-    
+    sync_zotero_down(api_key, user_id, collection_name)
+    return upload_dirty_content(api_key, user_id, collection_name)
+
 
 if __name__ == "__main__":
     load_dotenv()
@@ -1,4 +1,5 @@
 import { createSlice } from '@reduxjs/toolkit';
+import api from '../../api';
 
 const initialState = {
   chat_id: null,
@@ -69,11 +70,19 @@ export const clearChat = () => {
 export const loadChat = (chat) => {
   return (dispatch) => {
     dispatch(setChatId(chat.id));
-    dispatch(setMessages(chat.content_metadata.chat.messages));
+    dispatch(setMessages([]));
     dispatch(setInputMessage(""));
     dispatch(setSelectedMessage(""));
     dispatch(setIsWaiting(false));
     dispatch(setStartedStreaming(false));
+    // messages are stored separately from the chat; fetch the transcript
+    api.get(`/chats/${chat.id}/messages`)
+    .then(response => {
+      dispatch(setMessages(response.data.messages));
+    })
+    .catch(error => {
+      console.error('Error loading chat messages:', error);
+    });
   }
 }
 
@@ -120,9 +120,9 @@ const ChatBox = () => {
             <Select width="100%" value={loadingChatId} onChange={(e)=>setLoadingChatId(e.target.value)}>
               {Object.entries(allChats).map((chat, index) => {
                   const chat_id = chat[0];
-                  const chat_content = chat[1].content_metadata.chat.messages;
-                  if(chat_content.length > 0 && chat_content[0].content.length > 0){
-                    return <option key={index} value={chat_id}>{chat_content[0].content.substring(0,30)}</option>
+                  const first_message = chat[1].first_message;
+                  if(first_message && first_message.length > 0){
+                    return <option key={index} value={chat_id}>{first_message.substring(0,30)}</option>
                   }
                   else{
                     return <option key={index} value={chat_id}>{"Chat "+chat_id}</option>
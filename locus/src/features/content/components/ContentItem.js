@@ -2,8 +2,7 @@ import React from "react";
 import { Box, Flex, IconButton, Text, Tooltip, ListItem, Checkbox } from "@chakra-ui/react";
 import { DownloadIcon, CheckCircleIcon, AttachmentIcon } from "@chakra-ui/icons";
 import api from "../../../api"
-import { toggleSelectDocument } from "../contentSlice";
-import { fetchContent } from "../contentSlice";
+import { toggleSelectDocument, upsertDocument } from "../contentSlice";
 import { useDispatch, useSelector } from "react-redux";
 
 
@@ -12,9 +11,9 @@ const ContentItem = ({ title, content_type, content_id, zotero_key, hasPdf, isDo
   const selectedDocs = useSelector((state) => state.content.selected);
 
   const handleDownloadPdf = async () => {
-    // download a pdf and refetch the content list
-    await api.post("/dl_zotero", {id:content_id, zotero_key, content_type});
-    dispatch(fetchContent());
+    // download a pdf and update the entry it was attached to
+    const response = await api.post("/dl_zotero", {id:content_id, zotero_key, content_type});
+    dispatch(upsertDocument(response.data.item));
   };
 
   const handleUploadPdf = () => {
@@ -1,6 +1,7 @@
 import React, { useEffect, useState, useCallback, useMemo, useRef } from "react";
 import { useSelector, useDispatch } from "react-redux";
-import { fetchContent } from "../contentSlice";
+import { fetchContent, fetchChanges } from "../contentSlice";
+import io from 'socket.io-client';
 import api from "../../../api";
 import {
   Box,
@@ -44,6 +45,7 @@ const ContentList = ({ onSelect }) => {
     endDate: ''
   });
   const [filteredDocuments, setFilteredDocuments] = useState(documents);
+  const [syncJob, setSyncJob] = useState(null);
 
 
 
@@ -95,6 +97,20 @@ const ContentList = ({ onSelect }) => {
     filterDocuments();
   }, [documents, filters]);
 
+  useEffect(() => {
+    // the server pushes compact change events; pull the changed rows when they arrive
+    const socket = io.connect("http://locus.hirobotics.org/api");
+    const handleContentChanges = () => dispatch(fetchChanges());
+    socket.on("connect", () => socket.emit("subscribe"));
+    socket.on("content_changes", handleContentChanges);
+    socket.on("sync_progress", setSyncJob);
+    return () => {
+      socket.off("content_changes", handleContentChanges);
+      socket.off("sync_progress", setSyncJob);
+      socket.disconnect();
+    };
+  }, [dispatch]);
+
   // useEffect(() => {
   //   const fetchData = async () => {
   //     await dispatch(fetchContent());
@@ -132,10 +148,13 @@ const ContentList = ({ onSelect }) => {
   };
 
   const handleSyncClick = async () => {
-    await api.post("/sync");
-    dispatch(fetchContent());
+    // the sync runs in the background; its progress and the synced items arrive over the socket
+    const response = await api.post("/sync");
+    setSyncJob(response.data);
   };
 
+  const syncing = syncJob && (syncJob.status === "queued" || syncJob.status === "running");
+
   const handleNewClick = () => {
     dispatch(setId(undefined));
     dispatch(setTitle(""));
@@ -166,9 +185,16 @@ const ContentList = ({ onSelect }) => {
               // onChange={handleSearchInputChange}
             />
             < IconButton  aria-label="Search content" onClick={filterDocuments} icon={<SearchIcon />} />
-            < IconButton aria-label="Sync with Zotero" icon={<RepeatIcon />} onClick={handleSyncClick} />
+            < IconButton aria-label="Sync with Zotero" icon={<RepeatIcon />} onClick={handleSyncClick} isLoading={syncing} />
             < IconButton aria-label="New content" icon={<AddIcon />} onClick={handleNewClick} />
           </HStack>
+          {syncing && syncJob.progress.total !== null && (
+            <Text fontSize="sm">
+              Syncing {syncJob.progress.items} of {syncJob.progress.total}
+              {syncJob.progress.eta_seconds !== null && ` (about ${Math.ceil(syncJob.progress.eta_seconds)}s left)`}
+            </Text>
+          )}
+          {syncJob && syncJob.status === "failed" && <Text fontSize="sm" color="red.500">Sync failed: {syncJob.error}</Text>}
           </Box>
           <Accordion allowToggle width="100%">
             <AccordionItem>
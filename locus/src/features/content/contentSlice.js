@@ -4,12 +4,30 @@ import api from "../../api"
 
 const initialState = {
   documents: [],
-  selected: {}
+  selected: {},
+  cursor: null
 };
 
 export const fetchContent = createAsyncThunk("content/fetchContent", async () => {
   const response = await api.get("/content");
-  return response.data;
+  // where /changes picks up after this listing
+  return { documents: response.data, cursor: response.headers["x-change-cursor"] };
+});
+
+// fetch everything written since the last call, following /changes until it is exhausted
+export const fetchChanges = createAsyncThunk("content/fetchChanges", async (_, { getState }) => {
+  let cursor = getState().content.cursor;
+  let items = [];
+  let deleted = [];
+  let hasMore = true;
+  while (hasMore) {
+    const response = await api.get("/changes", { params: cursor ? { since: cursor } : {} });
+    items = items.concat(response.data.items);
+    deleted = deleted.concat(response.data.deleted);
+    cursor = response.data.cursor;
+    hasMore = response.data.has_more;
+  }
+  return { items, deleted, cursor };
 });
 
 export const saveQuillDocument = createAsyncThunk("content/saveQuillDocument", async (documentData) => {
@@ -17,6 +35,20 @@ export const saveQuillDocument = createAsyncThunk("content/saveQuillDocument", a
   return response.data;
 });
 
+// save the edits made to a note since `revision`, e.g. {id: 7, revision: 12, ops: [{retain: 120}, {insert: "a"}], title}
+export const saveNoteEdit = createAsyncThunk("content/saveNoteEdit", async ({ id, revision, ops, title }, { rejectWithValue }) => {
+  try {
+    const response = await api.post("/save_quill", { id, base_revision: revision, ops, title });
+    return response.data;
+  } catch (error) {
+    if (error.response && error.response.status === 409) {
+      // the note has a later revision
+      return rejectWithValue({ conflict: true, revision: error.response.data.revision });
+    }
+    throw error;
+  }
+});
+
 
 const contentSlice = createSlice({
   name: "content",
@@ -25,6 +57,15 @@ const contentSlice = createSlice({
     addDocument: (state, action) => {
       state.documents.push(action.payload);
     },
+    upsertDocument: (state, action) => {
+      // replace the document with the same id, or add it if it is new
+      const index = state.documents.findIndex((doc) => doc.id === action.payload.id);
+      if (index >= 0) {
+        state.documents[index] = action.payload;
+      } else {
+        state.documents.push(action.payload);
+      }
+    },
     selectDocument: (state, action) => {
       state.selected[action.payload.id] = true;
     },
@@ -44,22 +85,53 @@ const contentSlice = createSlice({
     builder
       .addCase(fetchContent.fulfilled, (state, action) => {
         // Replace the current state with the fetched content
-        state.documents = action.payload;
+        state.documents = action.payload.documents;
+        state.cursor = action.payload.cursor;
         // state.customPages = action.payload.customPages;
       })
+      .addCase(fetchChanges.fulfilled, (state, action) => {
+        const deletedIds = new Set(action.payload.deleted.map((tombstone) => tombstone.id));
+        const changed = {};
+        action.payload.items.forEach((item) => { changed[item.id] = item; });
+        state.documents = state.documents
+          .filter((doc) => !deletedIds.has(doc.id))
+          .map((doc) => changed[doc.id] || doc);
+        const known = new Set(state.documents.map((doc) => doc.id));
+        action.payload.items.forEach((item) => {
+          if (!known.has(item.id)) {
+            state.documents.push(item);
+          }
+        });
+        state.cursor = action.payload.cursor;
+      })
       .addCase(saveQuillDocument.fulfilled, (state, action) => {
         if (action.payload.error){
           console.log(action.payload.error);
           return;
         }
         else{
-          state.documents = action.payload.saved_content;
+          // the response only carries the saved document
+          const saved = action.payload.saved_content;
+          const index = state.documents.findIndex((doc) => doc.id === saved.id);
+          if (index >= 0) {
+            state.documents[index] = saved;
+          } else {
+            state.documents.push(saved);
+          }
         }
         
+      })
+      .addCase(saveNoteEdit.fulfilled, (state, action) => {
+        const doc = state.documents.find((doc) => doc.id === action.meta.arg.id);
+        if (doc) {
+          // the document itself comes with /changes
+          doc.revision = action.payload.revision;
+          doc.title = action.meta.arg.title;
+        }
       });
   },
 });
 
-export const { addDocument, selectDocument, deselectDocument, toggleSelectDocument } = contentSlice.actions;
+export const { addDocument, upsertDocument, selectDocument, deselectDocument, toggleSelectDocument } = contentSlice.actions;
 
 export default contentSlice.reducer;
@@ -47,6 +47,12 @@ const processHighlights = (highlights) => {
     }
   };
 
+  // the saved delta and revision of a note, the base of its incremental saves
+  export const fetchNoteDocument = async (id) => {
+    const response = await api.get(`/content/${id}/document`);
+    return response.data;
+  };
+
   export const loadPdf = (item, dispatch) =>{
     dispatch(setFilename(item.filename));
     dispatch(setContent(""));
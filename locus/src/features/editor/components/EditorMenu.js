@@ -3,12 +3,12 @@ import { useSelector, useDispatch } from 'react-redux';
 import { Box, HStack, Select, Input, IconButton, Icon } from '@chakra-ui/react';
 import { FaRegSave, FaSearch } from 'react-icons/fa';
 import { setTitle, setType, addAuthor } from '../editorSlice';
-import { saveQuillDocument } from '../../content/contentSlice';
+import { saveNoteEdit, saveQuillDocument } from '../../content/contentSlice';
 
 
 const EditorMenu = ({ quillRef }) => {
     const dispatch = useDispatch();
-    const { id, title, content, type, delta, authors } = useSelector((state) => state.editor);
+    const { id, title, content, type, delta, authors, revision, edits, saving } = useSelector((state) => state.editor);
     const { user, isAuthenticated } = useSelector((state) => state.user);
     const [searchText, setSearchText] = useState('');
 
@@ -21,8 +21,18 @@ const EditorMenu = ({ quillRef }) => {
     };
 
     const handleSave = async () => {
+        if (saving) {
+            // the next save is based on the revision this one creates
+            return;
+        }
+        const isAuthor = authors.some(author => author['id'] === user.author_id);
+        if (type === 'note' && id !== undefined && revision !== null && isAuthor) {
+            // only the edits since the saved revision (see QuillEditor)
+            dispatch(saveNoteEdit({ id, revision, ops: edits, title }));
+            return;
+        }
         const new_authors = [...authors];
-        if(!authors.some(author => author['id'] === user.author_id)){
+        if(!isAuthor){
             new_authors.push({ id: user.author_id, first_name: user.first_name, last_name: user.last_name })
             dispatch(addAuthor({ id: user.author_id, first_name: user.first_name, last_name: user.last_name }))
         }
@@ -1,8 +1,8 @@
 import hljs from 'highlight.js'
 
-import React, { useEffect, useState } from 'react';
-import { useDispatch, useSelector } from 'react-redux';
-import { setContent, setId, setTitle, setType, setDelta, setAuthors, setFilename, pushSaveStack, popSaveStack } from "../editorSlice";
+import React, { useEffect, useRef, useState } from 'react';
+import { useDispatch, useSelector, useStore } from 'react-redux';
+import { setContent, setId, setTitle, setType, setDelta, setAuthors, setFilename, pushSaveStack, popSaveStack, noteLoaded, addEdit } from "../editorSlice";
 import ReactQuill from 'react-quill';
 import 'react-quill/dist/quill.snow.css';
 import Quill from 'quill';
@@ -10,7 +10,7 @@ import QuillMarkdown from 'quilljs-markdown';
 import CitationAutocomplete from './CitationAutocomplete';
 import { toRange, fromRange } from "dom-anchor-text-quote";
 import CitationLinkBlot from './CitationLinkBlot';
-import { loadDoc } from '../actions';
+import { loadDoc, fetchNoteDocument } from '../actions';
 // import hljs from 'highlight.js'
 
 import 'highlight.js/styles/monokai-sublime.css'
@@ -20,12 +20,21 @@ window.hljs = hljs;
 // Register the quilljs-markdown module
 Quill.register('modules/markdown', QuillMarkdown);
 Quill.register('formats/citation-link',CitationLinkBlot);
+const Delta = Quill.import('delta');
 
 const QuillEditor = ({quillRef}) => {
   const dispatch = useDispatch();
+  const store = useStore();
   const content = useSelector((state) => state.editor.content);
   const documents = useSelector((state) => state.content.documents);
   const doc_id = useSelector((state) => state.editor.id);
+  const type = useSelector((state) => state.editor.type);
+  const revision = useSelector((state) => state.editor.revision);
+  const conflict = useSelector((state) => state.editor.conflict);
+  const loaded = revision !== null;
+  const revisionRef = useRef(revision);
+  revisionRef.current = revision;
+  const loadingRef = useRef(false);
   // const quill = quillRef.current.getEditor();
   const highlights = useSelector((state) => state.editor.highlights) // dict of highlights
   const docHighlights = Object.values(highlights).filter(highlight => highlight.content.content_metadata.doc_id == doc_id)
@@ -53,6 +62,51 @@ const QuillEditor = ({quillRef}) => {
   //   }
   // }, [saveddelta, quillRef]);
 
+  // collect the edits of a note for incremental saves (see EditorMenu)
+  useEffect(() => {
+    const quill = quillRef.current.getEditor();
+    const handleTextChange = (delta, oldDelta, source) => {
+      // the edits of a note that is not loaded yet are overwritten by loading it
+      if (loadingRef.current || revisionRef.current === null) {
+        return;
+      }
+      dispatch(addEdit(delta.ops));
+    };
+    quill.on('text-change', handleTextChange);
+    return () => quill.off('text-change', handleTextChange);
+  }, [quillRef, dispatch]);
+
+  // show the saved document of a note, which the edits are based on; after a conflicting save, rebase the unsaved
+  // edits on it
+  useEffect(() => {
+    if (doc_id === undefined || type !== 'note' || (loaded && !conflict)) {
+      return;
+    }
+    let cancelled = false;
+    fetchNoteDocument(doc_id).then((note) => {
+      if (cancelled) {
+        return;
+      }
+      const { base, edits } = store.getState().editor;
+      const saved = new Delta(note.delta.ops);
+      const rebased = new Delta(base).diff(saved).transform(new Delta(edits), true);
+      const quill = quillRef.current.getEditor();
+      loadingRef.current = true;
+      try {
+        quill.setContents(saved);
+      } finally {
+        loadingRef.current = false;
+      }
+      dispatch(noteLoaded({ revision: note.revision, ops: note.delta.ops }));
+      if (rebased.ops.length > 0) {
+        quill.updateContents(rebased, 'user');
+      }
+    }).catch((error) => {
+      console.error('Error loading note:', error);
+    });
+    return () => { cancelled = true; };
+  }, [doc_id, type, loaded, conflict]);
+
   const handleChange = (content, delta, source, editor) => {
     dispatch(setDelta(JSON.stringify(editor.getContents())));
     dispatch(setContent(content));
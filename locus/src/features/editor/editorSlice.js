@@ -1,4 +1,10 @@
-import { createSlice } from '@reduxjs/toolkit';
+import { createSlice, current } from '@reduxjs/toolkit';
+import Quill from 'quill';
+import { saveNoteEdit, saveQuillDocument } from '../content/contentSlice';
+
+const Delta = Quill.import('delta');
+
+const compose = (ops, next) => new Delta(ops).compose(new Delta(next)).ops;
 
 const initialState = {
   id: undefined,
@@ -12,6 +18,20 @@ const initialState = {
   currentHighlight: null,
   scrollTo: null,
   saveStack: [],
+  // incremental saves of a note: its saved revision (null until the editor shows it, see QuillEditor), the ops of the
+  // document at that revision, and the ops of the edits made since
+  revision: null,
+  base: [],
+  edits: [],
+  conflict: false,
+  saving: false,
+};
+
+const resetNote = (state) => {
+  state.revision = null;
+  state.base = [];
+  state.edits = [];
+  state.conflict = false;
 };
 
 const editorSlice = createSlice({
@@ -19,6 +39,9 @@ const editorSlice = createSlice({
   initialState,
   reducers: {
     setId: (state, action) => {
+      if (state.id !== action.payload) {
+        resetNote(state);
+      }
       state.id = action.payload;
     },
     setContent: (state, action) => {
@@ -76,6 +99,9 @@ const editorSlice = createSlice({
       // restore the previous state from the save stack
       const previousState = state.saveStack.pop();
       if(previousState != undefined){
+      if (state.id !== previousState.id) {
+        resetNote(state);
+      }
       state.id = previousState.id;
       state.title = previousState.title;
       state.content = previousState.content;
@@ -87,10 +113,67 @@ const editorSlice = createSlice({
       state.currentHighlight = previousState.currentHighlight;
       state.scrollTo = previousState.scrollTo;
       }
+    },
+    noteLoaded: (state, action) => {
+      // e.g. {revision: 12, ops: [...]}: the saved document the editor shows now
+      state.revision = action.payload.revision;
+      state.base = action.payload.ops;
+      state.edits = [];
+      state.conflict = false;
+    },
+    addEdit: (state, action) => {
+      state.edits = compose(current(state.edits), action.payload);
     }
   },
+  extraReducers: (builder) => {
+    builder
+      .addCase(saveNoteEdit.pending, (state, action) => {
+        // the edits are on their way; the ones made from now on go with the next save
+        state.edits = [];
+        state.saving = true;
+      })
+      .addCase(saveNoteEdit.fulfilled, (state, action) => {
+        state.saving = false;
+        if (action.meta.arg.id !== state.id) {
+          return;
+        }
+        state.base = compose(current(state.base), action.meta.arg.ops);
+        state.revision = action.payload.revision;
+      })
+      .addCase(saveNoteEdit.rejected, (state, action) => {
+        state.saving = false;
+        if (action.meta.arg.id !== state.id) {
+          return;
+        }
+        // not saved: keep the edits, in front of the ones made since
+        state.edits = compose(action.meta.arg.ops, current(state.edits));
+        if (action.payload && action.payload.conflict) {
+          // saved elsewhere in the meantime; QuillEditor reloads the note and rebases the edits on it
+          state.conflict = true;
+        }
+      })
+      .addCase(saveQuillDocument.pending, (state, action) => {
+        state.saving = true;
+      })
+      .addCase(saveQuillDocument.rejected, (state, action) => {
+        state.saving = false;
+      })
+      .addCase(saveQuillDocument.fulfilled, (state, action) => {
+        state.saving = false;
+        const saved = action.payload.saved_content;
+        if (action.payload.error || saved.content_type !== 'note' || (state.id !== undefined && state.id !== saved.id)) {
+          return;
+        }
+        // the saved document is the base of the next incremental save
+        state.id = saved.id;
+        state.revision = saved.revision;
+        state.base = JSON.parse(action.meta.arg.delta).ops;
+        state.edits = state.delta ? new Delta(state.base).diff(new Delta(JSON.parse(state.delta).ops)).ops : [];
+        state.conflict = false;
+      });
+  },
 });
 
-export const { setId, setContent, setTitle, setType, setDelta, setAuthors, setFilename, addAuthor, setHighlights, addHighlight, setCurrentHighlight, setScrollTo, pushSaveStack, popSaveStack } = editorSlice.actions;
+export const { setId, setContent, setTitle, setType, setDelta, setAuthors, setFilename, addAuthor, setHighlights, addHighlight, setCurrentHighlight, setScrollTo, pushSaveStack, popSaveStack, noteLoaded, addEdit } = editorSlice.actions;
 
 export default editorSlice.reducer;